@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark auto_crop_image against the original Image.point/getbbox version.
+
+Run with: python benchmarks/bench_auto_crop.py [--pages 20] [--dpi 300]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from edubase_cli import auto_crop_image, parse_page_size, capture_geometry
+
+
+def reference_crop(img: Image.Image, threshold: int, margin_px: int) -> Image.Image:
+    """auto_crop_image as it was before the NumPy version"""
+    g = img.convert('L')
+    mask = g.point(lambda x: 0 if x > threshold else 255, mode='1')
+    bbox = mask.getbbox()
+    if not bbox:
+        return img
+    left, top, right, bottom = bbox
+    left = max(left - margin_px, 0)
+    top = max(top - margin_px, 0)
+    right = min(right + margin_px, img.width)
+    bottom = min(bottom + margin_px, img.height)
+    return img.crop((left, top, right, bottom))
+
+
+def make_page(width: int, height: int, seed: int) -> Image.Image:
+    """White page with a text-like block and a screen-sized white border"""
+    img = Image.new('RGB', (width, height), color='white')
+    draw = ImageDraw.Draw(img)
+    left, top = width // 8 + seed, height // 10
+    line = max(height // 60, 4)
+    for n in range(45):
+        y = top + n * line
+        draw.rectangle((left, y, width - width // 8 - (seed * 7) % 200, y + line // 2), fill=(30, 30, 30))
+    return img
+
+
+def timed(fn, pages) -> float:
+    start = time.perf_counter()
+    for img in pages:
+        fn(img, threshold=248, margin_px=8)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--page-size', default='a4')
+    args = parser.parse_args()
+    
+    geometry = capture_geometry(args.dpi, parse_page_size(args.page_size))
+    width, height = (round(v * geometry['device_scale_factor']) for v in geometry['page_css'])
+    pages = [make_page(width, height, seed) for seed in range(args.pages)]
+    
+    for img in pages:
+        assert auto_crop_image(img, 248, 8).size == reference_crop(img, 248, 8).size
+    
+    old = timed(reference_crop, pages)
+    new = timed(auto_crop_image, pages)
+    print(f"{args.pages} pages of {width}x{height} px ({args.dpi} dpi {args.page_size})")
+    print(f"  Image.point + getbbox: {old * 1000 / args.pages:7.1f} ms/page")
+    print(f"  NumPy content_bbox:    {new * 1000 / args.pages:7.1f} ms/page")
+    print(f"  Speedup:               {old / new:7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
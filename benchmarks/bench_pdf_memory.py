@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Peak memory of raw PDF assembly for large synthetic books.
+
+Each variant runs in a fresh subprocess and reports its peak RSS, so the
+numbers do not include the page generation or the other variant.
+
+Run with: python benchmarks/bench_pdf_memory.py [--pages 1000 2000]
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image
+import numpy as np
+
+ROOT = Path(__file__).parent.parent
+
+ASSEMBLE = """
+import sys
+from pathlib import Path
+sys.path.insert(0, {root!r})
+import img2pdf
+from edubase_cli import build_pdf_from_images
+pages = sorted(Path({pages!r}).glob("*.jpg"))
+out = Path({out!r})
+if {variant!r} == "in-memory":
+    with open(out, "wb") as f:
+        f.write(img2pdf.convert([str(p) for p in pages], layout_fun=img2pdf.get_fixed_dpi_layout_fun((300, 300))))
+else:
+    build_pdf_from_images(pages, out, dpi=300)
+"""
+
+
+def make_book(directory: Path, count: int) -> int:
+    """count JPEG pages of A4 at 150 dpi with incompressible noise; returns bytes per page"""
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, size=(1754, 1240), dtype=np.uint8)
+    first = directory / "page_0001.jpg"
+    Image.fromarray(noise).save(first, format="JPEG", quality=85)
+    for n in range(2, count + 1):
+        (directory / f"page_{n:04d}.jpg").hardlink_to(first)
+    return first.stat().st_size
+
+
+def peak_rss_mb(variant: str, pages: Path, out: Path) -> tuple:
+    script = ASSEMBLE.format(root=str(ROOT), pages=str(pages), out=str(out), variant=variant)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", script], check=True, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pages', type=int, nargs='+', default=[250, 1000, 2000])
+    args = parser.parse_args()
+    
+    print(f"{'pages':>6} {'book':>9} {'variant':>10} {'peak RSS':>10} {'time':>7}")
+    for count in sorted(args.pages):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            pages = tmp / "pages"
+            pages.mkdir()
+            page_bytes = make_book(pages, count)
+            for variant in ("streaming", "in-memory"):
+                # Fresh measuring process per variant: ru_maxrss of children is a running maximum
+                result = subprocess.run(
+                    [sys.executable, __file__, "--measure", variant, str(pages), str(tmp / f"{variant}.pdf")],
+                    capture_output=True, text=True,
+                )
+                if result.returncode != 0:
+                    print(f"{count:>6} {count * page_bytes / 2**20:>7.0f}MB {variant:>10}    failed (out of memory?)")
+                    continue
+                peak, elapsed = result.stdout.split()
+                print(f"{count:>6} {count * page_bytes / 2**20:>7.0f}MB {variant:>10} {float(peak):>8.0f}MB {float(elapsed):>6.1f}s")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == "--measure":
+        peak, elapsed = peak_rss_mb(sys.argv[2], Path(sys.argv[3]), Path(sys.argv[4]))
+        print(peak, elapsed)
+    else:
+        main()
@@ -5,11 +5,20 @@ Screenshot capture and PDF builder for Edubase with OCR
 """
 import os
 import sys
+import json
+import heapq
+import hashlib
 import time
 import tempfile
+import shutil
+import signal
 import subprocess
+from collections import deque
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from io import BytesIO
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import click
 from rich.console import Console
@@ -27,6 +36,7 @@ from rich.prompt import Confirm, Prompt
 from rich.table import Table
 from rich import box
 
+import numpy as np
 from PIL import Image
 import img2pdf
 import pikepdf
@@ -44,6 +54,7 @@ def natural_key(s: str):
 
 
 def list_images(input_dir: Path) -> List[Path]:
+    # Every image on disk; build warns where the capture journal disagrees (manifest_mismatches)
     exts = {'.png', '.jpg', '.jpeg', '.tif', '.tiff', '.webp'}
     files = [f for f in input_dir.iterdir() if f.suffix.lower() in exts and f.is_file()]
     files.sort(key=lambda p: natural_key(p.name))
@@ -54,6 +65,17 @@ def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
 
+def link_into(source: Path, target: Path) -> None:
+    """Atomically place source at target, hard-linked if possible"""
+    part = target.with_name(f"{target.name}.{os.getpid()}.part")  # Unique per writing process
+    part.unlink(missing_ok=True)
+    try:
+        os.link(source, part)
+    except OSError:
+        shutil.copyfile(source, part)  # Different file system
+    os.replace(part, target)
+
+
 def get_system_info():
     """Get system information"""
     import platform
@@ -72,10 +94,52 @@ def format_size(bytes_size: int) -> str:
     return f"{bytes_size:.1f} TB"
 
 
+CROP_SEARCH_STEP = 8  # Stride of the coarse bounding-box search
+
+
+def content_bbox(img: Image.Image, threshold: int, step: int = CROP_SEARCH_STEP) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box (left, top, right, bottom) of pixels <= threshold in grayscale, None if blank
+    
+    A nearest-neighbour sample of one pixel per step x step cell locates the
+    content; only the margin bands around it are then converted and scanned
+    at full resolution, so the page body is never touched. The result is
+    exact: each band reaches into a sampled content cell.
+    """
+    width, height = img.size
+    
+    def dark(box) -> np.ndarray:
+        return np.asarray(img.crop(box).convert('L')) <= threshold
+    
+    cols_n, rows_n = width // step, height // step
+    rows = np.empty(0, dtype=int)
+    if cols_n and rows_n:
+        sample = img.resize((cols_n, rows_n), Image.NEAREST, box=(0, 0, cols_n * step, rows_n * step))
+        sample = np.asarray(sample.convert('L')) <= threshold
+        rows = np.flatnonzero(sample.any(axis=1))
+        cols = np.flatnonzero(sample.any(axis=0))
+    if rows.size == 0:
+        # Nothing hit the sample grid (blank page or hairline content)
+        mask = dark((0, 0, width, height))
+        rows = np.flatnonzero(mask.any(axis=1))
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(mask.any(axis=0))
+        return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+    
+    edge = (int(rows[0]) + 1) * step
+    top = int(np.flatnonzero(dark((0, 0, width, edge)).any(axis=1))[0])
+    edge = int(rows[-1]) * step
+    bottom = edge + int(np.flatnonzero(dark((0, edge, width, height)).any(axis=1))[-1]) + 1
+    edge = (int(cols[0]) + 1) * step
+    left = int(np.flatnonzero(dark((0, top, edge, bottom)).any(axis=0))[0])
+    edge = int(cols[-1]) * step
+    right = edge + int(np.flatnonzero(dark((edge, top, width, bottom)).any(axis=0))[-1]) + 1
+    return left, top, right, bottom
+
+
 def auto_crop_image(img: Image.Image, threshold: int, margin_px: int) -> Image.Image:
-    g = img.convert('L')
-    mask = g.point(lambda x: 0 if x > threshold else 255, mode='1')
-    bbox = mask.getbbox()
+    # Pixels > threshold considered white background
+    bbox = content_bbox(img, threshold)
     if not bbox:
         return img
     left, top, right, bottom = bbox
@@ -88,6 +152,1000 @@ def auto_crop_image(img: Image.Image, threshold: int, margin_px: int) -> Image.I
 
 # ---------- Capture Phase ----------
 
+EDUBASE_DOC_URL = "https://app.edubase.ch/#doc/{book_id}/{index}"
+EDUBASE_DOC_HASH = "#doc/{book_id}/{index}"
+
+NAV_STRATEGIES = ('hash', 'goto')
+
+DHASH_SIZE = 16
+STALE_REWAIT_S = 0.5
+THUMBNAIL_QUALITY = 60
+MAX_RETRY_BACKOFF_S = 60.0
+
+DEFAULT_VIEWPORT = {'width': 1920, 'height': 1080}
+CSS_PX_PER_INCH = 96
+PAGE_SIZES_MM = {'a4': (210.0, 297.0), 'a5': (148.0, 210.0), 'letter': (215.9, 279.4)}
+# First guess for toolbar/sidebar space around the page at --target-dpi;
+# corrected once the viewer box has been measured
+VIEWER_CHROME_CSS = (80, 120)
+
+# Largest visible canvas/img (clamped to the viewport) is taken as the page
+MIN_VIEWER_CSS = 200
+DETECT_VIEWER_JS = """(minSize) => {
+    let best = null, bestArea = 0;
+    for (const el of document.querySelectorAll('canvas, img')) {
+        const style = getComputedStyle(el);
+        if (style.display === 'none' || style.visibility === 'hidden') continue;
+        const r = el.getBoundingClientRect();
+        const x = Math.max(0, r.left), y = Math.max(0, r.top);
+        const width = Math.min(r.right, window.innerWidth) - x;
+        const height = Math.min(r.bottom, window.innerHeight) - y;
+        if (width < minSize || height < minSize) continue;
+        if (width * height > bestArea) {
+            bestArea = width * height;
+            best = {x, y, width, height};
+        }
+    }
+    return best;
+}"""
+
+IMAGE_FORMATS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+DEFAULT_COMPRESS_LEVEL = {'png': 3, 'jpeg': 92, 'webp': 4}
+COMPRESS_LEVEL_RANGE = {'png': (0, 9), 'jpeg': (1, 95), 'webp': (0, 6)}
+
+# Render marks: before an in-app jump every canvas/img is tagged with its
+# current look (img source; canvas size and a 16x16 pixel digest, so a
+# viewer that redraws a reused canvas counts too). An element that is
+# untagged or no longer matches its tag was painted after the jump.
+RENDER_MARK_JS = """
+    const pixelDigest = c => {
+        try {
+            const probe = document.createElement('canvas');
+            probe.width = probe.height = 16;
+            const ctx = probe.getContext('2d');
+            ctx.drawImage(c, 0, 0, 16, 16);
+            let h = 2166136261;
+            for (const v of ctx.getImageData(0, 0, 16, 16).data) h = Math.imul(h ^ v, 16777619);
+            return (h >>> 0).toString(16);
+        } catch (e) {
+            return '';  // Tainted or WebGL canvas: size only
+        }
+    };
+    const paintMark = el => el.tagName === 'IMG'
+        ? (el.currentSrc || el.src) : `${el.width}x${el.height}:${pixelDigest(el)}`;
+    const visible = el => el.offsetWidth > 0 && el.offsetHeight > 0;
+    const freshPaint = el => el.dataset.edubaseMark === undefined || el.dataset.edubaseMark !== paintMark(el);
+"""
+
+# Let the viewer's hash router switch pages in-process: tag what is painted
+# now and set location.hash, without waiting for the viewer. The readiness
+# probe waits for the repaint. False if the hash already pointed there.
+HASH_NAV_JS = """(hash) => {""" + RENDER_MARK_JS + """
+    const painted = Array.from(document.querySelectorAll('canvas, img'));
+    if (window.location.hash === hash) {
+        for (const el of painted) delete el.dataset.edubaseMark;
+        return false;
+    }
+    for (const el of painted) el.dataset.edubaseMark = paintMark(el);
+    window.location.hash = hash;
+    return true;
+}"""
+RENDER_SETTLE_S = 1.5  # Give Edubase time to render the PDF
+INITIAL_SETTLE_S = 2.0  # Give Edubase time to render after the first load
+
+READY_PROBES = ('fixed', 'dom', 'frames', 'js')
+FRAME_POLL_S = 0.15
+
+# Ready once the hash points at the requested page, every visible <img> has
+# decoded and a visible canvas/img was painted since the last in-app jump
+# (the previous page's canvas is still in the DOM right after the jump).
+DOM_READY_JS = """(index) => {""" + RENDER_MARK_JS + """
+    const hash = window.location.hash;
+    if (hash.startsWith('#doc/') && !hash.endsWith('/' + index)) return false;
+    if (document.readyState !== 'complete') return false;
+    if (document.fonts && document.fonts.status !== 'loaded') return false;
+    const images = Array.from(document.images).filter(visible);
+    if (images.some(im => !im.complete || im.naturalWidth === 0)) return false;
+    const canvases = Array.from(document.querySelectorAll('canvas')).filter(visible);
+    return images.some(freshPaint) || canvases.some(c => c.width > 0 && c.height > 0 && freshPaint(c));
+}"""
+
+
+def wait_for_page_ready(
+    page,
+    index: int,
+    probe: str,
+    timeout_s: float,
+    js_predicate: Optional[str] = None,
+    settle_until: Optional[float] = None,
+) -> bool:
+    """Wait until the viewer has painted page `index`
+    
+    Probes:
+      fixed  - networkidle plus a fixed settle time (legacy behaviour)
+      dom    - DOM_READY_JS: images decoded, canvas/img painted since the jump, hash matches
+      frames - two consecutive viewport frames are identical
+      js     - custom JS predicate, called with the page index
+    
+    Returns False if the page was not ready within timeout_s.
+    """
+    if probe == 'fixed':
+        try:
+            page.wait_for_load_state("networkidle", timeout=3000)
+        except PWTimeout:
+            pass
+        if settle_until is None:
+            settle_until = time.monotonic() + RENDER_SETTLE_S
+        time.sleep(max(0.0, settle_until - time.monotonic()))
+        return True
+    
+    if probe in ('dom', 'js'):
+        expression = js_predicate if probe == 'js' else DOM_READY_JS
+        try:
+            page.wait_for_function(expression, arg=index, timeout=timeout_s * 1000, polling=100)
+            return True
+        except PWTimeout:
+            return False
+    
+    if probe == 'frames':
+        deadline = time.monotonic() + timeout_s
+        previous = page.screenshot(type="png")
+        while time.monotonic() < deadline:
+            time.sleep(FRAME_POLL_S)
+            current = page.screenshot(type="png")
+            if current == previous:
+                return True
+            previous = current
+        return False
+    
+    raise ValueError(f"Unknown readiness probe: {probe}")
+
+
+def goto_page(page, book_id: str, index: int) -> Optional[int]:
+    """Load page `index` with a full page.goto; returns the HTTP status"""
+    response = page.goto(
+        EDUBASE_DOC_URL.format(book_id=book_id, index=index),
+        wait_until="domcontentloaded",
+        timeout=15000,
+    )
+    return response.status if response else None
+
+
+def navigate_to_page(page, book_id: str, index: int, strategy: str) -> Tuple[bool, Optional[int]]:
+    """Show page `index` of the book in the viewer
+    
+    'hash' changes location.hash in-process and returns at once; whether the
+    viewer followed is up to the readiness probe (see reload_after_jump).
+    It falls back to page.goto if the script fails.
+    Returns (jumped, HTTP status of a full navigation).
+    Raises on navigation errors.
+    """
+    if strategy == 'hash':
+        try:
+            return page.evaluate(HASH_NAV_JS, EDUBASE_DOC_HASH.format(book_id=book_id, index=index)), None
+        except Exception:
+            pass  # Fall back to a full navigation
+    return False, goto_page(page, book_id, index)
+
+
+def reload_after_jump(page, book_id: str, index: int, probe: str, timeout_s: float,
+                      js_predicate: Optional[str] = None) -> Tuple[bool, Optional[int]]:
+    """The probe timed out after an in-app jump: load the page in full and wait again
+    
+    Returns (ready, HTTP status).
+    """
+    console.log(f"[yellow]Page {index} did not repaint after the in-app jump, reloading[/yellow]")
+    status = goto_page(page, book_id, index)
+    return wait_for_page_ready(page, index, probe, timeout_s, js_predicate), status
+
+
+def open_worker_tabs(context, first_page, book_url: str, workers: int) -> list:
+    """Open one tab per worker inside the same (logged-in) browser context
+    
+    The first tab was opened on book_url by the caller.
+    """
+    tabs = [first_page]
+    for _ in range(workers - 1):
+        tab = context.new_page()
+        try:
+            tab.goto(book_url, wait_until="domcontentloaded", timeout=30000)
+        except PWTimeout:
+            pass  # The page is navigated again before its first screenshot
+        tabs.append(tab)
+    if len(tabs) > 1:
+        console.print(f"[green]✓[/green] Opened [cyan]{len(tabs)}[/cyan] capture tabs")
+    return tabs
+
+
+def close_quietly(page) -> None:
+    """Close a worker tab; a browser that is already gone must not hide the original error"""
+    try:
+        page.close()
+    except Exception:
+        pass
+
+
+def parse_page_size(value: str) -> Tuple[float, float]:
+    """Page size in mm from a name (a4, a5, letter) or WIDTHxHEIGHT in mm"""
+    key = value.strip().lower()
+    if key in PAGE_SIZES_MM:
+        return PAGE_SIZES_MM[key]
+    try:
+        width, height = (float(v) for v in key.split('x'))
+    except ValueError:
+        raise ValueError(f"Unknown page size: {value} (use a4, a5, letter or WIDTHxHEIGHT in mm)")
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Page size must be positive: {value}")
+    return width, height
+
+
+def capture_geometry(target_dpi: int, page_size_mm: Tuple[float, float]) -> dict:
+    """Device scale factor and viewport that render a page at target_dpi
+    
+    A page shown at its CSS size (96 px per inch) and scaled by
+    target_dpi / 96 comes out at exactly the requested resolution.
+    """
+    page_css = (
+        round(page_size_mm[0] / 25.4 * CSS_PX_PER_INCH),
+        round(page_size_mm[1] / 25.4 * CSS_PX_PER_INCH),
+    )
+    return {
+        'device_scale_factor': target_dpi / CSS_PX_PER_INCH,
+        'page_css': page_css,
+        'viewport': {'width': page_css[0] + VIEWER_CHROME_CSS[0], 'height': page_css[1] + VIEWER_CHROME_CSS[1]},
+    }
+
+
+def fitted_viewport(viewport: dict, box: dict, page_css: Tuple[int, int]) -> dict:
+    """Viewport that grows or shrinks the measured viewer box to page_css"""
+    return {
+        'width': max(320, round(viewport['width'] + page_css[0] - box['width'])),
+        'height': max(320, round(viewport['height'] + page_css[1] - box['height'])),
+    }
+
+
+def detect_viewer_box(page, selector: Optional[str] = None) -> Optional[dict]:
+    """Box of the page element in CSS pixels: the selector's element, else the largest canvas/img"""
+    try:
+        if selector:
+            return page.locator(selector).first.bounding_box(timeout=5000)
+        return page.evaluate(DETECT_VIEWER_JS, MIN_VIEWER_CSS)
+    except Exception:
+        return None
+
+
+def screenshot_options(clip: Optional[dict]) -> dict:
+    """Keyword arguments for page.screenshot: the viewer clip or the full page"""
+    if clip:
+        return {'clip': clip, 'type': 'png'}
+    return {'full_page': True, 'type': 'png'}
+
+
+def thumbnail_options(clip: Optional[dict]) -> dict:
+    """page.screenshot options for the stale-frame hash: the same area as a small JPEG"""
+    # CSS scale and JPEG draft decoding keep frame_dhash at a few ms instead of a full-size PNG decode
+    return {**screenshot_options(clip), 'type': 'jpeg', 'quality': THUMBNAIL_QUALITY, 'scale': 'css'}
+
+
+def page_path(out_dir: Path, index: int, image_format: str = 'png') -> Path:
+    """Path of the captured image for page `index`"""
+    return out_dir / f"page_{index:04d}{IMAGE_FORMATS[image_format]}"
+
+
+def list_page_files(out_dir: Path) -> List[Path]:
+    """Captured page images (page_NNNN.*) in out_dir"""
+    suffixes = set(IMAGE_FORMATS.values())
+    return [f for f in out_dir.glob("page_*") if f.suffix.lower() in suffixes]
+
+
+def encode_image(im: Image.Image, image_format: str, compress_level: Optional[int] = None) -> bytes:
+    """Encode an image in memory
+    
+    compress_level is the PNG zlib level (0-9), the lossless WebP method
+    (0-6) or the JPEG quality (1-95); None uses DEFAULT_COMPRESS_LEVEL.
+    """
+    level = DEFAULT_COMPRESS_LEVEL[image_format] if compress_level is None else compress_level
+    buf = BytesIO()
+    if image_format == 'png':
+        im.save(buf, format="PNG", compress_level=level)
+    elif image_format == 'jpeg':
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        im.save(buf, format="JPEG", quality=level)
+    elif image_format == 'webp':
+        im.save(buf, format="WEBP", lossless=True, method=level)
+    else:
+        raise ValueError(f"Unknown image format: {image_format}")
+    return buf.getvalue()
+
+
+def store_screenshot(
+    data: bytes,
+    filename: Path,
+    crop: bool,
+    crop_threshold: int,
+    crop_margin: int,
+    image_format: str = 'png',
+    compress_level: Optional[int] = None,
+) -> dict:
+    """Write a PNG screenshot to disk, optionally cropped and re-encoded
+    
+    Decoding, cropping and encoding happen in memory and the file is written
+    once. Uncropped PNG bytes are written as-is without any re-encode.
+    Returns the manifest fields (file, sha256, bytes) of the written file.
+    """
+    if crop or image_format != 'png' or compress_level is not None:
+        with Image.open(BytesIO(data)) as im:
+            if im.mode in ('RGBA', 'P'):
+                im = im.convert('RGB')
+            if crop:
+                im = auto_crop_image(im, threshold=crop_threshold, margin_px=crop_margin)
+            data = encode_image(im, image_format, compress_level)
+    
+    # Atomic write: a crash never leaves a half-written page_NNNN file
+    partial = filename.with_name(filename.name + ".part")
+    partial.write_bytes(data)
+    os.replace(partial, filename)
+    return {'file': filename.name, 'sha256': hashlib.sha256(data).hexdigest(), 'bytes': len(data)}
+
+
+def frame_dhash(data: bytes, size: int = DHASH_SIZE) -> int:
+    """Difference hash of an encoded frame (size * size bits)
+    
+    Each bit says whether a pixel of the downscaled grayscale frame is
+    brighter than its right neighbour.
+    """
+    with Image.open(BytesIO(data)) as im:
+        im.draft('L', (size * 8, size * 8))  # JPEG only; cheap decode
+        small = im.convert('L').resize((size + 1, size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def is_stale_frame(frame_hash: int, references: List[Optional[int]], threshold: int) -> bool:
+    """True if the frame matches one of the reference hashes (e.g. the previous page)"""
+    return any(ref is not None and hamming_distance(frame_hash, ref) <= threshold for ref in references)
+
+
+def retry_delay(attempt: int, base_s: float) -> float:
+    """Seconds to wait before retrying a page that failed attempt times (exponential, capped)"""
+    return min(MAX_RETRY_BACKOFF_S, base_s * 2 ** (attempt - 1))
+
+
+def default_postprocess_workers(crop: bool, image_format: str, compress_level: Optional[int]) -> int:
+    """Post-processing processes to use when not set explicitly
+    
+    Plain PNG pass-through has no pixel work, so it stays in the capture loop.
+    """
+    if not crop and image_format == 'png' and compress_level is None:
+        return 0
+    return min(4, os.cpu_count() or 1)
+
+
+def reap_postprocess(in_flight: dict, max_pending: int) -> List[tuple]:
+    """Collect finished post-processing jobs
+    
+    in_flight maps futures to page indices. Blocks while more than
+    max_pending jobs are queued (backpressure for the capture loop) and
+    returns (index, result, exception) for every job that finished.
+    """
+    finished = []
+    while in_flight:
+        if len(in_flight) > max_pending:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+        else:
+            done = [f for f in in_flight if f.done()]
+            if not done:
+                break
+        for future in done:
+            error = future.exception()
+            finished.append((in_flight.pop(future), None if error else future.result(), error))
+    return finished
+
+
+# ---------- Rate Control ----------
+
+class AdaptiveDelay:
+    """AIMD controller for the delay between pages
+    
+    Healthy pages shrink the delay by step_ms (additive); an HTTP error,
+    timeout, failed screenshot or navigation latency spike multiplies it by
+    backoff. With adaptive=False the delay stays at initial_ms.
+    """
+    
+    LATENCY_SPIKE_FACTOR = 3.0
+    LATENCY_EWMA_ALPHA = 0.2
+    
+    def __init__(self, initial_ms: int, adaptive: bool = False, min_ms: int = 0,
+                 max_ms: int = 15000, step_ms: int = 100, backoff: float = 2.0):
+        self.delay_ms = float(initial_ms)
+        self.adaptive = adaptive
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.step_ms = step_ms
+        self.backoff = backoff
+        self.nav_ewma = None
+        self.nav_samples = 0
+        self.backoffs = 0
+        self.history = []
+    
+    @property
+    def delay_s(self) -> float:
+        return self.delay_ms / 1000.0
+    
+    def observe(self, nav_s: Optional[float] = None, status: Optional[int] = None, error: bool = False) -> float:
+        """Feed one page outcome into the controller; returns the new delay (ms)"""
+        spike = (
+            nav_s is not None and self.nav_ewma is not None and self.nav_samples >= 3
+            and nav_s > self.LATENCY_SPIKE_FACTOR * self.nav_ewma
+        )
+        if nav_s is not None:
+            self.nav_ewma = nav_s if self.nav_ewma is None else (
+                self.LATENCY_EWMA_ALPHA * nav_s + (1 - self.LATENCY_EWMA_ALPHA) * self.nav_ewma
+            )
+            self.nav_samples += 1
+        
+        if self.adaptive:
+            if error or spike or (status is not None and status >= 400):
+                self.delay_ms = min(self.max_ms, max(self.delay_ms, self.step_ms) * self.backoff)
+                self.backoffs += 1
+            else:
+                self.delay_ms = max(self.min_ms, self.delay_ms - self.step_ms)
+        self.history.append(self.delay_ms)
+        return self.delay_ms
+    
+    def summary(self) -> str:
+        """One-line description of the delays used, for the capture summary"""
+        if not self.history:
+            return f"{self.delay_ms:.0f} ms"
+        if not self.adaptive:
+            return f"{self.delay_ms:.0f} ms (fixed)"
+        mean = sum(self.history) / len(self.history)
+        return (
+            f"{min(self.history):.0f}-{max(self.history):.0f} ms "
+            f"(avg {mean:.0f}, final {self.delay_ms:.0f}, {self.backoffs} backoffs)"
+        )
+
+
+# ---------- Request Blocking ----------
+
+BLOCK_POLICIES = ('off', 'trackers', 'lean')
+TRACKER_URL_PATTERNS = (
+    r'google-analytics\.com', r'googletagmanager\.com', r'doubleclick\.net', r'hotjar\.(com|io)',
+    r'clarity\.ms', r'sentry\.io', r'facebook\.(com|net)/tr', r'matomo', r'piwik', r'/collect\?',
+)
+LEAN_RESOURCE_TYPES = frozenset({'media', 'eventsource', 'texttrack', 'manifest', 'beacon', 'ping'})
+STUB_RESOURCE_TYPES = frozenset({'script', 'xhr', 'fetch'})
+
+
+class RequestBlocker:
+    """context.route policy that drops requests the page render does not need
+    
+    'trackers' blocks analytics and beacon URLs, 'lean' also media and
+    long-poll resource types; extra_patterns (regexes) are added to either.
+    Blocked scripts and XHRs get an empty 204 so viewer code keeps running,
+    everything else is aborted. Blocked requests are counted per tab.
+    """
+    
+    def __init__(self, policy: str = 'trackers', extra_patterns: tuple = ()):
+        import re
+        if policy not in BLOCK_POLICIES:
+            raise ValueError(f"Unknown block policy: {policy}")
+        patterns = list(extra_patterns)
+        if policy != 'off':
+            patterns = list(TRACKER_URL_PATTERNS) + patterns
+        self.url_re = re.compile('|'.join(f'(?:{p})' for p in patterns)) if patterns else None
+        self.resource_types = LEAN_RESOURCE_TYPES if policy == 'lean' else frozenset()
+        self.per_tab = {}
+        self.by_type = {}
+        self.total = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.url_re is not None or bool(self.resource_types)
+    
+    def route_pattern(self):
+        """URL matcher for context.route; every request only if resource types are blocked"""
+        return '**/*' if self.resource_types else self.url_re
+    
+    def decide(self, url: str, resource_type: str) -> Optional[str]:
+        """'stub', 'abort' or None to let the request through"""
+        if resource_type == 'document':
+            return None  # Never break navigations
+        if resource_type in self.resource_types or (self.url_re is not None and self.url_re.search(url)):
+            return 'stub' if resource_type in STUB_RESOURCE_TYPES else 'abort'
+        return None
+    
+    def _count(self, request) -> None:
+        try:
+            tab = request.frame.page
+        except Exception:
+            tab = None  # Service worker requests have no frame
+        self.per_tab[tab] = self.per_tab.get(tab, 0) + 1
+        self.by_type[request.resource_type] = self.by_type.get(request.resource_type, 0) + 1
+        self.total += 1
+    
+    def handle(self, route) -> None:
+        """Route handler for playwright.sync_api"""
+        action = self.decide(route.request.url, route.request.resource_type)
+        if action is None:
+            route.continue_()
+            return
+        self._count(route.request)
+        if action == 'stub':
+            route.fulfill(status=204, body='')
+        else:
+            route.abort('blockedbyclient')
+    
+    async def handle_async(self, route) -> None:
+        """Route handler for playwright.async_api"""
+        action = self.decide(route.request.url, route.request.resource_type)
+        if action is None:
+            await route.continue_()
+            return
+        self._count(route.request)
+        if action == 'stub':
+            await route.fulfill(status=204, body='')
+        else:
+            await route.abort('blockedbyclient')
+    
+    def take(self, tab) -> int:
+        """Requests blocked on this tab since the last call"""
+        return self.per_tab.pop(tab, 0)
+    
+    def summary(self) -> str:
+        """One-line count of blocked requests by resource type, for the capture summary"""
+        kinds = ", ".join(f"{kind} {n}" for kind, n in sorted(self.by_type.items(), key=lambda kv: -kv[1]))
+        return f"{self.total} requests ({kinds})" if self.total else "0 requests"
+
+
+# ---------- Browser Session ----------
+
+DAEMON_INFO_PATH = Path.home() / '.edubase_browser_daemon.json'
+# Login cookies/storage, saved after every run; loaded by --attach and --non-interactive
+SESSION_STATE_PATH = Path.home() / '.edubase_session.json'
+EXIT_SESSION_INVALID = 3
+
+# Logged out: Edubase shows its login form or leaves the book's #doc/ route
+SESSION_CHECK_JS = """(bookId) => {
+    if (document.querySelector('input[type=password]')) return false;
+    return !bookId || window.location.hash.startsWith('#doc/' + bookId);
+}"""
+
+
+class SessionInvalid(RuntimeError):
+    """The saved session does not get past the Edubase login"""
+
+
+def session_is_valid(page, book_id: Optional[str]) -> bool:
+    """True if the page shows the book rather than the login"""
+    try:
+        return bool(page.evaluate(SESSION_CHECK_JS, book_id))
+    except Exception:
+        return False
+
+
+def apply_viewer_setup(page, setup_js: str) -> None:
+    """Run the --setup-js snippet (zoom, fit to page, close sidebars) in a tab"""
+    try:
+        page.evaluate(setup_js)
+    except Exception as e:
+        console.print(f"[yellow]⚠️  Viewer setup script failed: {e}[/yellow]")
+
+
+def exit_session_invalid(message: str) -> None:
+    """Print why the session is unusable and exit with EXIT_SESSION_INVALID"""
+    console.print(Panel(
+        f"[red]❌ {message}[/red]\n\n"
+        "Log in once with an interactive capture run; the session is then saved to\n"
+        f"[yellow]{SESSION_STATE_PATH}[/yellow] (copy it to the worker or pass --storage-state).",
+        border_style="red"
+    ))
+    sys.exit(EXIT_SESSION_INVALID)
+
+
+def read_daemon_endpoint() -> Optional[str]:
+    """WebSocket endpoint of a running browser-daemon, None if there is none"""
+    try:
+        info = json.loads(DAEMON_INFO_PATH.read_text(encoding='utf-8'))
+        os.kill(info['pid'], 0)
+    except (OSError, ValueError, KeyError):
+        return None
+    return info['ws_endpoint']
+
+
+def daemon_endpoint_or_exit() -> str:
+    """Endpoint for --attach; exits with a hint if no daemon is running"""
+    endpoint = read_daemon_endpoint()
+    if not endpoint:
+        console.print(Panel(
+            "[red]❌ No browser daemon running[/red]\n\n"
+            "Start one in another terminal:\n"
+            "[yellow]python edubase_cli.py browser-daemon[/yellow]",
+            border_style="red"
+        ))
+        sys.exit(1)
+    return endpoint
+
+
+def playwright_driver() -> Tuple[List[str], dict]:
+    """Command prefix and environment of Playwright's node driver
+    
+    Uses Playwright's private driver module: since 1.40 it returns
+    (node, cli.js), older releases a single wrapper script. Raises
+    RuntimeError naming the installed version for any other shape.
+    """
+    from playwright._impl import _driver
+    from playwright._repo_version import version
+    driver = _driver.compute_driver_executable()
+    if isinstance(driver, tuple) and len(driver) == 2:
+        prefix = [str(part) for part in driver]
+    elif isinstance(driver, (str, os.PathLike)):
+        prefix = [str(driver)]
+    else:
+        raise RuntimeError(
+            f"Playwright {version} is not supported by browser-daemon (unknown driver layout); "
+            f"install a version listed in requirements.txt"
+        )
+    env = _driver.get_driver_env() if hasattr(_driver, 'get_driver_env') else os.environ.copy()
+    return prefix, env
+
+
+def browser_server_command(config_path: str) -> Tuple[List[str], dict]:
+    """Playwright's node driver running launch-server, without the `python -m playwright` wrapper
+    
+    The wrapper runs the driver in a child process, so signalling it would not stop the server.
+    """
+    prefix, env = playwright_driver()
+    return prefix + ['launch-server', '--browser', 'firefox', '--config', config_path], env
+
+
+def stop_process_group(process: subprocess.Popen, timeout: float = 10) -> None:
+    """Terminate a process started with start_new_session and everything it launched"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+    try:
+        os.killpg(process.pid, signal.SIGKILL)  # Browser processes outliving the server
+    except ProcessLookupError:
+        pass
+
+
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_browser_daemon(port: int, headless: bool) -> None:
+    """Run a Playwright Firefox server until Ctrl+C or SIGTERM and publish its endpoint in DAEMON_INFO_PATH"""
+    import secrets
+    config = {'headless': headless, 'host': '127.0.0.1', 'port': port, 'wsPath': f"/{secrets.token_hex(16)}"}
+    fd, config_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(config, f)
+    try:
+        command, env = browser_server_command(config_path)
+    except RuntimeError:
+        os.unlink(config_path)
+        raise
+    
+    # `kill <daemon pid>` (the usual way to stop `browser-daemon &`) runs the same cleanup as Ctrl+C
+    previous_handler = signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    # Own process group: node and the Firefox it starts are stopped together
+    server = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True, start_new_session=True)
+    try:
+        endpoint = server.stdout.readline().strip()
+        if not endpoint.startswith('ws://'):
+            raise RuntimeError(f"Browser server did not start (exit code {server.wait()})")
+        DAEMON_INFO_PATH.write_text(json.dumps({'ws_endpoint': endpoint, 'pid': server.pid}), encoding='utf-8')
+        DAEMON_INFO_PATH.chmod(0o600)  # The endpoint path is the only access token
+        console.print(f"[green]✓[/green] Browser daemon listening on [cyan]{endpoint}[/cyan]")
+        console.print("[dim]Run capture with --attach; stop with Ctrl+C or kill.[/dim]")
+        server.wait()
+    except KeyboardInterrupt:
+        console.print("\n[yellow]Stopping browser daemon...[/yellow]")
+    finally:
+        stop_process_group(server)
+        DAEMON_INFO_PATH.unlink(missing_ok=True)
+        os.unlink(config_path)
+        signal.signal(signal.SIGTERM, previous_handler)
+
+
+# ---------- Capture Manifest ----------
+
+MANIFEST_NAME = "capture_manifest.jsonl"
+
+
+def load_manifest(out_dir: Path) -> dict:
+    """Replay the capture journal into {page index: latest record}
+    
+    A truncated last line (crash while appending) is ignored.
+    """
+    manifest = {}
+    path = out_dir / MANIFEST_NAME
+    if not path.exists():
+        return manifest
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            manifest[record['page']] = record
+    return manifest
+
+
+def record_page(
+    out_dir: Path,
+    manifest: dict,
+    index: int,
+    status: str,
+    result: Optional[dict] = None,
+    timings: Optional[dict] = None,
+    error: Optional[BaseException] = None,
+    extra: Optional[dict] = None,
+) -> dict:
+    """Append a page record to the journal and the in-memory manifest"""
+    record = {
+        'page': index,
+        'status': status,
+        'attempts': manifest.get(index, {}).get('attempts', 0) + 1,
+        'ts': round(time.time(), 3),
+    }
+    if result:
+        record.update(result)
+    if timings:
+        record.update({k: round(v, 3) for k, v in timings.items()})
+    if extra:
+        record.update(extra)
+    if error:
+        record['error'] = str(error)[:200]
+    with open(out_dir / MANIFEST_NAME, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + "\n")
+    manifest[index] = record
+    return record
+
+
+def page_is_done(out_dir: Path, manifest: dict, index: int) -> bool:
+    """True if the journal has page `index` as done and its file is intact"""
+    entry = manifest.get(index)
+    if not entry or entry['status'] != 'done':
+        return False
+    try:
+        return (out_dir / entry['file']).stat().st_size == entry['bytes']
+    except OSError:
+        return False
+
+
+def adopt_existing_pages(out_dir: Path, manifest: dict) -> int:
+    """Journal page files captured before the manifest existed
+    
+    Only runs for directories without a journal; empty files are left out
+    so they get captured again. Returns the number of adopted pages.
+    """
+    import re
+    if manifest:
+        return 0
+    adopted = 0
+    for f in sorted(list_page_files(out_dir), key=lambda p: natural_key(p.name)):
+        index = int(re.search(r'page_(\d+)', f.name).group(1))
+        data = f.read_bytes()
+        if not data or index in manifest:
+            continue
+        record_page(out_dir, manifest, index, 'done', result={
+            'file': f.name, 'sha256': hashlib.sha256(data).hexdigest(), 'bytes': len(data),
+        })
+        adopted += 1
+    return adopted
+
+
+def manifest_dpi(out_dir: Path) -> Optional[int]:
+    """Capture resolution recorded by --target-dpi, None if pages carry none"""
+    from collections import Counter
+    dpis = Counter(e['dpi'] for e in load_manifest(out_dir).values() if e['status'] == 'done' and 'dpi' in e)
+    return dpis.most_common(1)[0][0] if dpis else None
+
+
+
+def manifest_mismatches(input_dir: Path, images: List[Path]) -> List[str]:
+    """Pages where the capture journal and the files on disk disagree, one line each"""
+    import re
+    manifest = load_manifest(input_dir)
+    if not manifest:
+        return []
+    problems = []
+    on_disk = set()
+    for f in images:
+        match = re.fullmatch(r'page_(\d+)\.\w+', f.name)
+        if not match:
+            continue
+        index = int(match.group(1))
+        on_disk.add(index)
+        entry = manifest.get(index)
+        if entry is None:
+            problems.append(f"{f.name}: not in the capture journal")
+        elif entry['status'] != 'done':
+            problems.append(f"{f.name}: journaled as {entry['status']}")
+        elif entry['file'] != f.name or f.stat().st_size != entry['bytes']:
+            problems.append(f"{f.name}: changed since capture")
+    for index, entry in sorted(manifest.items()):
+        if entry['status'] == 'done' and index not in on_disk:
+            problems.append(f"{entry['file']}: journaled as done but missing")
+    return problems
+
+# ---------- Sharding ----------
+
+SHARD_INFO_NAME = "shard.json"
+SHARD_INFO_KEYS = ('shard', 'shards', 'book_url', 'first', 'last', 'total_pages')
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """(K, N) from "K/N", 1 <= K <= N"""
+    try:
+        k, n = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ValueError(f"Shard must look like K/N (e.g. 2/4), got {value!r}")
+    if not 1 <= k <= n:
+        raise ValueError(f"Shard {value} is out of range (need 1 <= K <= N)")
+    return k, n
+
+
+def shard_range(start_index: int, total_pages: int, k: int, n: int) -> Tuple[int, int]:
+    """First and last page of shard K of N: contiguous blocks, the first ones one page longer"""
+    count = total_pages - start_index + 1
+    size, extra = divmod(count, n)
+    first = start_index + (k - 1) * size + min(k - 1, extra)
+    return first, first + size - 1 + (1 if k <= extra else 0)
+
+
+def shard_dir_name(k: int, n: int) -> str:
+    return f"shard-{k}-of-{n}"
+
+
+def write_shard_info(shard_dir: Path, k: int, n: int, book_url: str, first: int, last: int, total_pages: int) -> None:
+    """Describe the shard so merge-shards can check that the set is complete"""
+    info = {'shard': k, 'shards': n, 'book_url': book_url, 'first': first, 'last': last, 'total_pages': total_pages}
+    (shard_dir / SHARD_INFO_NAME).write_text(json.dumps(info, indent=2) + "\n", encoding='utf-8')
+
+
+def shard_book(book_url: str) -> str:
+    """Book ID of a shard's URL, the URL itself if it has none"""
+    import re
+    match = re.search(r'#doc/(\d+)', book_url)
+    return match.group(1) if match else book_url
+
+
+def plan_merge(shard_dirs: List[Path]) -> dict:
+    """Check a set of shard directories and pick the file for every page
+    
+    Returns {'pages': {index: (shard_dir, record)}, 'total_pages', 'gaps',
+    'duplicates', 'conflicts', 'problems'}. A page captured by two shards
+    is a duplicate if the bytes match and a conflict otherwise.
+    """
+    infos = []
+    problems = []
+    for shard_dir in shard_dirs:
+        try:
+            info = json.loads((shard_dir / SHARD_INFO_NAME).read_text(encoding='utf-8'))
+        except (OSError, ValueError) as e:
+            problems.append(f"{shard_dir}: no readable {SHARD_INFO_NAME} ({e})")
+            continue
+        missing = [key for key in SHARD_INFO_KEYS if key not in info] if isinstance(info, dict) else SHARD_INFO_KEYS
+        if missing:
+            problems.append(f"Incomplete shard metadata in {shard_dir} (missing {', '.join(missing)})")
+            continue
+        infos.append((shard_dir, info))
+    
+    # Compare the book ID, not the whole URL: shards may start at different pages
+    books = {shard_book(info['book_url']) for _, info in infos}
+    if len(books) > 1:
+        problems.append(f"Shards come from different books ({', '.join(sorted(books))})")
+    counts = {info['shards'] for _, info in infos}
+    totals = {info['total_pages'] for _, info in infos}
+    if len(counts) > 1 or len(totals) > 1:
+        problems.append(f"Shards come from different splits (N={sorted(counts)}, pages={sorted(totals)})")
+    seen_shards = sorted(info['shard'] for _, info in infos)
+    if counts and len(counts) == 1:
+        missing = sorted(set(range(1, counts.pop() + 1)) - set(seen_shards))
+        if missing:
+            problems.append(f"Missing shards: {missing}")
+    
+    pages = {}
+    duplicates = []
+    conflicts = []
+    for shard_dir, info in sorted(infos, key=lambda item: item[1]['shard']):
+        for index, record in sorted(load_manifest(shard_dir).items()):
+            if not page_is_done(shard_dir, {index: record}, index):
+                continue
+            if index in pages:
+                if pages[index][1].get('sha256') == record.get('sha256'):
+                    duplicates.append(index)
+                else:
+                    conflicts.append(index)
+                continue
+            pages[index] = (shard_dir, record)
+    
+    total_pages = max(totals) if totals else 0
+    first_page = min((info['first'] for _, info in infos), default=1)
+    gaps = [i for i in range(first_page, total_pages + 1) if i not in pages]
+    return {
+        'pages': pages, 'total_pages': total_pages, 'gaps': gaps,
+        'duplicates': duplicates, 'conflicts': conflicts, 'problems': problems,
+    }
+
+
+def merge_shards(plan: dict, out_dir: Path) -> int:
+    """Link or copy every planned page into out_dir and journal it there; returns pages merged"""
+    ensure_dir(out_dir)
+    manifest = load_manifest(out_dir)
+    merged = 0
+    for index, (shard_dir, record) in sorted(plan['pages'].items()):
+        source = shard_dir / record['file']
+        target = out_dir / source.name
+        if target.resolve() != source.resolve():
+            link_into(source, target)
+        result = {k: record[k] for k in ('file', 'sha256', 'bytes')}
+        extra = {k: v for k, v in record.items() if k not in result and k not in ('page', 'status', 'attempts', 'ts')}
+        extra['shard'] = shard_dir.name
+        record_page(out_dir, manifest, index, 'done', result=result, extra=extra)
+        merged += 1
+    return merged
+
+
+def print_capture_summary(
+    out_dir: Path,
+    captured_count: int,
+    skipped_count: int,
+    failed_pages: List[int],
+    manifest: Optional[dict] = None,
+    rate: Optional[AdaptiveDelay] = None,
+    blocker: Optional[RequestBlocker] = None,
+) -> None:
+    """Print the capture summary table and next-step hints"""
+    console.print()
+    summary = Table(show_header=False, box=box.ROUNDED, border_style="green")
+    summary.add_column("Metric", style="cyan")
+    summary.add_column("Value", style="green")
+    summary.add_row("✓ Captured", str(captured_count))
+    if skipped_count > 0:
+        summary.add_row("⏭️  Skipped", f"{skipped_count} (already existed)")
+    if failed_pages:
+        failed_pages.sort()
+        summary.add_row("❌ Failed", f"{len(failed_pages)}: {failed_pages}")
+    
+    if manifest is not None:
+        total_files = sum(1 for entry in manifest.values() if entry['status'] == 'done')
+    else:
+        total_files = len(list_page_files(out_dir))
+    summary.add_row("📁 Total Files", str(total_files))
+    if rate is not None:
+        summary.add_row("⏱️  Delay", rate.summary())
+    if blocker is not None and blocker.enabled:
+        summary.add_row("🚫 Blocked", blocker.summary())
+    
+    console.print(Panel(summary, title="[bold green]✓ Capture Complete[/bold green]", border_style="green"))
+    
+    if failed_pages:
+        console.print("\n[yellow]💡 Tip: Restart with --retry-failed to capture only the failed pages[/yellow]")
+    
+    console.print()
+    console.print("[bold cyan]➜ Next:[/bold cyan] Run [yellow]python edubase_cli.py build[/yellow] to create PDF")
+    console.print()
+
+
 def capture_pages(
     book_url: str,
     total_pages: int,
@@ -99,22 +1157,100 @@ def capture_pages(
     crop: bool,
     crop_threshold: int,
     crop_margin: int,
+    workers: int = 1,
+    ready_probe: str = 'dom',
+    ready_timeout: float = 10.0,
+    ready_js: Optional[str] = None,
+    engine: str = 'sync',
+    nav_strategy: str = 'hash',
+    image_format: str = 'png',
+    compress_level: Optional[int] = None,
+    postprocess_workers: Optional[int] = None,
+    retry_failed: bool = False,
+    stale_retries: int = 2,
+    stale_threshold: int = 2,
+    adaptive_delay: bool = False,
+    min_delay_ms: int = 0,
+    max_delay_ms: int = 15000,
+    max_attempts: int = 3,
+    retry_backoff_s: float = 2.0,
+    block_policy: str = 'trackers',
+    block_patterns: tuple = (),
+    target_dpi: Optional[int] = None,
+    page_size: str = 'a4',
+    viewer_selector: Optional[str] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    attach: bool = False,
+    headless: bool = False,
+    non_interactive: bool = False,
+    storage_state: Optional[Path] = None,
+    setup_js: Optional[str] = None,
 ) -> None:
-    """Capture pages on Ubuntu with Playwright"""
+    """Capture pages on Ubuntu with Playwright
     
-    ensure_dir(out_dir)
+    With workers > 1, that many tabs share the persistent context and take
+    page indices from a common queue, so their render waits overlap.
+    engine='async' runs the same capture on playwright.async_api.
+    Crop, encode and write run in a pool of postprocess_workers processes.
+    Every page outcome is journaled in MANIFEST_NAME inside out_dir.
+    Frames whose difference hash is within stale_threshold bits of the
+    previous frame are re-captured up to stale_retries times.
+    adaptive_delay tunes per_page_delay_ms at runtime (see AdaptiveDelay).
+    Failed pages are retried in the same run, up to max_attempts in total,
+    after retry_backoff_s, then twice as long for every further attempt.
+    Requests matched by block_policy / block_patterns are dropped (see
+    RequestBlocker) so networkidle waits are not held up by trackers.
+    With target_dpi, the device scale factor and viewport are chosen so a
+    page_size page renders at that resolution.
+    Unless fullpage is set, screenshots are clipped to the viewer element
+    (viewer_selector, else the largest canvas/img), which replaces crop.
+    With shard=(K, N), only the K-th of N contiguous page blocks is captured,
+    into its own shard-K-of-N directory under out_dir (see merge-shards).
+    attach runs on the browser-daemon instead of launching Firefox.
+    non_interactive never prompts: it logs in from storage_state (default
+    SESSION_STATE_PATH), runs setup_js in place of the manual viewer setup
+    and exits with EXIT_SESSION_INVALID if that session is logged out, or 1
+    if pages failed.
+    """
+    endpoint = daemon_endpoint_or_exit() if attach else None
+    session_path = storage_state or SESSION_STATE_PATH
+    if non_interactive and not session_path.exists():
+        exit_session_invalid(f"No saved session at {session_path}")
     
     # Extract book ID
     import re
     match = re.search(r'#doc/(\d+)', book_url)
     book_id = match.group(1) if match else None
     
+    first_run = start_index == 1 and not non_interactive
+    if shard:
+        k, n = shard
+        first, last = shard_range(start_index, total_pages, k, n)
+        if first > last:
+            console.print(f"[yellow]⚠️  Shard {k}/{n} has no pages ({total_pages - start_index + 1} pages in total)[/yellow]")
+            return
+        out_dir = out_dir / shard_dir_name(k, n)
+        ensure_dir(out_dir)
+        write_shard_info(out_dir, k, n, book_url, first, last, total_pages)
+        if book_id:
+            book_url = EDUBASE_DOC_URL.format(book_id=book_id, index=first)
+        start_index = first
+        console.print(f"[blue]ℹ️  Shard {k}/{n}: pages {first}-{last}[/blue]")
+        total_pages = last
+    ensure_dir(out_dir)
+    
+    if workers > 1 and not book_id:
+        console.print("[yellow]⚠️  No book ID in URL, parallel capture disabled (--workers 1)[/yellow]")
+        workers = 1
+    workers = max(1, workers)
+    
     # Welcome panel
     console.print()
     welcome = Panel.fit(
         f"[bold cyan]📸 Screenshot Capture[/bold cyan]\n\n"
         f"Book: [yellow]{book_url}[/yellow]\n"
         f"Pages: [green]{total_pages}[/green]\n"
+        f"Workers: [magenta]{workers}[/magenta]\n"
         f"Output: [blue]{out_dir}[/blue]",
         border_style="cyan",
         title="[bold]Edubase Exporter[/bold]",
@@ -124,8 +1260,8 @@ def capture_pages(
     console.print()
     
     # Check for existing screenshots
-    existing = list(out_dir.glob("page_*.png"))
-    if existing and start_index == 1:
+    existing = list_page_files(out_dir)
+    if existing and first_run and not retry_failed:
         console.print(f"[yellow]⚠️  Found {len(existing)} existing screenshots[/yellow]")
         console.print()
         
@@ -142,13 +1278,26 @@ def capture_pages(
             console.print("[yellow]🗑️  Removing old screenshots...[/yellow]")
             for f in existing:
                 f.unlink()
+            (out_dir / MANIFEST_NAME).unlink(missing_ok=True)
             console.print("[green]✓ Ready for fresh capture[/green]")
         else:
             console.print("[blue]ℹ️  Resuming from last position[/blue]")
         console.print()
     
+    # Per-page journal drives resume and --retry-failed
+    manifest = load_manifest(out_dir)
+    adopted = adopt_existing_pages(out_dir, manifest)
+    if adopted:
+        console.print(f"[blue]ℹ️  Added {adopted} existing pages to {MANIFEST_NAME}[/blue]")
+    failed_before = {i for i, entry in manifest.items() if entry['status'] == 'failed'}
+    if retry_failed:
+        if not failed_before:
+            console.print("[green]✓ No failed pages recorded, nothing to retry[/green]")
+            return
+        console.print(f"[blue]ℹ️  Retrying {len(failed_before)} failed pages[/blue]")
+    
     # Instructions
-    if start_index == 1:
+    if first_run:
         instructions = Table(show_header=False, box=box.ROUNDED, border_style="blue")
         instructions.add_column(justify="left")
         instructions.add_row("[bold cyan]1.[/bold cyan] Browser will open automatically")
@@ -165,191 +1314,1445 @@ def capture_pages(
         console.input("[bold green]Press Enter when ready...[/bold green] ")
         console.print()
     
+    rate = AdaptiveDelay(per_page_delay_ms, adaptive=adaptive_delay, min_ms=min_delay_ms, max_ms=max_delay_ms)
+    blocker = RequestBlocker(block_policy, block_patterns)
+    geometry = capture_geometry(target_dpi, parse_page_size(page_size)) if target_dpi else None
+    if geometry:
+        console.print(
+            f"[blue]ℹ️  {target_dpi} DPI: scale factor {geometry['device_scale_factor']:.2f}, "
+            f"page {geometry['page_css'][0]}x{geometry['page_css'][1]} CSS px[/blue]"
+        )
+    
+    if engine == 'async':
+        import asyncio
+        try:
+            captured_count, skipped_count, failed_pages = asyncio.run(capture_pages_async(
+                book_url=book_url,
+                book_id=book_id,
+                total_pages=total_pages,
+                out_dir=out_dir,
+                start_index=start_index,
+                rate=rate,
+                crop=crop,
+                crop_threshold=crop_threshold,
+                crop_margin=crop_margin,
+                workers=workers,
+                ready_probe=ready_probe,
+                ready_timeout=ready_timeout,
+                ready_js=ready_js,
+                nav_strategy=nav_strategy,
+                image_format=image_format,
+                compress_level=compress_level,
+                postprocess_workers=postprocess_workers,
+                manifest=manifest,
+                retry_pages=failed_before if retry_failed else None,
+                stale_retries=stale_retries,
+                stale_threshold=stale_threshold,
+                max_attempts=max_attempts,
+                retry_backoff_s=retry_backoff_s,
+                blocker=blocker,
+                geometry=geometry,
+                target_dpi=target_dpi,
+                viewer_selector=viewer_selector,
+                fullpage=fullpage,
+                prompt=first_run,
+                endpoint=endpoint,
+                headless=headless,
+                storage_state=session_path if (attach or non_interactive) else None,
+                session_path=session_path,
+                check_session=non_interactive,
+                setup_js=setup_js,
+            ))
+        except SessionInvalid as e:
+            exit_session_invalid(str(e))
+        print_capture_summary(out_dir, captured_count, skipped_count, failed_pages, manifest, rate, blocker)
+        if non_interactive and failed_pages:
+            sys.exit(1)
+        return
+    
     # Start browser
     with sync_playwright() as p:
-        console.print("[green]✓[/green] Browser started")
+        context = launch_capture_context(
+            p, geometry, blocker, endpoint, headless=headless,
+            storage_state=session_path if (attach or non_interactive) else None,
+        )
+        try:
+            captured_count, skipped_count, failed_pages = capture_book(
+                context,
+                book_url=book_url,
+                book_id=book_id,
+                total_pages=total_pages,
+                out_dir=out_dir,
+                start_index=start_index,
+                manifest=manifest,
+                retry_pages=failed_before if retry_failed else None,
+                rate=rate,
+                blocker=blocker,
+                geometry=geometry,
+                crop=crop,
+                crop_threshold=crop_threshold,
+                crop_margin=crop_margin,
+                workers=workers,
+                ready_probe=ready_probe,
+                ready_timeout=ready_timeout,
+                ready_js=ready_js,
+                nav_strategy=nav_strategy,
+                image_format=image_format,
+                compress_level=compress_level,
+                postprocess_workers=postprocess_workers,
+                stale_retries=stale_retries,
+                stale_threshold=stale_threshold,
+                max_attempts=max_attempts,
+                retry_backoff_s=retry_backoff_s,
+                target_dpi=target_dpi,
+                viewer_selector=viewer_selector,
+                fullpage=fullpage,
+                prompt=first_run,
+                check_session=non_interactive,
+                setup_js=setup_js,
+            )
+        except SessionInvalid as e:
+            close_capture_context(context, session_path=None)
+            exit_session_invalid(str(e))
+        close_capture_context(context, session_path)
+    
+    print_capture_summary(out_dir, captured_count, skipped_count, failed_pages, manifest, rate, blocker)
+    if non_interactive and failed_pages:
+        sys.exit(1)
+
+
+FIREFOX_PROFILE_DIR = Path.home() / '.edubase_browser_firefox'
+MAXIMIZE_WINDOW_JS = """() => {
+    window.moveTo(0, 0);
+    window.resizeTo(screen.availWidth, screen.availHeight);
+}"""
+START_PROMPT = "\n[bold green]Press Enter to start capture...[/bold green] "
+
+
+def context_options(geometry: Optional[dict], storage_state: Optional[Path] = None) -> dict:
+    """Viewport and scale factor for the capture geometry, plus the saved login for fresh contexts"""
+    options = {
+        'viewport': geometry['viewport'] if geometry else DEFAULT_VIEWPORT,
+        'device_scale_factor': geometry['device_scale_factor'] if geometry else None,
+    }
+    if storage_state is not None:
+        options['storage_state'] = str(storage_state) if storage_state.exists() else None
+    return options
+
+
+def print_start_prompt() -> None:
+    console.print()
+    console.print(Panel(
+        "[yellow]⚠️  IMPORTANT[/yellow]\n\n"
+        "1. Log in if needed\n"
+        "2. Adjust viewer settings\n"
+        "3. When ready, press Enter in terminal",
+        border_style="yellow"
+    ))
+
+
+def report_viewer_clip(clip: Optional[dict]) -> None:
+    if clip:
+        console.print(f"[green]✓[/green] Clipping to viewer: [cyan]{clip['width']:.0f}x{clip['height']:.0f}[/cyan] CSS px")
+    else:
+        console.print("[yellow]⚠️  Viewer element not found, capturing full page[/yellow]")
+
+
+def capture_progress() -> Progress:
+    return Progress(
+        SpinnerColumn(),
+        TextColumn("[bold blue]{task.description}"),
+        BarColumn(),
+        TaskProgressColumn(),
+        TimeRemainingColumn(),
+        console=console,
+    )
+
+
+class CaptureRun:
+    """Page bookkeeping shared by the sync and async capture engines
+    
+    Holds the work queue, retry attempts and frame hashes of one book,
+    journals finished pages and advances the progress bar. The engine puts
+    failed pages back in line through schedule_retry(delay_s, index).
+    """
+    
+    def __init__(self, out_dir: Path, manifest: dict, start_index: int, total_pages: int,
+                 retry_pages: Optional[set], max_attempts: int, retry_backoff_s: float,
+                 progress: Progress, schedule_retry):
+        self.out_dir = out_dir
+        self.manifest = manifest
+        self.max_attempts = max_attempts
+        self.retry_backoff_s = retry_backoff_s
+        self.progress = progress
+        self.schedule_retry = schedule_retry
+        self.captured = 0
+        self.skipped = 0
+        self.failed_pages = []
+        self.attempts = {}
+        self.page_hashes = {i: int(e['dhash'], 16) for i, e in manifest.items() if 'dhash' in e}
+        self.task = progress.add_task(
+            f"Capturing pages {start_index}-{total_pages}",
+            total=total_pages - start_index + 1
+        )
         
-        # Use Firefox with separate profile directory
-        firefox_profile_dir = Path.home() / '.edubase_browser_firefox'
-        viewport_config = {'width': 1920, 'height': 1080}
+        # Shared work queue; pages journaled as done are skipped up front
+        self.pending = deque()
+        for i in range(start_index, total_pages + 1):
+            if page_is_done(out_dir, manifest, i) or (retry_pages is not None and i not in retry_pages):
+                self.skipped += 1
+                progress.advance(self.task)
+            else:
+                self.pending.append(i)
+        self.unfinished = len(self.pending)
+    
+    def finish_page(self, i: int, result: Optional[dict], error: Optional[BaseException], stage: str,
+                    timings: Optional[dict] = None, extra: Optional[dict] = None) -> None:
+        """Count a finished page, journal it and advance the progress bar
         
+        Failed pages are scheduled again after a backoff until max_attempts is reached.
+        """
+        if error:
+            record_page(self.out_dir, self.manifest, i, 'failed', timings=timings, error=error, extra=extra)
+            self.attempts[i] = self.attempts.get(i, 0) + 1
+            if self.attempts[i] < self.max_attempts:
+                backoff = retry_delay(self.attempts[i], self.retry_backoff_s)
+                console.log(f"[yellow]Page {i} {stage} failed: {error} (retry in {backoff:.0f}s)[/yellow]")
+                self.schedule_retry(backoff, i)
+                return
+            console.log(f"[red]Page {i} {stage} failed: {error}[/red]")
+            self.failed_pages.append(i)
+        else:
+            self.captured += 1
+            record_page(self.out_dir, self.manifest, i, 'done', result=result, timings=timings, extra=extra)
+        self.unfinished -= 1
+        self.progress.advance(self.task)
+    
+    def is_stale(self, i: int, frame_hash: int, last_hash: Optional[int], stale_threshold: int) -> bool:
+        """Same pixels as the tab's last frame or the previous page: the viewer has not repainted yet"""
+        return is_stale_frame(frame_hash, [last_hash, self.page_hashes.get(i - 1)], stale_threshold)
+    
+    def record_frame(self, i: int, frame_hash: int, last_hash: Optional[int], retries: int,
+                     stale_threshold: int) -> dict:
+        """Remember page i's frame hash; returns its manifest fields"""
+        stale = self.is_stale(i, frame_hash, last_hash, stale_threshold)
+        if stale:
+            console.log(f"[yellow]Page {i} still looks like the previous page, keeping it[/yellow]")
+        self.page_hashes[i] = frame_hash
+        return {'dhash': f"{frame_hash:0{DHASH_SIZE * DHASH_SIZE // 4}x}", 'stale_retries': retries, 'stale': stale}
+    
+    def result(self) -> Tuple[int, int, List[int]]:
+        return self.captured, self.skipped, self.failed_pages
+
+
+def launch_capture_context(
+    p,
+    geometry: Optional[dict],
+    blocker: RequestBlocker,
+    endpoint: Optional[str] = None,
+    headless: bool = False,
+    storage_state: Optional[Path] = None,
+):
+    """Launch the Firefox context shared by every capture tab
+    
+    Default is the persistent profile. With endpoint, attach to the
+    browser-daemon; with storage_state, start a plain browser instead. Both
+    open a fresh context logged in from storage_state (if the file exists).
+    """
+    if endpoint or storage_state:
+        if endpoint:
+            browser = p.firefox.connect(endpoint, timeout=10000)
+            console.print("[green]✓[/green] Attached to browser daemon")
+        else:
+            browser = p.firefox.launch(headless=headless)
+            console.print(f"[green]✓[/green] Browser started{' [dim](headless)[/dim]' if headless else ''}")
+        context = browser.new_context(**context_options(geometry, storage_state))
+    else:
+        # Use Firefox with separate profile directory
         context = p.firefox.launch_persistent_context(
-            user_data_dir=str(firefox_profile_dir),
-            headless=False,
-            viewport=viewport_config,
+            user_data_dir=str(FIREFOX_PROFILE_DIR),
+            headless=headless,
+            **context_options(geometry),
         )
-        
-        context.set_default_timeout(30000)
-        context.set_default_navigation_timeout(30000)
-        
-        page = context.pages[0] if context.pages else context.new_page()
-        
-        # Maximize window for full visibility
+        console.print(f"[green]✓[/green] Browser started{' [dim](headless)[/dim]' if headless else ''}")
+    
+    context.set_default_timeout(30000)
+    context.set_default_navigation_timeout(30000)
+    if blocker.enabled:
+        context.route(blocker.route_pattern(), blocker.handle)
+    
+    page = context.pages[0] if context.pages else context.new_page()
+    
+    # Maximize window for full visibility
+    try:
+        page.evaluate(MAXIMIZE_WINDOW_JS)
+    except Exception:
+        # Fallback: Use init script for next page loads
         try:
-            page.evaluate("""() => {
-                window.moveTo(0, 0);
-                window.resizeTo(screen.availWidth, screen.availHeight);
-            }""")
+            page.context.add_init_script(f"({MAXIMIZE_WINDOW_JS})()")
         except Exception:
-            # Fallback: Use init script for next page loads
-            try:
-                page.context.add_init_script("""
-                    window.moveTo(0, 0);
-                    window.resizeTo(screen.availWidth, screen.availHeight);
-                """)
-            except Exception:
-                pass  # Window maximization is non-critical
-        
-        # Navigate to book
-        console.print(f"[blue]🔗[/blue] Opening: [cyan]{book_url}[/cyan]")
+            pass  # Window maximization is non-critical
+    
+    return context
+
+
+def close_capture_context(context, session_path: Optional[Path]) -> None:
+    """Save the login to session_path (unless None) and close the capture context"""
+    if session_path is not None:
         try:
-            page.goto(book_url, wait_until="domcontentloaded", timeout=30000)
-            page.wait_for_load_state("networkidle", timeout=10000)
-        except PWTimeout:
-            console.print("[yellow]⚠️  Page loading slowly, continuing anyway...[/yellow]")
-        
-        # Wait a bit for Edubase to fully load - MINIMAL intervention
-        page.wait_for_load_state("networkidle", timeout=5000)
-        time.sleep(2.0)  # Give Edubase time to render
+            context.storage_state(path=str(session_path))
+            session_path.chmod(0o600)
+        except Exception as e:
+            console.print(f"[yellow]⚠️  Could not save session: {e}[/yellow]")
+    browser = context.browser  # None for the persistent profile
+    context.close()
+    if browser is not None:
+        browser.close()  # On the daemon this only disconnects
+
+
+def open_book(page, book_url: str, book_id: Optional[str], start_index: int, ready_probe: str,
+              ready_timeout: float, ready_js: Optional[str], check_session: bool, prompt: bool) -> None:
+    """Load the book in the first tab, check the login and let the user prepare the viewer"""
+    console.print(f"[blue]🔗[/blue] Opening: [cyan]{book_url}[/cyan]")
+    try:
+        page.goto(book_url, wait_until="domcontentloaded", timeout=30000)
+        page.wait_for_load_state("networkidle", timeout=10000)
+    except PWTimeout:
+        console.print("[yellow]⚠️  Page loading slowly, continuing anyway...[/yellow]")
+    
+    # Wait a bit for Edubase to fully load - MINIMAL intervention
+    try:
+        ready = wait_for_page_ready(
+            page, start_index, ready_probe, ready_timeout, ready_js,
+            settle_until=time.monotonic() + INITIAL_SETTLE_S,
+        )
+    except Exception:
+        ready = False
+    if not ready:
+        console.print("[yellow]⚠️  Viewer not ready yet, continuing anyway...[/yellow]")
+    
+    if check_session and not session_is_valid(page, book_id):
+        raise SessionInvalid(f"Saved session is not logged in ({page.url})")
+    
+    # Give user time to prepare
+    if prompt:
+        print_start_prompt()
+        console.input(START_PROMPT)
+        console.print()
+
+
+def setup_tabs(tabs: list, setup_js: str) -> None:
+    for tab in tabs:
+        apply_viewer_setup(tab, setup_js)
+    time.sleep(RENDER_SETTLE_S)
+
+
+def fit_viewer(page, tabs: list, geometry: Optional[dict], viewer_selector: Optional[str]) -> Optional[dict]:
+    """Clip box of the viewer; at --target-dpi first resize every tab to the page's CSS size"""
+    clip = detect_viewer_box(page, viewer_selector)
+    if clip and geometry:
+        viewport_config = fitted_viewport(page.viewport_size, clip, geometry['page_css'])
+        for tab in tabs:
+            tab.set_viewport_size(viewport_config)
+        time.sleep(RENDER_SETTLE_S)
+        clip = detect_viewer_box(page, viewer_selector)
+    report_viewer_clip(clip)
+    return clip
+
+
+def screenshot_page(page, i: int, clip: Optional[dict], run: CaptureRun, last_hash: Optional[int],
+                    stale_retries: int, stale_threshold: int, ready_probe: str, ready_timeout: float,
+                    ready_js: Optional[str]) -> Tuple[bytes, Optional[int], dict]:
+    """Screenshot page i once its frame is no longer stale
+    
+    Staleness is judged on a small thumbnail, so the full screenshot is
+    neither decoded in the capture loop nor taken again for a stale frame.
+    Returns (PNG bytes, frame hash, manifest fields); no hash without stale_retries.
+    """
+    if not stale_retries:
+        return page.screenshot(**screenshot_options(clip)), None, {}
+    frame_hash = frame_dhash(page.screenshot(**thumbnail_options(clip)))
+    retries = 0
+    while retries < stale_retries and run.is_stale(i, frame_hash, last_hash, stale_threshold):
+        retries += 1
+        time.sleep(STALE_REWAIT_S)
+        wait_for_page_ready(page, i, ready_probe, ready_timeout, ready_js)
+        frame_hash = frame_dhash(page.screenshot(**thumbnail_options(clip)))
+    data = page.screenshot(**screenshot_options(clip))
+    return data, frame_hash, run.record_frame(i, frame_hash, last_hash, retries, stale_threshold)
+
+
+def capture_book(
+    context,
+    book_url: str,
+    book_id: Optional[str],
+    total_pages: int,
+    out_dir: Path,
+    start_index: int,
+    manifest: dict,
+    retry_pages: Optional[set],
+    rate: AdaptiveDelay,
+    blocker: RequestBlocker,
+    geometry: Optional[dict],
+    crop: bool,
+    crop_threshold: int,
+    crop_margin: int,
+    workers: int,
+    ready_probe: str,
+    ready_timeout: float,
+    ready_js: Optional[str],
+    nav_strategy: str,
+    image_format: str,
+    compress_level: Optional[int],
+    postprocess_workers: Optional[int],
+    stale_retries: int,
+    stale_threshold: int,
+    max_attempts: int,
+    retry_backoff_s: float,
+    target_dpi: Optional[int],
+    viewer_selector: Optional[str],
+    fullpage: bool,
+    prompt: bool = True,
+    check_session: bool = False,
+    setup_js: Optional[str] = None,
+):
+    """Capture one book in an already running browser context (sync engine)
+    
+    Worker tabs are opened on the first tab's context and closed again at
+    the end, so the context can go on to the next book. With check_session,
+    raises SessionInvalid instead of waiting for a login.
+    
+    Returns (captured_count, skipped_count, failed_pages).
+    """
+    page = context.pages[0] if context.pages else context.new_page()
+    open_book(page, book_url, book_id, start_index, ready_probe, ready_timeout, ready_js, check_session, prompt)
+    
+    # 'shown' is the page index the tab currently displays; the first tab
+    # was opened on book_url
+    tabs = [
+        {'page': tab, 'index': None, 'shown': None, 'ready_at': 0.0, 'next_nav_at': 0.0, 'last_hash': None}
+        for tab in open_worker_tabs(context, page, book_url, workers)
+    ]
+    tabs[0]['shown'] = start_index
+    postprocess_pool = None
+    try:
+        if setup_js:
+            setup_tabs([t['page'] for t in tabs], setup_js)
         
-        # Give user time to prepare
-        if start_index == 1:
-            console.print()
-            console.print(Panel(
-                "[yellow]⚠️  IMPORTANT[/yellow]\n\n"
-                "1. Log in if needed\n"
-                "2. Adjust viewer settings\n"
-                "3. When ready, press Enter in terminal",
-                border_style="yellow"
-            ))
-            console.input("\n[bold green]Press Enter to start capture...[/bold green] ")
-            console.print()
+        # Clip to the viewer; at --target-dpi first resize it to the page's CSS size
+        clip = None if fullpage else fit_viewer(page, [t['page'] for t in tabs], geometry, viewer_selector)
+        if clip:
+            crop = False  # The clip already is the page
         
         # Start capture with progress bar
         console.print("[bold blue]📸 Starting capture...[/bold blue]")
         console.print()
         
-        captured_count = 0
-        skipped_count = 0
-        failed_pages = []
+        timings = {}
+        frame_info = {}
+        retry_queue = []  # heap of (not_before, page index)
         
-        with Progress(
-            SpinnerColumn(),
-            TextColumn("[bold blue]{task.description}"),
-            BarColumn(),
-            TaskProgressColumn(),
-            TimeRemainingColumn(),
-            console=console,
-        ) as progress:
-            
-            task = progress.add_task(
-                f"Capturing pages {start_index}-{total_pages}",
-                total=total_pages - start_index + 1
+        # Producer/consumer: the browser loop only navigates and snapshots
+        if postprocess_workers is None:
+            postprocess_workers = default_postprocess_workers(crop, image_format, compress_level)
+        postprocess_pool = ProcessPoolExecutor(postprocess_workers) if postprocess_workers else None
+        max_pending = 2 * postprocess_workers
+        in_flight = {}
+        
+        with capture_progress() as progress:
+            run = CaptureRun(
+                out_dir, manifest, start_index, total_pages, retry_pages, max_attempts, retry_backoff_s, progress,
+                schedule_retry=lambda delay_s, i: heapq.heappush(retry_queue, (time.monotonic() + delay_s, i)),
             )
+            pending = run.pending
+            
+            def finish_page(i: int, result: Optional[dict], error: Optional[BaseException], stage: str):
+                run.finish_page(i, result, error, stage, timings.pop(i, None), frame_info.pop(i, None))
             
-            for i in range(start_index, total_pages + 1):
-                filename = out_dir / f"page_{i:04d}.png"
+            while pending or retry_queue or in_flight or any(t['index'] is not None for t in tabs):
+                # Hand out pages to idle tabs whose rate-limit delay has passed;
+                # retries that are due go first
+                now = time.monotonic()
+                for tab in tabs:
+                    if tab['index'] is not None or now < tab['next_nav_at']:
+                        continue
+                    if retry_queue and retry_queue[0][0] <= now:
+                        i = heapq.heappop(retry_queue)[1]
+                    elif pending:
+                        i = pending.popleft()
+                    else:
+                        continue
+                    timings[i] = {'nav_s': 0.0}
+                    tab['status'] = None
+                    tab['jumped'] = False
+                    tab['trouble'] = False
+                    
+                    # Navigate to page
+                    if book_id and tab['shown'] != i:
+                        nav_start = time.monotonic()
+                        try:
+                            tab['jumped'], tab['status'] = navigate_to_page(tab['page'], book_id, i, nav_strategy)
+                            # Check if response indicates an error (4xx, 5xx)
+                            if tab['status'] and tab['status'] >= 400:
+                                console.log(f"[yellow]Page {i} returned status {tab['status']}[/yellow]")
+                        except PWTimeout:
+                            tab['trouble'] = True  # Page loaded but domcontentloaded timeout - usually fine
+                        except Exception as e:
+                            finish_page(i, None, e, "navigation")
+                            rate.observe(error=True)
+                            tab['next_nav_at'] = time.monotonic() + rate.delay_s
+                            continue
+                        timings[i]['nav_s'] = time.monotonic() - nav_start
+                    
+                    tab['index'] = i
+                    tab['shown'] = i
+                    tab['ready_at'] = time.monotonic() + (RENDER_SETTLE_S if ready_probe == 'fixed' else 0.0)
                 
-                # Skip existing
-                if filename.exists():
-                    skipped_count += 1
-                    progress.advance(task)
+                busy = [t for t in tabs if t['index'] is not None]
+                if not busy:
+                    work_at = now if pending else (retry_queue[0][0] if retry_queue else None)
+                    if work_at is None:
+                        # Only post-processing left; a failure there schedules a retry
+                        for done_index, result, error in reap_postprocess(in_flight, len(in_flight) - 1):
+                            finish_page(done_index, result, error, "post-processing")
+                        continue
+                    # Every tab is idle and waiting for its delay or a retry to come due
+                    time.sleep(max(0.0, max(work_at, min(t['next_nav_at'] for t in tabs)) - time.monotonic()))
                     continue
                 
-                # Navigate to page
-                if book_id and i > start_index:
-                    page_url = f"https://app.edubase.ch/#doc/{book_id}/{i}"
-                    try:
-                        response = page.goto(page_url, wait_until="domcontentloaded", timeout=15000)
-                        # Check if response indicates an error (4xx, 5xx)
-                        if response and response.status >= 400:
-                            console.log(f"[yellow]Page {i} returned status {response.status}[/yellow]")
-                        page.wait_for_load_state("networkidle", timeout=3000)
-                    except PWTimeout:
-                        pass  # Page loaded but networkidle timeout - usually fine
-                    except Exception as e:
-                        console.log(f"[red]Page {i} navigation failed: {e}[/red]")
-                        failed_pages.append(i)
-                        progress.advance(task)
-                        continue
+                # Screenshot the tab whose page has had the longest time to render
+                tab = min(busy, key=lambda t: t['ready_at'])
+                i = tab['index']
+                filename = page_path(out_dir, i, image_format)
+                tab['index'] = None
                 
                 # Wait for page to render - NO manipulation
-                page.wait_for_load_state("networkidle", timeout=3000)
-                time.sleep(1.5)  # Give Edubase time to render the PDF
+                render_start = time.monotonic()
+                try:
+                    ready = wait_for_page_ready(
+                        tab['page'], i, ready_probe, ready_timeout, ready_js,
+                        settle_until=tab['ready_at'],
+                    )
+                    if not ready and tab['jumped']:
+                        ready, tab['status'] = reload_after_jump(
+                            tab['page'], book_id, i, ready_probe, ready_timeout, ready_js,
+                        )
+                except Exception as e:
+                    tab['shown'] = None  # Unknown after e.g. a destroyed execution context; navigate again
+                    finish_page(i, None, e, "render")
+                    rate.observe(error=True)
+                    tab['next_nav_at'] = time.monotonic() + rate.delay_s
+                    continue
+                if not ready:
+                    console.log(f"[yellow]Page {i} not ready after {ready_timeout:.0f}s, capturing anyway[/yellow]")
+                    tab['trouble'] = True
+                timings[i]['render_s'] = time.monotonic() - render_start
                 
-                # Capture screenshot
+                blocked = blocker.take(tab['page'])
+                if blocked:
+                    frame_info.setdefault(i, {})['blocked'] = blocked
+                if target_dpi and clip:
+                    frame_info.setdefault(i, {})['dpi'] = target_dpi
+                
+                # Capture screenshot; crop/encode/write go to the pool if there is one
+                shot_start = time.monotonic()
                 try:
-                    page.screenshot(path=str(filename), full_page=True, type="png")
-                    
-                    # Optional crop
-                    if crop:
-                        with Image.open(filename) as im:
-                            if im.mode in ('RGBA', 'P'):
-                                im = im.convert('RGB')
-                            im = auto_crop_image(im, threshold=crop_threshold, margin_px=crop_margin)
-                            im.save(filename, format="PNG", optimize=True)
-                    
-                    captured_count += 1
-                    
+                    data, frame_hash, frame_fields = screenshot_page(
+                        tab['page'], i, clip, run, tab['last_hash'], stale_retries, stale_threshold,
+                        ready_probe, ready_timeout, ready_js,
+                    )
+                    if frame_hash is not None:
+                        tab['last_hash'] = frame_hash
+                        frame_info.setdefault(i, {}).update(frame_fields)
                 except Exception as e:
-                    console.log(f"[red]Page {i} screenshot failed: {e}[/red]")
-                    failed_pages.append(i)
+                    finish_page(i, None, e, "screenshot")
+                    rate.observe(error=True)
+                    tab['next_nav_at'] = time.monotonic() + rate.delay_s
+                    continue
+                timings[i]['shot_s'] = time.monotonic() - shot_start
+                
+                # Rate-limit this tab's next page
+                rate.observe(
+                    nav_s=timings[i]['nav_s'] or None,
+                    status=tab['status'],
+                    error=tab['trouble'],
+                )
+                tab['next_nav_at'] = time.monotonic() + rate.delay_s
                 
-                progress.advance(task)
+                if postprocess_pool:
+                    job = postprocess_pool.submit(
+                        store_screenshot, data, filename,
+                        crop, crop_threshold, crop_margin, image_format, compress_level,
+                    )
+                    in_flight[job] = i
+                else:
+                    try:
+                        finish_page(i, store_screenshot(
+                            data, filename, crop, crop_threshold, crop_margin, image_format, compress_level,
+                        ), None, "write")
+                    except Exception as e:
+                        finish_page(i, None, e, "write")
                 
-                if i < total_pages:
-                    time.sleep(per_page_delay_ms / 1000.0)
+                # Blocks while the post-processing queue is full
+                for done_index, result, error in reap_postprocess(in_flight, max_pending):
+                    finish_page(done_index, result, error, "post-processing")
+    finally:
+        # Also when the book is aborted: the batch goes on in this context
+        if postprocess_pool:
+            postprocess_pool.shutdown(cancel_futures=True)
+        for tab in tabs[1:]:
+            close_quietly(tab['page'])
+    
+    return run.result()
+
+
+# ---------- Batch Capture ----------
+
+def load_jobs(job_file: Path, out_root: Path) -> List[dict]:
+    """Read a capture job file: one "URL PAGES [OUT_DIR]" per line, # starts a comment line
+    
+    OUT_DIR defaults to out_root/book_<id>. Raises ValueError naming the bad line.
+    """
+    import re
+    jobs = []
+    for lineno, line in enumerate(job_file.read_text(encoding='utf-8').splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) not in (2, 3) or not fields[1].isdigit() or int(fields[1]) < 1:
+            raise ValueError(f"{job_file}:{lineno}: expected 'URL PAGES [OUT_DIR]', got {line!r}")
+        match = re.search(r'#doc/(\d+)', fields[0])
+        book_id = match.group(1) if match else None
+        if len(fields) == 3:
+            out_dir = Path(fields[2]).expanduser()
+        elif book_id:
+            out_dir = out_root / f"book_{book_id}"
+        else:
+            raise ValueError(f"{job_file}:{lineno}: no book ID in URL, OUT_DIR is required")
+        jobs.append({'url': fields[0], 'book_id': book_id, 'pages': int(fields[1]), 'out_dir': out_dir.resolve()})
+    
+    seen = set()
+    for job in jobs:
+        if job['out_dir'] in seen:
+            raise ValueError(f"{job_file}: output directory used twice: {job['out_dir']}")
+        seen.add(job['out_dir'])
+    return jobs
+
+
+def capture_batch(
+    jobs: List[dict],
+    per_page_delay_ms: int,
+    fullpage: bool,
+    crop: bool,
+    crop_threshold: int,
+    crop_margin: int,
+    workers: int = 1,
+    ready_probe: str = 'dom',
+    ready_timeout: float = 10.0,
+    ready_js: Optional[str] = None,
+    nav_strategy: str = 'hash',
+    image_format: str = 'png',
+    compress_level: Optional[int] = None,
+    postprocess_workers: Optional[int] = None,
+    retry_failed: bool = False,
+    stale_retries: int = 2,
+    stale_threshold: int = 2,
+    adaptive_delay: bool = False,
+    min_delay_ms: int = 0,
+    max_delay_ms: int = 15000,
+    max_attempts: int = 3,
+    retry_backoff_s: float = 2.0,
+    block_policy: str = 'trackers',
+    block_patterns: tuple = (),
+    target_dpi: Optional[int] = None,
+    page_size: str = 'a4',
+    viewer_selector: Optional[str] = None,
+    attach: bool = False,
+    headless: bool = False,
+    non_interactive: bool = False,
+    storage_state: Optional[Path] = None,
+    setup_js: Optional[str] = None,
+) -> List[dict]:
+    """Capture several books, one after another, in a single browser context
+    
+    Browser startup, profile load and login happen once for the batch; the
+    Enter prompt is only shown before the first book. Every book resumes
+    from its own capture manifest, and the delay controller and request
+    blocker carry over from book to book. A book that cannot be opened is
+    reported and the batch moves on; a logged-out session in
+    non_interactive mode stops the whole batch (see capture_pages).
+    
+    Returns one result dict per job.
+    """
+    endpoint = daemon_endpoint_or_exit() if attach else None
+    session_path = storage_state or SESSION_STATE_PATH
+    if non_interactive and not session_path.exists():
+        exit_session_invalid(f"No saved session at {session_path}")
+    console.print()
+    overview = Table(title="Capture queue", box=box.ROUNDED, border_style="cyan")
+    overview.add_column("#", justify="right")
+    overview.add_column("Book", style="yellow")
+    overview.add_column("Pages", justify="right", style="green")
+    overview.add_column("Output", style="blue")
+    for n, job in enumerate(jobs, 1):
+        overview.add_row(str(n), job['book_id'] or job['url'], str(job['pages']), str(job['out_dir']))
+    console.print(overview)
+    console.print()
+    
+    rate = AdaptiveDelay(per_page_delay_ms, adaptive=adaptive_delay, min_ms=min_delay_ms, max_ms=max_delay_ms)
+    blocker = RequestBlocker(block_policy, block_patterns)
+    geometry = capture_geometry(target_dpi, parse_page_size(page_size)) if target_dpi else None
+    results = []
+    prompt = not non_interactive
+    
+    with sync_playwright() as p:
+        context = launch_capture_context(
+            p, geometry, blocker, endpoint, headless=headless,
+            storage_state=session_path if (attach or non_interactive) else None,
+        )
         
-        context.close()
+        for n, job in enumerate(jobs, 1):
+            console.rule(f"[bold cyan]Book {n}/{len(jobs)}[/bold cyan] {job['book_id'] or job['url']}")
+            out_dir = job['out_dir']
+            ensure_dir(out_dir)
+            result = {'job': job, 'captured': 0, 'skipped': 0, 'failed': [], 'error': None}
+            results.append(result)
+            
+            manifest = load_manifest(out_dir)
+            adopt_existing_pages(out_dir, manifest)
+            failed_before = {i for i, entry in manifest.items() if entry['status'] == 'failed'}
+            if retry_failed and not failed_before:
+                result['skipped'] = job['pages']
+                console.print("[green]✓ No failed pages recorded, nothing to retry[/green]")
+                continue
+            
+            try:
+                result['captured'], result['skipped'], result['failed'] = capture_book(
+                    context,
+                    book_url=job['url'],
+                    book_id=job['book_id'],
+                    total_pages=job['pages'],
+                    out_dir=out_dir,
+                    start_index=1,
+                    manifest=manifest,
+                    retry_pages=failed_before if retry_failed else None,
+                    rate=rate,
+                    blocker=blocker,
+                    geometry=geometry,
+                    crop=crop,
+                    crop_threshold=crop_threshold,
+                    crop_margin=crop_margin,
+                    workers=workers if job['book_id'] else 1,
+                    ready_probe=ready_probe,
+                    ready_timeout=ready_timeout,
+                    ready_js=ready_js,
+                    nav_strategy=nav_strategy,
+                    image_format=image_format,
+                    compress_level=compress_level,
+                    postprocess_workers=postprocess_workers,
+                    stale_retries=stale_retries,
+                    stale_threshold=stale_threshold,
+                    max_attempts=max_attempts,
+                    retry_backoff_s=retry_backoff_s,
+                    target_dpi=target_dpi,
+                    viewer_selector=viewer_selector,
+                    fullpage=fullpage,
+                    prompt=prompt,
+                    check_session=non_interactive,
+                    setup_js=setup_js,
+                )
+                prompt = False
+            except SessionInvalid as e:
+                close_capture_context(context, session_path=None)
+                exit_session_invalid(str(e))
+            except Exception as e:
+                result['error'] = str(e)
+                console.print(f"[red]❌ Book {job['book_id'] or job['url']} aborted: {e}[/red]")
         
-        # Summary
+        close_capture_context(context, session_path)
+    
+    print_batch_summary(results, rate, blocker)
+    if non_interactive and any(result['failed'] or result['error'] for result in results):
+        sys.exit(1)
+    return results
+
+
+def print_batch_summary(results: List[dict], rate: AdaptiveDelay, blocker: RequestBlocker) -> None:
+    """Print one row per book and the next-step hints"""
+    console.print()
+    summary = Table(box=box.ROUNDED, border_style="green")
+    summary.add_column("Book", style="yellow")
+    summary.add_column("Captured", justify="right", style="green")
+    summary.add_column("Skipped", justify="right")
+    summary.add_column("Failed", justify="right", style="red")
+    summary.add_column("Output", style="blue")
+    for result in results:
+        job = result['job']
+        failed = result['error'] or (f"{len(result['failed'])}: {sorted(result['failed'])}" if result['failed'] else "0")
+        summary.add_row(job['book_id'] or job['url'], str(result['captured']), str(result['skipped']),
+                        failed, str(job['out_dir']))
+    console.print(Panel(summary, title="[bold green]✓ Batch Complete[/bold green]", border_style="green"))
+    console.print(f"⏱️  Delay: {rate.summary()}")
+    if blocker.enabled:
+        console.print(f"🚫 Blocked: {blocker.summary()}")
+    
+    if any(result['failed'] or result['error'] for result in results):
+        console.print("\n[yellow]💡 Tip: Run capture-batch again with --retry-failed to capture only the failed pages[/yellow]")
+    
+    console.print()
+    console.print("[bold cyan]➜ Next:[/bold cyan] Run [yellow]python edubase_cli.py build --input DIR[/yellow] for each book")
+    console.print()
+
+
+# ---------- Async Capture Engine ----------
+
+async def wait_for_page_ready_async(
+    page,
+    index: int,
+    probe: str,
+    timeout_s: float,
+    js_predicate: Optional[str] = None,
+    settle_until: Optional[float] = None,
+) -> bool:
+    """Async counterpart of wait_for_page_ready()"""
+    import asyncio
+    
+    if probe == 'fixed':
+        try:
+            await page.wait_for_load_state("networkidle", timeout=3000)
+        except PWTimeout:
+            pass
+        if settle_until is None:
+            settle_until = time.monotonic() + RENDER_SETTLE_S
+        await asyncio.sleep(max(0.0, settle_until - time.monotonic()))
+        return True
+    
+    if probe in ('dom', 'js'):
+        expression = js_predicate if probe == 'js' else DOM_READY_JS
+        try:
+            await page.wait_for_function(expression, arg=index, timeout=timeout_s * 1000, polling=100)
+            return True
+        except PWTimeout:
+            return False
+    
+    if probe == 'frames':
+        deadline = time.monotonic() + timeout_s
+        previous = await page.screenshot(type="png")
+        while time.monotonic() < deadline:
+            await asyncio.sleep(FRAME_POLL_S)
+            current = await page.screenshot(type="png")
+            if current == previous:
+                return True
+            previous = current
+        return False
+    
+    raise ValueError(f"Unknown readiness probe: {probe}")
+
+
+async def goto_page_async(page, book_id: str, index: int) -> Optional[int]:
+    """Async counterpart of goto_page()"""
+    response = await page.goto(
+        EDUBASE_DOC_URL.format(book_id=book_id, index=index),
+        wait_until="domcontentloaded",
+        timeout=15000,
+    )
+    return response.status if response else None
+
+
+async def navigate_to_page_async(page, book_id: str, index: int, strategy: str) -> Tuple[bool, Optional[int]]:
+    """Async counterpart of navigate_to_page()"""
+    if strategy == 'hash':
+        try:
+            return await page.evaluate(HASH_NAV_JS, EDUBASE_DOC_HASH.format(book_id=book_id, index=index)), None
+        except Exception:
+            pass  # Fall back to a full navigation
+    return False, await goto_page_async(page, book_id, index)
+
+
+async def reload_after_jump_async(page, book_id: str, index: int, probe: str, timeout_s: float,
+                                  js_predicate: Optional[str] = None) -> Tuple[bool, Optional[int]]:
+    """Async counterpart of reload_after_jump()"""
+    console.log(f"[yellow]Page {index} did not repaint after the in-app jump, reloading[/yellow]")
+    status = await goto_page_async(page, book_id, index)
+    return await wait_for_page_ready_async(page, index, probe, timeout_s, js_predicate), status
+
+
+async def detect_viewer_box_async(page, selector: Optional[str] = None) -> Optional[dict]:
+    """Box of the page element in CSS pixels: the selector's element, else the largest canvas/img"""
+    try:
+        if selector:
+            return await page.locator(selector).first.bounding_box(timeout=5000)
+        return await page.evaluate(DETECT_VIEWER_JS, MIN_VIEWER_CSS)
+    except Exception:
+        return None
+
+
+async def launch_capture_context_async(
+    p,
+    geometry: Optional[dict],
+    blocker: RequestBlocker,
+    endpoint: Optional[str] = None,
+    headless: bool = False,
+    storage_state: Optional[Path] = None,
+):
+    """Async counterpart of launch_capture_context()"""
+    if endpoint or storage_state:
+        if endpoint:
+            browser = await p.firefox.connect(endpoint, timeout=10000)
+            console.print("[green]✓[/green] Attached to browser daemon [dim](async engine)[/dim]")
+        else:
+            browser = await p.firefox.launch(headless=headless)
+            console.print("[green]✓[/green] Browser started [dim](async engine)[/dim]")
+        context = await browser.new_context(**context_options(geometry, storage_state))
+    else:
+        context = await p.firefox.launch_persistent_context(
+            user_data_dir=str(FIREFOX_PROFILE_DIR),
+            headless=headless,
+            **context_options(geometry),
+        )
+        console.print("[green]✓[/green] Browser started [dim](async engine)[/dim]")
+    
+    context.set_default_timeout(30000)
+    context.set_default_navigation_timeout(30000)
+    if blocker.enabled:
+        await context.route(blocker.route_pattern(), blocker.handle_async)
+    
+    page = context.pages[0] if context.pages else await context.new_page()
+    try:
+        await page.evaluate(MAXIMIZE_WINDOW_JS)
+    except Exception:
+        try:
+            await context.add_init_script(f"({MAXIMIZE_WINDOW_JS})()")
+        except Exception:
+            pass  # Window maximization is non-critical
+    
+    return context
+
+
+async def close_capture_context_async(context, session_path: Optional[Path]) -> None:
+    """Async counterpart of close_capture_context()"""
+    if session_path is not None:
+        try:
+            await context.storage_state(path=str(session_path))
+            session_path.chmod(0o600)
+        except Exception as e:
+            console.print(f"[yellow]⚠️  Could not save session: {e}[/yellow]")
+    browser = context.browser  # None for the persistent profile
+    await context.close()
+    if browser is not None:
+        await browser.close()  # On the daemon this only disconnects
+
+
+async def open_book_async(page, book_url: str, book_id: Optional[str], start_index: int, ready_probe: str,
+                          ready_timeout: float, ready_js: Optional[str], check_session: bool, prompt: bool) -> None:
+    """Async counterpart of open_book()"""
+    import asyncio
+    
+    console.print(f"[blue]🔗[/blue] Opening: [cyan]{book_url}[/cyan]")
+    try:
+        await page.goto(book_url, wait_until="domcontentloaded", timeout=30000)
+        await page.wait_for_load_state("networkidle", timeout=10000)
+    except PWTimeout:
+        console.print("[yellow]⚠️  Page loading slowly, continuing anyway...[/yellow]")
+    
+    try:
+        ready = await wait_for_page_ready_async(
+            page, start_index, ready_probe, ready_timeout, ready_js,
+            settle_until=time.monotonic() + INITIAL_SETTLE_S,
+        )
+    except Exception:
+        ready = False
+    if not ready:
+        console.print("[yellow]⚠️  Viewer not ready yet, continuing anyway...[/yellow]")
+    
+    if check_session:
+        try:
+            logged_in = bool(await page.evaluate(SESSION_CHECK_JS, book_id))
+        except Exception:
+            logged_in = False
+        if not logged_in:
+            raise SessionInvalid(f"Saved session is not logged in ({page.url})")
+    
+    if prompt:
+        print_start_prompt()
+        await asyncio.to_thread(console.input, START_PROMPT)
+        console.print()
+
+
+async def open_worker_tabs_async(context, first_page, book_url: str, workers: int) -> list:
+    """Async counterpart of open_worker_tabs()"""
+    tabs = [first_page]
+    for _ in range(workers - 1):
+        tab = await context.new_page()
+        try:
+            await tab.goto(book_url, wait_until="domcontentloaded", timeout=30000)
+        except PWTimeout:
+            pass  # The page is navigated again before its first screenshot
+        tabs.append(tab)
+    if len(tabs) > 1:
+        console.print(f"[green]✓[/green] Opened [cyan]{len(tabs)}[/cyan] capture tabs")
+    return tabs
+
+
+async def close_quietly_async(page) -> None:
+    """Async counterpart of close_quietly()"""
+    try:
+        await page.close()
+    except Exception:
+        pass
+
+
+async def setup_tabs_async(tabs: list, setup_js: str) -> None:
+    """Async counterpart of setup_tabs()"""
+    import asyncio
+    for tab in tabs:
+        try:
+            await tab.evaluate(setup_js)
+        except Exception as e:
+            console.print(f"[yellow]⚠️  Viewer setup script failed: {e}[/yellow]")
+    await asyncio.sleep(RENDER_SETTLE_S)
+
+
+async def fit_viewer_async(page, tabs: list, geometry: Optional[dict], viewer_selector: Optional[str]) -> Optional[dict]:
+    """Async counterpart of fit_viewer()"""
+    import asyncio
+    clip = await detect_viewer_box_async(page, viewer_selector)
+    if clip and geometry:
+        viewport_config = fitted_viewport(page.viewport_size, clip, geometry['page_css'])
+        for tab in tabs:
+            await tab.set_viewport_size(viewport_config)
+        await asyncio.sleep(RENDER_SETTLE_S)
+        clip = await detect_viewer_box_async(page, viewer_selector)
+    report_viewer_clip(clip)
+    return clip
+
+
+async def screenshot_page_async(page, i: int, clip: Optional[dict], run: CaptureRun, last_hash: Optional[int],
+                                stale_retries: int, stale_threshold: int, ready_probe: str, ready_timeout: float,
+                                ready_js: Optional[str]) -> Tuple[bytes, Optional[int], dict]:
+    """Async counterpart of screenshot_page()"""
+    import asyncio
+    if not stale_retries:
+        return await page.screenshot(**screenshot_options(clip)), None, {}
+    frame_hash = await asyncio.to_thread(frame_dhash, await page.screenshot(**thumbnail_options(clip)))
+    retries = 0
+    while retries < stale_retries and run.is_stale(i, frame_hash, last_hash, stale_threshold):
+        retries += 1
+        await asyncio.sleep(STALE_REWAIT_S)
+        await wait_for_page_ready_async(page, i, ready_probe, ready_timeout, ready_js)
+        frame_hash = await asyncio.to_thread(frame_dhash, await page.screenshot(**thumbnail_options(clip)))
+    data = await page.screenshot(**screenshot_options(clip))
+    return data, frame_hash, run.record_frame(i, frame_hash, last_hash, retries, stale_threshold)
+
+
+async def capture_book_async(
+    context,
+    book_url: str,
+    book_id: Optional[str],
+    total_pages: int,
+    out_dir: Path,
+    start_index: int,
+    manifest: dict,
+    retry_pages: Optional[set],
+    rate: AdaptiveDelay,
+    blocker: RequestBlocker,
+    geometry: Optional[dict],
+    crop: bool,
+    crop_threshold: int,
+    crop_margin: int,
+    workers: int,
+    ready_probe: str,
+    ready_timeout: float,
+    ready_js: Optional[str],
+    nav_strategy: str,
+    image_format: str,
+    compress_level: Optional[int],
+    postprocess_workers: Optional[int],
+    stale_retries: int,
+    stale_threshold: int,
+    max_attempts: int,
+    retry_backoff_s: float,
+    target_dpi: Optional[int],
+    viewer_selector: Optional[str],
+    fullpage: bool,
+    prompt: bool = True,
+    check_session: bool = False,
+    setup_js: Optional[str] = None,
+):
+    """Async counterpart of capture_book()
+    
+    One coroutine per tab navigates, waits and screenshots; crop and disk
+    writes run in the post-processing pool (or threads without one) so the
+    next navigation starts right away. Pending writes are bounded.
+    
+    Returns (captured_count, skipped_count, failed_pages).
+    """
+    import asyncio
+    
+    page = context.pages[0] if context.pages else await context.new_page()
+    await open_book_async(page, book_url, book_id, start_index, ready_probe, ready_timeout, ready_js,
+                          check_session, prompt)
+    
+    tabs = await open_worker_tabs_async(context, page, book_url, workers)
+    postprocess_pool = None
+    try:
+        if setup_js:
+            await setup_tabs_async(tabs, setup_js)
+        
+        clip = None if fullpage else await fit_viewer_async(page, tabs, geometry, viewer_selector)
+        if clip:
+            crop = False  # The clip already is the page
+        
+        console.print("[bold blue]📸 Starting capture...[/bold blue]")
         console.print()
-        summary = Table(show_header=False, box=box.ROUNDED, border_style="green")
-        summary.add_column("Metric", style="cyan")
-        summary.add_column("Value", style="green")
-        summary.add_row("✓ Captured", str(captured_count))
-        if skipped_count > 0:
-            summary.add_row("⏭️  Skipped", f"{skipped_count} (already existed)")
-        if failed_pages:
-            summary.add_row("❌ Failed", f"{len(failed_pages)}: {failed_pages}")
         
-        total_files = len(list(out_dir.glob("page_*.png")))
-        summary.add_row("📁 Total Files", str(total_files))
+        if postprocess_workers is None:
+            postprocess_workers = default_postprocess_workers(crop, image_format, compress_level)
+        postprocess_pool = ProcessPoolExecutor(postprocess_workers) if postprocess_workers else None
+        write_slots = asyncio.Semaphore(2 * max(workers, postprocess_workers))
+        writes = []
+        
+        with capture_progress() as progress:
+            loop = asyncio.get_running_loop()
+            run = CaptureRun(
+                out_dir, manifest, start_index, total_pages, retry_pages, max_attempts, retry_backoff_s, progress,
+                schedule_retry=lambda delay_s, i: loop.call_later(delay_s, run.pending.append, i),
+            )
+            pending = run.pending
+            
+            async def write(i: int, data: bytes, timings: dict, extra: Optional[dict]):
+                try:
+                    result = await loop.run_in_executor(
+                        postprocess_pool, store_screenshot, data, page_path(out_dir, i, image_format),
+                        crop, crop_threshold, crop_margin, image_format, compress_level,
+                    )
+                    run.finish_page(i, result, None, "write", timings, extra)
+                except Exception as e:
+                    run.finish_page(i, None, e, "write", timings, extra)
+                finally:
+                    write_slots.release()
+            
+            async def run_tab(tab, shown: Optional[int]):
+                last_hash = None
+                while run.unfinished:
+                    if not pending:
+                        # Wait for a scheduled retry or a write that may still fail
+                        await asyncio.sleep(0.05)
+                        continue
+                    i = pending.popleft()
+                    timings = {'nav_s': 0.0}
+                    status = None
+                    jumped = False
+                    trouble = False
+                    
+                    if book_id and shown != i:
+                        nav_start = time.monotonic()
+                        try:
+                            jumped, status = await navigate_to_page_async(tab, book_id, i, nav_strategy)
+                            if status and status >= 400:
+                                console.log(f"[yellow]Page {i} returned status {status}[/yellow]")
+                        except PWTimeout:
+                            trouble = True
+                        except Exception as e:
+                            run.finish_page(i, None, e, "navigation", timings)
+                            rate.observe(error=True)
+                            await asyncio.sleep(rate.delay_s)
+                            continue
+                        timings['nav_s'] = time.monotonic() - nav_start
+                    shown = i
+                    
+                    render_start = time.monotonic()
+                    try:
+                        ready = await wait_for_page_ready_async(
+                            tab, i, ready_probe, ready_timeout, ready_js,
+                            settle_until=time.monotonic() + RENDER_SETTLE_S,
+                        )
+                        if not ready and jumped:
+                            ready, status = await reload_after_jump_async(
+                                tab, book_id, i, ready_probe, ready_timeout, ready_js,
+                            )
+                    except Exception as e:
+                        shown = None  # Unknown after e.g. a destroyed execution context; navigate again
+                        run.finish_page(i, None, e, "render", timings)
+                        rate.observe(error=True)
+                        await asyncio.sleep(rate.delay_s)
+                        continue
+                    if not ready:
+                        console.log(f"[yellow]Page {i} not ready after {ready_timeout:.0f}s, capturing anyway[/yellow]")
+                        trouble = True
+                    timings['render_s'] = time.monotonic() - render_start
+                    
+                    shot_start = time.monotonic()
+                    blocked = blocker.take(tab)
+                    extra = {'blocked': blocked} if blocked else {}
+                    if target_dpi and clip:
+                        extra['dpi'] = target_dpi
+                    try:
+                        data, frame_hash, frame_fields = await screenshot_page_async(
+                            tab, i, clip, run, last_hash, stale_retries, stale_threshold,
+                            ready_probe, ready_timeout, ready_js,
+                        )
+                        if frame_hash is not None:
+                            last_hash = frame_hash
+                            extra.update(frame_fields)
+                    except Exception as e:
+                        run.finish_page(i, None, e, "screenshot", timings, extra or None)
+                        rate.observe(error=True)
+                        await asyncio.sleep(rate.delay_s)
+                        continue
+                    timings['shot_s'] = time.monotonic() - shot_start
+                    
+                    await write_slots.acquire()
+                    writes.append(asyncio.create_task(write(i, data, timings, extra or None)))
+                    
+                    rate.observe(nav_s=timings['nav_s'] or None, status=status, error=trouble)
+                    if pending:
+                        await asyncio.sleep(rate.delay_s)
+            
+            await asyncio.gather(*(
+                run_tab(tab, start_index if n == 0 else None) for n, tab in enumerate(tabs)
+            ))
+            await asyncio.gather(*writes)  # Already settled, run_tab waits for every page
+    finally:
+        if postprocess_pool:
+            postprocess_pool.shutdown(cancel_futures=True)
+        for tab in tabs[1:]:
+            await close_quietly_async(tab)
+    
+    return run.result()
+
+
+async def capture_pages_async(
+    book_url: str,
+    book_id: Optional[str],
+    total_pages: int,
+    out_dir: Path,
+    start_index: int,
+    rate: AdaptiveDelay,
+    crop: bool,
+    crop_threshold: int,
+    crop_margin: int,
+    workers: int,
+    ready_probe: str,
+    ready_timeout: float,
+    ready_js: Optional[str],
+    nav_strategy: str,
+    image_format: str,
+    compress_level: Optional[int],
+    postprocess_workers: Optional[int],
+    manifest: dict,
+    retry_pages: Optional[set] = None,
+    stale_retries: int = 2,
+    stale_threshold: int = 2,
+    max_attempts: int = 3,
+    retry_backoff_s: float = 2.0,
+    blocker: Optional[RequestBlocker] = None,
+    geometry: Optional[dict] = None,
+    target_dpi: Optional[int] = None,
+    viewer_selector: Optional[str] = None,
+    fullpage: bool = False,
+    prompt: bool = True,
+    endpoint: Optional[str] = None,
+    headless: bool = False,
+    storage_state: Optional[Path] = None,
+    session_path: Optional[Path] = SESSION_STATE_PATH,
+    check_session: bool = False,
+    setup_js: Optional[str] = None,
+):
+    """Capture pages with playwright.async_api: launch, capture_book_async, close
+    
+    Returns (captured_count, skipped_count, failed_pages).
+    """
+    from playwright.async_api import async_playwright
+    
+    if blocker is None:
+        blocker = RequestBlocker('off')
+    async with async_playwright() as p:
+        context = await launch_capture_context_async(p, geometry, blocker, endpoint, headless, storage_state)
+        try:
+            result = await capture_book_async(
+                context,
+                book_url=book_url,
+                book_id=book_id,
+                total_pages=total_pages,
+                out_dir=out_dir,
+                start_index=start_index,
+                manifest=manifest,
+                retry_pages=retry_pages,
+                rate=rate,
+                blocker=blocker,
+                geometry=geometry,
+                crop=crop,
+                crop_threshold=crop_threshold,
+                crop_margin=crop_margin,
+                workers=workers,
+                ready_probe=ready_probe,
+                ready_timeout=ready_timeout,
+                ready_js=ready_js,
+                nav_strategy=nav_strategy,
+                image_format=image_format,
+                compress_level=compress_level,
+                postprocess_workers=postprocess_workers,
+                stale_retries=stale_retries,
+                stale_threshold=stale_threshold,
+                max_attempts=max_attempts,
+                retry_backoff_s=retry_backoff_s,
+                target_dpi=target_dpi,
+                viewer_selector=viewer_selector,
+                fullpage=fullpage,
+                prompt=prompt,
+                check_session=check_session,
+                setup_js=setup_js,
+            )
+        except SessionInvalid:
+            await close_capture_context_async(context, session_path=None)
+            raise
+        await close_capture_context_async(context, session_path)
+    
+    return result
+
+
+# ---------- Build Phase ----------
+
+def version_key(version: str) -> Tuple[int, ...]:
+    """Comparable form of a PDF version, e.g. (1, 7) for 1.7"""
+    return tuple(int(part) for part in version.split('.'))
+
+
+class PdfPageWriter:
+    """Write a PDF page by page to an open binary file
+    
+    Each added page (with its images and content streams) goes to disk
+    immediately; only object offsets and page numbers stay in memory, so
+    memory use does not grow with the page count.
+    """
+    
+    CATALOG, PAGES = 1, 2  # Reserved object numbers, written by close()
+    HEADER_VERSION = "1.4"
+    
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+        self.next_num = 3
+        self.kids = []
+        self.version = self.HEADER_VERSION
+        f.write(b"%%PDF-%s\n%%\xe2\xe3\xcf\xd3\n" % self.HEADER_VERSION.encode())
+    
+    def _reserve(self) -> int:
+        self.next_num += 1
+        return self.next_num - 1
+    
+    def _write(self, num: int, body: bytes, stream: Optional[bytes] = None) -> None:
+        self.offsets[num] = self.f.tell()
+        self.f.write(b"%d 0 obj\n" % num + body)
+        if stream is not None:
+            self.f.write(b"\nstream\n" + stream + b"\nendstream")
+        self.f.write(b"\nendobj\n")
+    
+    def add_page(self, page: pikepdf.Page, pdf_version: str = HEADER_VERSION) -> None:
+        """Copy a page and everything it references from another (open) PDF
         
-        console.print(Panel(summary, title="[bold green]✓ Capture Complete[/bold green]", border_style="green"))
+        pdf_version is the source's version; close() declares the highest one seen.
+        """
+        if version_key(pdf_version) > version_key(self.version):
+            self.version = pdf_version
+        numbers = {}
+        pending = []
         
-        if failed_pages:
-            console.print(f"\n[yellow]💡 Tip: Restart with --start-index {failed_pages[0]} to retry failed pages[/yellow]")
+        def dump(obj, top=False, skip=()) -> bytes:
+            # pikepdf hands out null, booleans and numbers as Python values
+            if obj is None:
+                return b"null"
+            if isinstance(obj, bool):
+                return b"true" if obj else b"false"
+            if isinstance(obj, int):
+                return b"%d" % obj
+            if isinstance(obj, (float, Decimal)):
+                return format(obj, 'f').encode()  # Never in exponent notation
+            if not isinstance(obj, pikepdf.Object):
+                raise TypeError(f"Cannot write {type(obj).__name__} into the PDF")
+            if not top and obj.is_indirect:
+                if obj.objgen not in numbers:
+                    numbers[obj.objgen] = self._reserve()
+                    pending.append(obj)
+                return b"%d 0 R" % numbers[obj.objgen]
+            if isinstance(obj, pikepdf.Array):
+                return b"[" + b" ".join(dump(item) for item in obj) + b"]"
+            if isinstance(obj, pikepdf.Dictionary):
+                items = [pikepdf.Name(key).unparse() + b" " + dump(obj[key]) for key in obj.keys() if key not in skip]
+                return b"<<" + b" ".join(items) + b">>"
+            return obj.unparse()
         
-        console.print()
-        console.print("[bold cyan]➜ Next:[/bold cyan] Run [yellow]python edubase_cli.py build[/yellow] to create PDF")
-        console.print()
-
+        num = self._reserve()
+        body = dump(page.obj, top=True, skip=('/Parent',))
+        self._write(num, body[:-2] + b" /Parent %d 0 R>>" % self.PAGES)
+        self.kids.append(num)
+        while pending:
+            obj = pending.pop()
+            if isinstance(obj, pikepdf.Stream):
+                data = obj.read_raw_bytes()
+                body = dump(obj.stream_dict, top=True, skip=('/Length',))
+                self._write(numbers[obj.objgen], body[:-2] + b" /Length %d>>" % len(data), data)
+            else:
+                self._write(numbers[obj.objgen], dump(obj, top=True))
+    
+    def close(self) -> None:
+        """Write the page tree, catalog, cross-reference table and trailer"""
+        kids = b" ".join(b"%d 0 R" % num for num in self.kids)
+        self._write(self.PAGES, b"<</Type /Pages /Kids [%s] /Count %d>>" % (kids, len(self.kids)))
+        version = b"" if self.version == self.HEADER_VERSION else b" /Version /%s" % self.version.encode()
+        self._write(self.CATALOG, b"<</Type /Catalog /Pages %d 0 R%s>>" % (self.PAGES, version))
+        xref = self.f.tell()
+        self.f.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_num)
+        for num in range(1, self.next_num):
+            self.f.write(b"%010d 00000 n \n" % self.offsets[num])
+        self.f.write(b"trailer\n<</Size %d /Root %d 0 R>>\nstartxref\n%d\n%%%%EOF\n"
+                     % (self.next_num, self.CATALOG, xref))
 
-# ---------- Build Phase ----------
 
 def build_pdf_from_images(images: List[Path], out_pdf: Path, dpi: Optional[int]) -> None:
-    layout = None
-    if dpi:
-        layout = (dpi, dpi)
+    """Assemble the raw PDF one page at a time
+    
+    img2pdf converts each image into a single-page PDF in memory, whose
+    objects PdfPageWriter streams to out_pdf, so peak memory is about one
+    page regardless of the book length. .pdf pages (MRC) are copied as-is.
+    """
+    layout_fun = img2pdf.get_fixed_dpi_layout_fun((dpi, dpi)) if dpi else img2pdf.default_layout_fun
     with open(out_pdf, "wb") as f:
-        f.write(img2pdf.convert([str(p) for p in images], dpi=layout))
+        writer = PdfPageWriter(f)
+        for path in images:
+            if path.suffix == '.pdf':  # Page already laid out (MRC)
+                page_pdf = pikepdf.open(path)
+            else:
+                page_pdf = pikepdf.open(BytesIO(img2pdf.convert(str(path), layout_fun=layout_fun,
+                                                                engine=img2pdf.Engine.internal)))
+            with page_pdf:
+                writer.add_page(page_pdf.pages[0], page_pdf.pdf_version)
+        writer.close()
 
 
-def run_ocr(input_pdf: Path, output_pdf: Path, lang: str, jobs: int, optimize: int) -> None:
-    """Run OCR on Ubuntu with ocrmypdf"""
+def run_ocr(input_pdf: Path, output_pdf: Path, lang: str, jobs: int, optimize: int, deskew: bool = True,
+            tmpdir: Optional[Path] = None) -> None:
+    """Run OCR on Ubuntu with ocrmypdf
+    
+    Deskewing rasterizes every page into one image, so it is skipped for
+    layered (MRC) pages. tmpdir receives ocrmypdf's per-page intermediate
+    files (default: the system temp directory).
+    """
     cmd = [
         "ocrmypdf",
         "--language", lang,
         "--jobs", str(jobs),
         f"--optimize={optimize}",
         "--skip-text",
-        "--deskew",
+        *(["--deskew"] if deskew else []),
         str(input_pdf),
         str(output_pdf)
     ]
     
-    subprocess.run(cmd, check=True)
+    env = {**os.environ, 'TMPDIR': str(tmpdir)} if tmpdir else None
+    subprocess.run(cmd, check=True, env=env)
 
 
 def set_metadata(pdf_path: Path, title: Optional[str], author: Optional[str],
@@ -368,6 +2771,467 @@ def set_metadata(pdf_path: Path, title: Optional[str], author: Optional[str],
         pdf.save(pdf_path)
 
 
+# ---------- Build Workspace ----------
+
+WORKSPACE_PREFIX = "edubase-build-"
+RAM_WORKDIR = Path("/dev/shm")
+OCR_TEMP_BYTES_PER_PAGE = 8 * 1024 * 1024  # ocrmypdf's rasterized page and OCR layers, generously
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, owned by another user
+    return True
+
+
+def reap_stale_workspaces(root: Path) -> int:
+    """Remove workspaces of builds that died without cleaning up (SIGKILL, power loss)"""
+    removed = 0
+    for path in root.glob(f"{WORKSPACE_PREFIX}*"):
+        pid = path.name[len(WORKSPACE_PREFIX):].split("-", 1)[0]
+        if pid.isdigit() and int(pid) != os.getpid() and not pid_alive(int(pid)):
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def default_workdir() -> Path:
+    """RAM-backed /dev/shm where available, the system temp directory otherwise"""
+    if RAM_WORKDIR.is_dir() and os.access(RAM_WORKDIR, os.W_OK | os.X_OK):
+        return RAM_WORKDIR
+    return Path(tempfile.gettempdir())
+
+
+class BuildWorkspace:
+    """Scratch directories of one build
+    
+    Files go to the work directory while it stays within budget_bytes and has
+    free space, otherwise they spill to a directory under spill_root. Both are
+    removed on exit: after success, failure and Ctrl-C alike.
+    """
+    
+    def __init__(self, root: Optional[Path] = None, budget_bytes: Optional[int] = None,
+                 spill_root: Optional[Path] = None):
+        self.root = Path(root) if root else default_workdir()
+        self.spill_root = Path(spill_root) if spill_root else Path(tempfile.gettempdir())
+        self.budget_bytes = budget_bytes
+        self.primary: Optional[Path] = None
+        self.spill: Optional[Path] = None
+        self.spilled: List[str] = []
+    
+    def __enter__(self) -> "BuildWorkspace":
+        for root in {self.root, self.spill_root}:
+            if root.is_dir():
+                reap_stale_workspaces(root)
+        self.primary = self._mkdtemp(self.root)
+        if self.budget_bytes is None:
+            self.budget_bytes = shutil.disk_usage(self.primary).free // 2
+        return self
+    
+    def __exit__(self, *exc) -> bool:
+        for path in (self.primary, self.spill):
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+        self.primary = self.spill = None
+        return False
+    
+    def _mkdtemp(self, root: Path) -> Path:
+        ensure_dir(root)
+        return Path(tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}-", dir=root))
+    
+    def usage(self) -> int:
+        """Bytes currently held in the work directory"""
+        return sum(p.stat().st_size for p in self.primary.rglob("*") if p.is_file())
+    
+    def fits(self, size_hint: int) -> bool:
+        return (self.usage() + size_hint <= self.budget_bytes
+                and size_hint < shutil.disk_usage(self.primary).free)
+    
+    def path(self, name: str, size_hint: int = 0) -> Path:
+        """Location for a scratch file of about size_hint bytes"""
+        if self.fits(size_hint):
+            return self.primary / name
+        if self.spill is None:
+            self.spill = self._mkdtemp(self.spill_root)
+        self.spilled.append(name)
+        return self.spill / name
+    
+    def dir(self, name: str, size_hint: int = 0) -> Path:
+        path = self.path(name, size_hint)
+        ensure_dir(path)
+        return path
+
+
+# ---------- Page Codecs ----------
+
+# Output file suffix per page codec; img2pdf embeds all of them without re-encoding
+PAGE_CODECS = {
+    'bilevel': '.tif',   # 1-bit CCITT G4: black text on white
+    'gray': '.jpg',      # Grayscale JPEG: shading, grayscale figures
+    'palette': '.png',   # Few flat colours: diagrams, coloured headings
+    'color': '.jpg',     # Full-colour JPEG: photos
+    'mrc': '.pdf',       # Layered single-page PDF: text mask over low-resolution colour (--codec mrc)
+}
+CODEC_MODES = ('auto', 'jpeg', 'mrc')
+CLASSIFY_REDUCE = 4          # Colour analysis runs on a 1/4 x 1/4 copy
+COLOR_CHROMA = 32            # max(R,G,B) - min(R,G,B) above which a pixel counts as coloured
+COLOR_FRACTION = 0.002       # Share of coloured pixels that makes a page non-gray
+PALETTE_COLORS = 32
+PALETTE_COVERAGE = 0.95      # Share of pixels the PALETTE_COLORS most common colours must cover
+BILEVEL_DARK, BILEVEL_LIGHT = 48, 232
+BILEVEL_MIDTONES = 0.05      # Share of pixels between dark and light allowed for bilevel (anti-aliasing)
+BILEVEL_THRESHOLD = 128
+MRC_TEXT_THRESHOLD = 140     # Grayscale level at or below which a pixel belongs to the text mask
+MRC_BG_SCALE = 3             # Background layer at 1/3 resolution (100 dpi for 300 dpi pages)
+MRC_FG_SCALE = 6             # Text colour layer at 1/6 resolution
+MRC_BG_QUALITY = 40
+MRC_FG_QUALITY = 50
+
+
+def classify_page(im: Image.Image) -> str:
+    """Cheapest faithful codec for a page: bilevel, gray, palette or color
+    
+    Pages with coloured pixels are palette if a few colours cover nearly all
+    of them, else color. Gray pages are bilevel if almost every pixel is
+    near black or white (only anti-aliased edges in between), else gray.
+    """
+    if im.mode not in ('1', 'L'):
+        rgb = im.convert('RGB')
+        if min(rgb.size) >= CLASSIFY_REDUCE * 16:
+            rgb = rgb.reduce(CLASSIFY_REDUCE)
+        pixels = np.asarray(rgb, dtype=np.int16)
+        chroma = pixels.max(axis=2) - pixels.min(axis=2)
+        if (chroma > COLOR_CHROMA).mean() > COLOR_FRACTION:
+            # Count colours at 5 bits per channel so JPEG/scaling noise does not split them
+            q = pixels >> 3
+            _, counts = np.unique((q[..., 0] << 10) | (q[..., 1] << 5) | q[..., 2], return_counts=True)
+            top = np.sort(counts)[::-1][:PALETTE_COLORS].sum()
+            return 'palette' if top >= PALETTE_COVERAGE * chroma.size else 'color'
+    
+    hist = np.array(im.convert('L').histogram())
+    midtones = hist[BILEVEL_DARK + 1:BILEVEL_LIGHT].sum() / hist.sum()
+    return 'bilevel' if midtones <= BILEVEL_MIDTONES else 'gray'
+
+
+def save_page(im: Image.Image, out_file: Path, codec: str, jpeg_quality: int) -> None:
+    """Encode a preprocessed page with its codec (see PAGE_CODECS)"""
+    if codec == 'bilevel':
+        im = im.convert('L').point(lambda x: 255 if x > BILEVEL_THRESHOLD else 0, mode='1')
+        im.save(out_file, format="TIFF", compression="group4")
+    elif codec == 'gray':
+        im.convert('L').save(out_file, format="JPEG", quality=jpeg_quality, optimize=True)
+    elif codec == 'palette':
+        im = im.convert('RGB').quantize(PALETTE_COLORS, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+        im.save(out_file, format="PNG", optimize=True)
+    elif codec == 'color':
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        im.save(out_file, format="JPEG", quality=jpeg_quality, optimize=True)
+    else:
+        raise ValueError(f"Unknown page codec: {codec}")
+
+
+def masked_block_mean(pixels: np.ndarray, weights: np.ndarray, scale: int) -> np.ndarray:
+    """Downscale pixels (H x W x C) by scale, averaging only pixels where weights is True
+    
+    Blocks without any such pixel get the overall mean of the weighted
+    pixels, which keeps the layer smooth for JPEG.
+    """
+    height, width = weights.shape
+    pad = ((0, -height % scale), (0, -width % scale))
+    weights = np.pad(weights, pad).astype(np.float32)
+    pixels = np.pad(pixels, pad + ((0, 0),)).astype(np.float32) * weights[..., None]
+    rows, cols = weights.shape[0] // scale, weights.shape[1] // scale
+    sums = pixels.reshape(rows, scale, cols, scale, -1).sum(axis=(1, 3))
+    counts = weights.reshape(rows, scale, cols, scale).sum(axis=(1, 3))[..., None]
+    fill = sums.sum(axis=(0, 1)) / max(counts.sum(), 1)
+    mean = np.where(counts > 0, sums / np.maximum(counts, 1), fill)
+    return np.clip(mean.round(), 0, 255).astype(np.uint8)
+
+
+def mrc_layers(im: Image.Image, color: bool) -> Tuple[Image.Image, Image.Image, Image.Image]:
+    """Split a page into (mask, background, foreground) for mixed raster content
+    
+    The full-resolution 1-bit mask is black where the page is text or line
+    art. The background is the page with the text averaged away at
+    1/MRC_BG_SCALE resolution; the foreground carries the text colour at
+    1/MRC_FG_SCALE. Layers are RGB if color, else grayscale.
+    """
+    mode = 'RGB' if color else 'L'
+    pixels = np.asarray(im.convert(mode))
+    if not color:
+        pixels = pixels[..., None]
+    text = np.asarray(im.convert('L')) <= MRC_TEXT_THRESHOLD
+    background = masked_block_mean(pixels, ~text, MRC_BG_SCALE)
+    foreground = masked_block_mean(pixels, text, MRC_FG_SCALE)
+    if not color:
+        background, foreground = background[..., 0], foreground[..., 0]
+    return Image.fromarray(~text), Image.fromarray(background), Image.fromarray(foreground)
+
+
+def pdf_image(pdf: pikepdf.Pdf, im: Image.Image, **save_options) -> pikepdf.Object:
+    """Encode an image and add it to pdf as an image XObject (img2pdf does the embedding)"""
+    buf = BytesIO()
+    im.save(buf, **save_options)
+    with pikepdf.open(BytesIO(img2pdf.convert(buf.getvalue(), engine=img2pdf.Engine.internal))) as single:
+        [image] = single.pages[0].Resources.XObject.values()
+        return pdf.copy_foreign(image)
+
+
+def save_mrc_page(im: Image.Image, out_file: Path, dpi: int, color: bool) -> None:
+    """Write a one-page PDF drawing the background, then the text colour through the G4 mask
+    
+    The mask is an explicit /Mask of the foreground image, which PDF allows
+    at a higher resolution than the image it masks.
+    """
+    mask, background, foreground = mrc_layers(im, color)
+    width, height = im.width * 72 / dpi, im.height * 72 / dpi
+    with pikepdf.new() as pdf:
+        page = pdf.add_blank_page(page_size=(width, height))
+        stencil = pdf_image(pdf, mask, format="TIFF", compression="group4")
+        del stencil['/ColorSpace']
+        stencil.ImageMask = True
+        text = pdf_image(pdf, foreground, format="JPEG", quality=MRC_FG_QUALITY)
+        text.Mask = stencil
+        page.Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(
+            Bg=pdf_image(pdf, background, format="JPEG", quality=MRC_BG_QUALITY),
+            Fg=text,
+        ))
+        draw = b"q %.4f 0 0 %.4f 0 0 cm /%s Do Q"
+        page.Contents = pdf.make_stream(b" ".join(draw % (width, height, name) for name in (b"Bg", b"Fg")))
+        pdf.save(out_file)
+
+
+def write_build_report(report_path: Path, pages: List[dict], settings: dict) -> dict:
+    """Write the per-page codec choices of a build as JSON; returns the codec summary"""
+    summary = {}
+    for page in pages:
+        entry = summary.setdefault(page['codec'], {'pages': 0, 'bytes': 0})
+        entry['pages'] += 1
+        entry['bytes'] += page['bytes']
+    report = {
+        'settings': settings,
+        'codecs': summary,
+        'pages': [dict(page, source=str(page['source']), file=page['file'].name) for page in pages],
+    }
+    report_path.write_text(json.dumps(report, indent=2) + "\n", encoding='utf-8')
+    return summary
+
+
+# ---------- Preprocessing Cache ----------
+
+CACHE_DIR = Path.home() / ".cache" / "edubase2pdf" / "preprocessed"
+DEFAULT_CACHE_SIZE_MB = 2048
+PREPROCESS_VERSION = 1  # Bump when preprocess_image output changes for the same parameters
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def preprocess_cache_key(img_path: Path, params: dict) -> str:
+    """Cache key of one page: source image content plus every output-affecting parameter"""
+    params = dict(params, version=PREPROCESS_VERSION, source=file_sha256(img_path))
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def cache_path(cache_dir: Path, key: str, codec: str) -> Path:
+    return cache_dir / key[:2] / f"{key}.{codec}{PAGE_CODECS[codec]}"
+
+
+def cache_entries(cache_dir: Path) -> List[Tuple[Path, os.stat_result]]:
+    """(path, stat) of every cached page, least recently used first"""
+    if not cache_dir.is_dir():
+        return []
+    entries = [(p, p.stat()) for p in cache_dir.glob("*/*") if not p.name.endswith(".part")]
+    entries.sort(key=lambda e: e[1].st_mtime)
+    return entries
+
+
+def prune_cache(cache_dir: Path, max_bytes: int) -> Tuple[int, int]:
+    """Evict least recently used pages until the cache fits max_bytes
+    
+    Cache hits touch the file mtime, so mtime order is LRU order.
+    Returns (files removed, bytes freed).
+    """
+    entries = cache_entries(cache_dir)
+    total = sum(st.st_size for _, st in entries)
+    removed = freed = 0
+    for path, st in entries:
+        if total - freed <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        removed += 1
+        freed += st.st_size
+    return removed, freed
+
+
+CROP_MODES = ('page', 'book')
+BOOK_CROP_SAMPLE = 24       # Pages analysed for --crop-mode book
+BOOK_CROP_PERCENTILE = 5    # Outer percentile of the sampled boxes (ignores covers/full-bleed pages)
+
+
+def sample_pages(images: List[Path], sample_size: int) -> List[Path]:
+    """Evenly spaced pages across the book, first and last included"""
+    if sample_size >= len(images):
+        return list(images)
+    if sample_size <= 1:
+        return [images[len(images) // 2]]
+    step = (len(images) - 1) / (sample_size - 1)
+    return [images[round(n * step)] for n in range(sample_size)]
+
+
+def page_content_bbox(img_path: Path, threshold: int) -> Optional[Tuple[int, int, int, int]]:
+    with Image.open(img_path) as im:
+        return content_bbox(im, threshold)
+
+
+def book_crop_box(
+    images: List[Path],
+    threshold: int,
+    margin_px: int,
+    sample_size: int = BOOK_CROP_SAMPLE,
+    percentile: float = BOOK_CROP_PERCENTILE,
+    workers: int = 1,
+) -> Optional[Tuple[int, int, int, int]]:
+    """One crop rectangle for the whole book from a sample of pages
+    
+    Each edge is the percentile-outermost edge of the sampled content
+    boxes (a union that ignores a few outliers such as the cover), plus
+    margin_px. None if every sampled page is blank.
+    """
+    sample = sample_pages(images, sample_size)
+    if workers > 1:
+        with ProcessPoolExecutor(min(workers, len(sample))) as pool:
+            boxes = list(pool.map(page_content_bbox, sample, [threshold] * len(sample)))
+    else:
+        boxes = [page_content_bbox(p, threshold) for p in sample]
+    boxes = np.array([b for b in boxes if b], dtype=int)
+    if not len(boxes):
+        return None
+    left = np.percentile(boxes[:, 0], percentile, method='lower')
+    top = np.percentile(boxes[:, 1], percentile, method='lower')
+    right = np.percentile(boxes[:, 2], 100 - percentile, method='higher')
+    bottom = np.percentile(boxes[:, 3], 100 - percentile, method='higher')
+    return (max(int(left) - margin_px, 0), max(int(top) - margin_px, 0),
+            int(right) + margin_px, int(bottom) + margin_px)
+
+
+def preprocess_image(img_path: Path, out_base: Path, crop: bool, crop_threshold: int,
+                     crop_margin: int, jpeg_quality: int,
+                     crop_box: Optional[Tuple[int, int, int, int]] = None,
+                     cache_dir: Optional[Path] = None,
+                     codec_mode: str = 'auto',
+                     dpi: int = 300) -> dict:
+    """Crop and encode one page for the PDF (runs in a worker process)
+    
+    crop_box is the book-wide rectangle of --crop-mode book; it replaces the
+    per-page bounding-box search. codec_mode auto picks the codec per page
+    (classify_page), jpeg always writes colour JPEG, and mrc turns gray and
+    palette pages into layered pages at dpi. The output is out_base
+    plus the codec's suffix. With cache_dir, an unchanged page with the same
+    parameters is linked from the cache instead.
+    Returns the report entry (source, file, codec, bytes, cached).
+    """
+    def result(out_file: Path, codec: str, cached: bool) -> dict:
+        return {'source': img_path, 'file': out_file, 'codec': codec,
+                'bytes': out_file.stat().st_size, 'cached': cached}
+    
+    key = None
+    if cache_dir is not None:
+        if crop_box:
+            params = {'crop': 'book', 'box': list(crop_box)}
+        elif crop:
+            params = {'crop': 'page', 'threshold': crop_threshold, 'margin': crop_margin}
+        else:
+            params = {'crop': 'none'}
+        params.update(jpeg_quality=jpeg_quality, codec=codec_mode)
+        if codec_mode == 'mrc':
+            params['dpi'] = dpi
+        key = preprocess_cache_key(img_path, params)
+        for codec, suffix in PAGE_CODECS.items():
+            cached = cache_path(cache_dir, key, codec)
+            if cached.exists():
+                os.utime(cached)  # LRU
+                out_file = out_base.with_name(out_base.name + suffix)
+                link_into(cached, out_file)
+                return result(out_file, codec, True)
+    
+    with Image.open(img_path) as im:
+        if crop_box:
+            left, top, right, bottom = crop_box
+            im = im.crop((left, top, min(right, im.width), min(bottom, im.height)))
+        elif crop:
+            im = auto_crop_image(im, threshold=crop_threshold, margin_px=crop_margin)
+        codec = 'color' if codec_mode == 'jpeg' else classify_page(im)
+        if codec_mode == 'mrc' and codec in ('gray', 'palette'):
+            # Text over shading or colour; bilevel pages and photos stay single images
+            out_file = out_base.with_name(out_base.name + PAGE_CODECS['mrc'])
+            save_mrc_page(im, out_file, dpi, color=codec == 'palette')
+            codec = 'mrc'
+        else:
+            out_file = out_base.with_name(out_base.name + PAGE_CODECS[codec])
+            save_page(im, out_file, codec, jpeg_quality)
+    
+    if key is not None:
+        cached = cache_path(cache_dir, key, codec)
+        ensure_dir(cached.parent)
+        link_into(out_file, cached)
+    return result(out_file, codec, False)
+
+
+def preprocess_images(
+    images: List[Path],
+    processed_dir: Path,
+    crop: bool,
+    crop_threshold: int,
+    crop_margin: int,
+    jpeg_quality: int,
+    workers: int,
+    on_done=None,
+    crop_box: Optional[Tuple[int, int, int, int]] = None,
+    cache_dir: Optional[Path] = None,
+    codec_mode: str = 'auto',
+    dpi: int = 300,
+) -> List[dict]:
+    """Preprocess all pages on a process pool
+    
+    Returns the report entries of preprocess_image in the order of images,
+    however the workers finish. on_done is called once per finished page
+    (progress bar).
+    """
+    jobs = [(img_path, processed_dir / img_path.stem) for img_path in images]
+    args = (crop, crop_threshold, crop_margin, jpeg_quality, crop_box, cache_dir, codec_mode, dpi)
+    if workers <= 1:
+        pages = []
+        for img_path, out_base in jobs:
+            pages.append(preprocess_image(img_path, out_base, *args))
+            if on_done:
+                on_done()
+        return pages
+    
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(preprocess_image, img_path, out_base, *args) for img_path, out_base in jobs]
+        try:
+            for future in as_completed(futures):
+                future.result()
+                if on_done:
+                    on_done()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return [future.result() for future in futures]
+
+
 def build_pipeline(
     input_dir: Path,
     output_pdf: Path,
@@ -383,6 +3247,14 @@ def build_pipeline(
     author: Optional[str],
     subject: Optional[str],
     keywords: Optional[str],
+    preprocess_workers: Optional[int] = None,
+    crop_mode: str = 'page',
+    crop_sample: int = BOOK_CROP_SAMPLE,
+    cache_dir: Optional[Path] = CACHE_DIR,
+    cache_size_mb: int = DEFAULT_CACHE_SIZE_MB,
+    codec_mode: str = 'auto',
+    workdir: Optional[Path] = None,
+    workdir_budget_mb: Optional[int] = None,
 ) -> None:
     """Build PDF with OCR on Ubuntu/Linux"""
     
@@ -416,6 +3288,19 @@ def build_pipeline(
         sys.exit(1)
     
     console.print(f"[green]✓[/green] Found [cyan]{len(images)}[/cyan] images")
+    mismatches = manifest_mismatches(input_dir, images)
+    if mismatches:
+        console.print(f"[yellow]⚠️  {len(mismatches)} page(s) differ from the capture journal (all files on disk are used):[/yellow]")
+        for line in mismatches[:10]:
+            console.print(f"   [yellow]{line}[/yellow]")
+        if len(mismatches) > 10:
+            console.print(f"   [yellow]... and {len(mismatches) - 10} more[/yellow]")
+    if dpi is None:
+        dpi = manifest_dpi(input_dir)
+        if dpi:
+            console.print(f"   DPI: [cyan]{dpi}[/cyan] (from capture)")
+        else:
+            dpi = 300
     console.print(f"   First: [yellow]{images[0].name}[/yellow]")
     console.print(f"   Last: [yellow]{images[-1].name}[/yellow]")
     console.print()
@@ -430,106 +3315,169 @@ def build_pipeline(
     keywords_list = [k.strip() for k in keywords.split(",")] if keywords else None
     ensure_dir(output_pdf.parent)
     
-    tmpdir = Path(tempfile.mkdtemp())
-    processed_dir = tmpdir / "processed"
-    ensure_dir(processed_dir)
-    processed = []
+    if not preprocess_workers:
+        preprocess_workers = os.cpu_count() or 1
+    preprocess_workers = min(preprocess_workers, len(images))
     
-    # Step 1: Preprocess images
-    console.print(Panel(
-        "[bold cyan]Step 1/4:[/bold cyan] Image Preprocessing\n\n"
-        f"Actions: {'Crop + ' if crop else ''}JPEG conversion (quality {jpeg_quality})",
-        border_style="cyan"
-    ))
-    console.print()
-    
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[bold blue]{task.description}"),
-        BarColumn(),
-        TaskProgressColumn(),
-        TimeRemainingColumn(),
-        console=console,
-    ) as progress:
-        
-        task = progress.add_task("Processing images", total=len(images))
-        
-        for img_path in images:
-            with Image.open(img_path) as im:
-                if crop:
-                    im = auto_crop_image(im, threshold=crop_threshold, margin_px=crop_margin)
-                if im.mode in ('RGBA', 'P'):
-                    im = im.convert('RGB')
-                out_file = processed_dir / (img_path.stem + ".jpg")
-                im.save(out_file, format="JPEG", quality=jpeg_quality, optimize=True)
-                processed.append(out_file)
-            progress.advance(task)
-    
-    console.print("[green]✓[/green] Images preprocessed")
-    console.print()
-    
-    # Step 2: Create raw PDF
-    console.print(Panel(
-        "[bold cyan]Step 2/4:[/bold cyan] Creating Raw PDF",
-        border_style="cyan"
-    ))
-    console.print()
-    
-    raw_pdf = tmpdir / "raw.pdf"
-    with console.status("[bold blue]Building PDF from images...[/bold blue]"):
-        build_pdf_from_images(processed, raw_pdf, dpi=dpi)
-    
-    pdf_size = raw_pdf.stat().st_size
-    console.print(f"[green]✓[/green] Raw PDF created: [cyan]{format_size(pdf_size)}[/cyan]")
-    console.print()
-    
-    # Step 3: OCR
-    console.print(Panel(
-        f"[bold cyan]Step 3/4:[/bold cyan] OCR Text Recognition\n\n"
-        f"Language: [blue]{lang}[/blue]\n"
-        f"Jobs: [yellow]{jobs}[/yellow]\n"
-        f"Estimated time: [yellow]~{len(images)//6} minutes[/yellow]\n\n"
-        "[dim]This may take several minutes. Please wait...[/dim]",
-        border_style="cyan"
-    ))
-    console.print()
-    
-    ocr_pdf = tmpdir / "ocr.pdf"
-    
-    with console.status("[bold yellow]Running OCR (this takes time)...[/bold yellow]", spinner="dots"):
-        try:
-            run_ocr(
-                input_pdf=raw_pdf,
-                output_pdf=ocr_pdf,
-                lang=lang,
-                jobs=jobs,
-                optimize=optimize
+    budget_bytes = workdir_budget_mb * 1024 * 1024 if workdir_budget_mb is not None else None
+    with BuildWorkspace(workdir, budget_bytes=budget_bytes) as workspace:
+        console.print(f"[green]✓[/green] Workspace: [yellow]{workspace.primary}[/yellow] "
+                      f"(budget {format_size(workspace.budget_bytes)})")
+        console.print()
+        processed_dir = workspace.dir("processed", sum(img.stat().st_size for img in images))
+        
+        # Step 1: Preprocess images
+        crop_action = ''
+        if crop:
+            crop_action = 'Book-wide crop + ' if crop_mode == 'book' else 'Crop + '
+        encode_action = {
+            'auto': "Per-page codec (bilevel/gray/palette/color)",
+            'jpeg': "JPEG conversion",
+            'mrc': "Mixed raster content (text mask + background)",
+        }[codec_mode]
+        console.print(Panel(
+            "[bold cyan]Step 1/4:[/bold cyan] Image Preprocessing\n\n"
+            f"Actions: {crop_action}{encode_action} (JPEG quality {jpeg_quality})\n"
+            f"Workers: [yellow]{preprocess_workers}[/yellow]",
+            border_style="cyan"
+        ))
+        console.print()
+        
+        crop_box = None
+        if crop and crop_mode == 'book':
+            sample_size = min(crop_sample, len(images))
+            with console.status(f"[bold blue]Finding crop box from {sample_size} sample pages...[/bold blue]"):
+                crop_box = book_crop_box(images, crop_threshold, crop_margin, sample_size=sample_size,
+                                         workers=preprocess_workers)
+            if crop_box:
+                left, top, right, bottom = crop_box
+                console.print(f"[green]✓[/green] Crop box: [cyan]{right - left}x{bottom - top}[/cyan] px at ({left}, {top})")
+            else:
+                console.print("[yellow]⚠️  Sample pages are blank, not cropping[/yellow]")
+                crop = False
+            console.print()
+        
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[bold blue]{task.description}"),
+            BarColumn(),
+            TaskProgressColumn(),
+            TimeRemainingColumn(),
+            console=console,
+        ) as progress:
+        
+            task = progress.add_task("Processing images", total=len(images))
+            pages = preprocess_images(
+                images,
+                processed_dir,
+                crop=crop,
+                crop_threshold=crop_threshold,
+                crop_margin=crop_margin,
+                jpeg_quality=jpeg_quality,
+                workers=preprocess_workers,
+                on_done=lambda: progress.advance(task),
+                crop_box=crop_box,
+                cache_dir=cache_dir,
+                codec_mode=codec_mode,
+                dpi=dpi,
             )
-        except subprocess.CalledProcessError as e:
-            console.print(f"[red]❌ OCR failed: {e}[/red]")
+        processed = [page['file'] for page in pages]
+        
+        console.print("[green]✓[/green] Images preprocessed")
+        if cache_dir is not None:
+            cache_hits = sum(page['cached'] for page in pages)
+            removed, freed = prune_cache(cache_dir, cache_size_mb * 1024 * 1024)
+            console.print(f"   Cache: [cyan]{cache_hits}[/cyan] reused, [cyan]{len(images) - cache_hits}[/cyan] processed"
+                          + (f", evicted {removed} ({format_size(freed)})" if removed else ""))
+        
+        report_path = output_pdf.with_name(output_pdf.stem + ".report.json")
+        codecs = write_build_report(report_path, pages, {
+            'codec_mode': codec_mode,
+            'jpeg_quality': jpeg_quality,
+            'crop': crop_mode if crop else None,
+            'crop_box': list(crop_box) if crop_box else None,
+            'dpi': dpi,
+        })
+        codec_table = Table(box=box.SIMPLE)
+        codec_table.add_column("Codec", style="cyan")
+        codec_table.add_column("Pages", justify="right")
+        codec_table.add_column("Size", justify="right")
+        for codec in PAGE_CODECS:
+            if codec in codecs:
+                codec_table.add_row(codec, str(codecs[codec]['pages']), format_size(codecs[codec]['bytes']))
+        console.print(codec_table)
+        console.print(f"   Report: [yellow]{report_path}[/yellow]")
+        console.print()
+        
+        # Step 2: Create raw PDF
+        console.print(Panel(
+            "[bold cyan]Step 2/4:[/bold cyan] Creating Raw PDF",
+            border_style="cyan"
+        ))
+        console.print()
+        
+        raw_pdf = workspace.path("raw.pdf", sum(page['bytes'] for page in pages))
+        with console.status("[bold blue]Building PDF from images...[/bold blue]"):
+            build_pdf_from_images(processed, raw_pdf, dpi=dpi)
+        shutil.rmtree(processed_dir)  # Free the workspace for OCR
+        
+        pdf_size = raw_pdf.stat().st_size
+        console.print(f"[green]✓[/green] Raw PDF created: [cyan]{format_size(pdf_size)}[/cyan]")
+        console.print()
+        
+        # Step 3: OCR
+        console.print(Panel(
+            f"[bold cyan]Step 3/4:[/bold cyan] OCR Text Recognition\n\n"
+            f"Language: [blue]{lang}[/blue]\n"
+            f"Jobs: [yellow]{jobs}[/yellow]\n"
+            f"Estimated time: [yellow]~{len(images)//6} minutes[/yellow]\n\n"
+            "[dim]This may take several minutes. Please wait...[/dim]",
+            border_style="cyan"
+        ))
+        console.print()
+        
+        ocr_pdf = workspace.path("ocr.pdf", raw_pdf.stat().st_size * 11 // 10)
+        ocr_tmp = workspace.dir("ocrmypdf", len(images) * OCR_TEMP_BYTES_PER_PAGE)
+        if workspace.spilled:
+            console.print(f"[yellow]⚠️  Workspace budget exceeded, spilled to disk: {', '.join(workspace.spilled)}[/yellow]")
             console.print()
-            console.print("[yellow]Make sure ocrmypdf is installed:[/yellow]")
-            console.print("  Ubuntu/Linux: sudo apt install ocrmypdf tesseract-ocr-deu")
-            sys.exit(1)
-    
-    console.print("[green]✓[/green] OCR completed")
-    console.print()
-    
-    # Step 4: Finalize
-    console.print(Panel(
-        "[bold cyan]Step 4/4:[/bold cyan] Finalizing PDF",
-        border_style="cyan"
-    ))
-    console.print()
-    
-    with console.status("[bold blue]Setting metadata and saving...[/bold blue]"):
-        ocr_pdf.replace(output_pdf)
-        set_metadata(output_pdf, title, author, subject, keywords_list)
-    
-    final_size = output_pdf.stat().st_size
-    console.print("[green]✓[/green] Metadata set")
-    console.print("[green]✓[/green] PDF saved")
-    console.print()
+        
+        with console.status("[bold yellow]Running OCR (this takes time)...[/bold yellow]", spinner="dots"):
+            try:
+                run_ocr(
+                    input_pdf=raw_pdf,
+                    output_pdf=ocr_pdf,
+                    lang=lang,
+                    jobs=jobs,
+                    optimize=optimize,
+                    deskew=codec_mode != 'mrc',
+                    tmpdir=ocr_tmp,
+                )
+            except subprocess.CalledProcessError as e:
+                console.print(f"[red]❌ OCR failed: {e}[/red]")
+                console.print()
+                console.print("[yellow]Make sure ocrmypdf is installed:[/yellow]")
+                console.print("  Ubuntu/Linux: sudo apt install ocrmypdf tesseract-ocr-deu")
+                sys.exit(1)
+        
+        console.print("[green]✓[/green] OCR completed")
+        console.print()
+        
+        # Step 4: Finalize
+        console.print(Panel(
+            "[bold cyan]Step 4/4:[/bold cyan] Finalizing PDF",
+            border_style="cyan"
+        ))
+        console.print()
+        
+        with console.status("[bold blue]Setting metadata and saving...[/bold blue]"):
+            shutil.move(ocr_pdf, output_pdf)  # Workspace may be on another file system
+            set_metadata(output_pdf, title, author, subject, keywords_list)
+        
+        final_size = output_pdf.stat().st_size
+        console.print("[green]✓[/green] Metadata set")
+        console.print("[green]✓[/green] PDF saved")
+        console.print()
     
     # Success summary
     result = Table(show_header=False, box=box.ROUNDED, border_style="green")
@@ -560,24 +3508,87 @@ def cli():
     pass
 
 
+def capture_options(f):
+    """Capture options shared by capture and capture-batch"""
+    for option in reversed([
+        click.option('--delay-ms', type=int, default=1500, help='Delay between pages (milliseconds)'),
+        click.option('--fullpage', is_flag=True, default=False, help='Full-page screenshots instead of clipping to the viewer'),
+        click.option('--crop/--no-crop', default=True, help='Auto-crop white margins'),
+        click.option('--crop-threshold', type=int, default=248, help='Crop threshold (200-254)'),
+        click.option('--crop-margin', type=int, default=10, help='Crop margin (pixels)'),
+        click.option('--workers', type=click.IntRange(1, 16), default=1, help='Parallel capture tabs in the same browser session'),
+        click.option('--ready-probe', type=click.Choice(READY_PROBES), default='dom', help='How to detect that a page has finished rendering'),
+        click.option('--ready-timeout', type=float, default=10.0, help='Max seconds to wait for a page to render'),
+        click.option('--ready-js', default=None, help='JS predicate for --ready-probe js, e.g. "(i) => !!document.querySelector(\'canvas\')"'),
+        click.option('--nav', 'nav_strategy', type=click.Choice(NAV_STRATEGIES), default='hash', help='Page navigation: in-app hash jump (falls back to goto) or full page.goto'),
+        click.option('--image-format', type=click.Choice(list(IMAGE_FORMATS)), default='png', help='Codec for captured pages'),
+        click.option('--compress-level', type=int, default=None, help='PNG zlib level (0-9), WebP method (0-6) or JPEG quality (1-95)'),
+        click.option('--postprocess-workers', type=click.IntRange(0, 64), default=None, help='Processes for crop/encode/write (0 = inline, default: auto)'),
+        click.option('--stale-retries', type=click.IntRange(0, 10), default=2, help='Re-captures when a frame still shows the previous page (0 = off)'),
+        click.option('--stale-threshold', type=click.IntRange(0, 64), default=2, help='Max differing hash bits (of 256) for a frame to count as unchanged'),
+        click.option('--adaptive-delay', is_flag=True, default=False, help='Tune --delay-ms at runtime (shrinks while healthy, backs off on errors)'),
+        click.option('--min-delay-ms', type=int, default=0, help='Lower bound for --adaptive-delay'),
+        click.option('--max-delay-ms', type=int, default=15000, help='Upper bound for --adaptive-delay'),
+        click.option('--max-attempts', type=click.IntRange(1, 10), default=3, help='Attempts per page before it is recorded as failed'),
+        click.option('--retry-backoff', 'retry_backoff_s', type=float, default=2.0, help='Seconds before the first in-run retry (doubles per attempt)'),
+        click.option('--block', 'block_policy', type=click.Choice(BLOCK_POLICIES), default='trackers', help='Drop requests the render does not need (trackers, or also media/long-polls with lean)'),
+        click.option('--block-url', 'block_patterns', multiple=True, help='Extra URL regex to block (repeatable)'),
+        click.option('--target-dpi', type=click.IntRange(72, 1200), default=None, help='Render pages at this resolution'),
+        click.option('--page-size', default='a4', help='Printed page size for --target-dpi: a4, a5, letter or WIDTHxHEIGHT in mm'),
+        click.option('--viewer-selector', default=None, help='CSS selector of the page element to clip to (default: largest canvas/img)'),
+        click.option('--attach', is_flag=True, default=False, help='Use the running browser-daemon instead of launching Firefox'),
+        click.option('--headless', is_flag=True, default=False, help='Run Firefox without a window'),
+        click.option('--non-interactive', is_flag=True, default=False, help='Never prompt; log in from --storage-state and exit 3 if that session is logged out'),
+        click.option('--storage-state', type=click.Path(dir_okay=False, path_type=Path), default=None, help=f'Saved login for --non-interactive/--attach (default: {SESSION_STATE_PATH})'),
+        click.option('--setup-js', default=None, help='JS run in every tab before capture, e.g. to set zoom or close sidebars'),
+        click.option('--retry-failed', is_flag=True, default=False, help='Only capture pages recorded as failed in the capture manifest'),
+    ]):
+        f = option(f)
+    return f
+
+
+def check_capture_options(ready_probe, ready_js, target_dpi, fullpage, page_size, image_format, compress_level,
+                          **_) -> None:
+    """Reject option combinations click cannot express"""
+    if ready_probe == 'js' and not ready_js:
+        raise click.UsageError("--ready-probe js requires --ready-js")
+    if compress_level is not None:
+        low, high = COMPRESS_LEVEL_RANGE[image_format]
+        if not low <= compress_level <= high:
+            raise click.BadParameter(
+                f"{compress_level} is out of range for {image_format} ({low}-{high})", param_hint='--compress-level',
+            )
+    if target_dpi and fullpage:
+        raise click.UsageError("--target-dpi clips to the viewer and cannot be combined with --fullpage")
+    try:
+        parse_page_size(page_size)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--page-size')
+
+
 @cli.command()
 @click.option('--book-url', required=True, help='Book viewer URL (e.g., https://app.edubase.ch/#doc/60505/1)')
 @click.option('--pages', type=int, required=True, help='Total number of pages')
 @click.option('--out-dir', type=click.Path(), default='./input_pages', help='Output directory for screenshots')
 @click.option('--user-data-dir', type=click.Path(), default=None, help='Browser profile directory (default: ~/.edubase_browser)')
 @click.option('--start-index', type=int, default=1, help='Start page number')
-@click.option('--delay-ms', type=int, default=1500, help='Delay between pages (milliseconds)')
-@click.option('--fullpage', is_flag=True, default=True, help='Use fullpage screenshots')
-@click.option('--crop/--no-crop', default=True, help='Auto-crop white margins')
-@click.option('--crop-threshold', type=int, default=248, help='Crop threshold (200-254)')
-@click.option('--crop-margin', type=int, default=10, help='Crop margin (pixels)')
-def capture(book_url, pages, out_dir, user_data_dir, start_index, delay_ms, fullpage, crop, crop_threshold, crop_margin):
+@click.option('--engine', type=click.Choice(['sync', 'async']), default='sync', help='Capture backend (async overlaps navigation, waits and disk writes)')
+@click.option('--shard', default=None, help='Capture only block K of N (e.g. 2/4) into OUT_DIR/shard-K-of-N; combine with merge-shards')
+@capture_options
+def capture(book_url, pages, out_dir, user_data_dir, start_index, engine, shard, delay_ms, **options):
     """
     Capture screenshots from Edubase viewer.
     
     Example:
         python edubase_cli.py capture --book-url "https://app.edubase.ch/#doc/60505/1" --pages 396
     """
+    check_capture_options(**options)
+    if shard:
+        try:
+            shard = parse_shard(shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--shard')
+    
     out_path = Path(out_dir).expanduser().resolve()
     
     if user_data_dir:
@@ -592,30 +3603,131 @@ def capture(book_url, pages, out_dir, user_data_dir, start_index, delay_ms, full
         out_dir=out_path,
         user_data_dir=user_data_path,
         start_index=start_index,
+        engine=engine,
+        shard=shard,
         per_page_delay_ms=delay_ms,
-        fullpage=fullpage,
-        crop=crop,
-        crop_threshold=crop_threshold,
-        crop_margin=crop_margin,
+        **options,
     )
 
 
+@cli.command('browser-daemon')
+@click.option('--port', type=click.IntRange(0, 65535), default=0, help='Local port for the browser server (0 = any free port)')
+@click.option('--headless', is_flag=True, default=False, help='Run Firefox without a window')
+def browser_daemon(port, headless):
+    """
+    Keep Firefox running so capture --attach starts instantly.
+    
+    Example:
+        python edubase_cli.py browser-daemon &
+        python edubase_cli.py capture --attach --book-url "https://app.edubase.ch/#doc/60505/1" --pages 396
+    """
+    if read_daemon_endpoint():
+        raise click.UsageError(f"A browser daemon is already running (see {DAEMON_INFO_PATH})")
+    try:
+        run_browser_daemon(port, headless)
+    except RuntimeError as e:
+        console.print(f"[red]❌ {e}[/red]")
+        sys.exit(1)
+
+
+@cli.command('merge-shards')
+@click.argument('shard_dirs', nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option('--out-dir', type=click.Path(file_okay=False), default='./input_pages', help='Directory for the merged page set (default shard source: its shard-* subdirectories)')
+@click.option('--allow-gaps', is_flag=True, default=False, help='Merge even if some pages were not captured by any shard')
+def merge_shards_command(shard_dirs, out_dir, allow_gaps):
+    """
+    Combine shard directories into one page_NNNN set for build.
+    
+    Example:
+        python edubase_cli.py merge-shards --out-dir ./input_pages
+    """
+    out_path = Path(out_dir).expanduser().resolve()
+    if shard_dirs:
+        sources = [Path(d).expanduser().resolve() for d in shard_dirs]
+    else:
+        sources = sorted((p for p in out_path.glob("shard-*-of-*") if p.is_dir()), key=lambda p: natural_key(p.name))
+    if not sources:
+        raise click.UsageError(f"No shard directories given or found in {out_path}")
+    
+    plan = plan_merge(sources)
+    
+    console.print()
+    summary = Table(show_header=False, box=box.ROUNDED, border_style="cyan")
+    summary.add_column("Metric", style="cyan")
+    summary.add_column("Value", style="green")
+    summary.add_row("🧩 Shards", str(len(sources)))
+    summary.add_row("📄 Pages", f"{len(plan['pages'])} of {plan['total_pages']}")
+    if plan['duplicates']:
+        summary.add_row("♊ Duplicates", f"{len(plan['duplicates'])} (identical, kept once)")
+    if plan['conflicts']:
+        summary.add_row("❌ Conflicts", f"{len(plan['conflicts'])}: {plan['conflicts'][:20]}")
+    if plan['gaps']:
+        summary.add_row("🕳️  Gaps", f"{len(plan['gaps'])}: {plan['gaps'][:20]}")
+    console.print(summary)
+    
+    for problem in plan['problems']:
+        console.print(f"[red]❌ {problem}[/red]")
+    if plan['problems'] or plan['conflicts'] or (plan['gaps'] and not allow_gaps):
+        console.print("[yellow]💡 Re-run the affected shards with --retry-failed, or pass --allow-gaps[/yellow]")
+        sys.exit(1)
+    
+    merged = merge_shards(plan, out_path)
+    console.print(f"[green]✓[/green] Merged [cyan]{merged}[/cyan] pages into [blue]{out_path}[/blue]")
+    console.print()
+    console.print("[bold cyan]➜ Next:[/bold cyan] Run [yellow]python edubase_cli.py build[/yellow] to create PDF")
+    console.print()
+
+
+@cli.command('capture-batch')
+@click.option('--jobs', 'job_file', type=click.Path(exists=True, dir_okay=False), required=True, help='Job file with one "URL PAGES [OUT_DIR]" per line')
+@click.option('--out-root', type=click.Path(file_okay=False), default='./books', help='Parent directory for jobs without OUT_DIR')
+@capture_options
+def capture_batch_command(job_file, out_root, delay_ms, **options):
+    """
+    Capture several books in one browser session.
+    
+    Login and browser startup happen once; each book resumes from its own
+    capture manifest.
+    
+    Example:
+        python edubase_cli.py capture-batch --jobs books.txt --workers 3
+    """
+    check_capture_options(**options)
+    try:
+        jobs = load_jobs(Path(job_file), Path(out_root).expanduser())
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--jobs')
+    if not jobs:
+        raise click.BadParameter(f"{job_file} lists no books", param_hint='--jobs')
+    
+    capture_batch(jobs, per_page_delay_ms=delay_ms, **options)
+
+
 @cli.command()
 @click.option('--input', 'input_dir', type=click.Path(exists=True), default='./input_pages', help='Input images directory')
 @click.option('--output', type=click.Path(), default='./output/book.pdf', help='Output PDF path')
 @click.option('--lang', default='deu', help='OCR language (e.g., deu, eng, deu+eng)')
 @click.option('--jobs', type=int, default=6, help='Parallel OCR jobs')
+@click.option('--preprocess-workers', type=click.IntRange(min=1), default=None, help='Processes for cropping/JPEG conversion (default: all cores)')
 @click.option('--optimize', type=int, default=2, help='Optimization level (0-3)')
-@click.option('--dpi', type=int, default=300, help='DPI for PDF')
+@click.option('--dpi', type=int, default=None, help='DPI for PDF (default: from --target-dpi capture, else 300)')
 @click.option('--jpeg-quality', type=int, default=92, help='JPEG quality (80-95)')
 @click.option('--crop/--no-crop', default=True, help='Auto-crop images')
 @click.option('--crop-threshold', type=int, default=248, help='Crop threshold')
 @click.option('--crop-margin', type=int, default=10, help='Crop margin')
+@click.option('--crop-mode', type=click.Choice(CROP_MODES), default='page', help='Crop each page to its content, or every page to one box found from a sample (book)')
+@click.option('--crop-sample', type=click.IntRange(min=1), default=BOOK_CROP_SAMPLE, help='Pages sampled for --crop-mode book')
+@click.option('--codec', '--compression', 'codec_mode', type=click.Choice(CODEC_MODES), default='auto', help='Per page: bilevel G4, gray JPEG, palette PNG or color JPEG (auto), always color JPEG, or text mask over low-res background (mrc)')
+@click.option('--cache/--no-cache', default=True, help='Reuse preprocessed pages from earlier builds')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=str(CACHE_DIR), help='Preprocessing cache directory')
+@click.option('--cache-size-mb', type=click.IntRange(min=0), default=DEFAULT_CACHE_SIZE_MB, help='Evict least recently used pages above this size')
+@click.option('--workdir', default='auto', help='Scratch directory for intermediate files; auto uses /dev/shm (RAM) when available')
+@click.option('--workdir-budget-mb', type=click.IntRange(min=0), default=None, help='Spill intermediate files to disk above this size (default: half the free space of the workdir)')
 @click.option('--title', default=None, help='PDF title metadata')
 @click.option('--author', default=None, help='PDF author metadata')
 @click.option('--subject', default=None, help='PDF subject metadata')
 @click.option('--keywords', default=None, help='Comma-separated keywords')
-def build(input_dir, output, lang, jobs, optimize, dpi, jpeg_quality, crop, crop_threshold, crop_margin, title, author, subject, keywords):
+def build(input_dir, output, lang, jobs, preprocess_workers, optimize, dpi, jpeg_quality, crop, crop_threshold, crop_margin, crop_mode, crop_sample, codec_mode, cache, cache_dir, cache_size_mb, workdir, workdir_budget_mb, title, author, subject, keywords):
     """
     Build searchable PDF from screenshots with OCR.
     
@@ -640,9 +3752,50 @@ def build(input_dir, output, lang, jobs, optimize, dpi, jpeg_quality, crop, crop
         author=author,
         subject=subject,
         keywords=keywords,
+        preprocess_workers=preprocess_workers,
+        crop_mode=crop_mode,
+        crop_sample=crop_sample,
+        cache_dir=Path(cache_dir).expanduser() if cache else None,
+        cache_size_mb=cache_size_mb,
+        codec_mode=codec_mode,
+        workdir=None if workdir == 'auto' else Path(workdir).expanduser(),
+        workdir_budget_mb=workdir_budget_mb,
     )
 
 
+@cli.group('cache')
+def cache_group():
+    """Inspect or shrink the build preprocessing cache."""
+
+
+@cache_group.command('stats')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=str(CACHE_DIR), help='Preprocessing cache directory')
+def cache_stats(cache_dir):
+    """Show size and age of the preprocessing cache."""
+    cache_dir = Path(cache_dir).expanduser()
+    entries = cache_entries(cache_dir)
+    
+    table = Table(show_header=False, box=box.ROUNDED)
+    table.add_column("Property", style="cyan")
+    table.add_column("Value")
+    table.add_row("Directory", str(cache_dir))
+    table.add_row("Pages", str(len(entries)))
+    table.add_row("Size", format_size(sum(st.st_size for _, st in entries)))
+    if entries:
+        table.add_row("Least recently used", time.strftime('%Y-%m-%d %H:%M', time.localtime(entries[0][1].st_mtime)))
+        table.add_row("Most recently used", time.strftime('%Y-%m-%d %H:%M', time.localtime(entries[-1][1].st_mtime)))
+    console.print(table)
+
+
+@cache_group.command('prune')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=str(CACHE_DIR), help='Preprocessing cache directory')
+@click.option('--max-size-mb', type=click.IntRange(min=0), default=DEFAULT_CACHE_SIZE_MB, help='Size to shrink the cache to (0 = empty it)')
+def cache_prune(cache_dir, max_size_mb):
+    """Evict least recently used pages until the cache fits --max-size-mb."""
+    removed, freed = prune_cache(Path(cache_dir).expanduser(), max_size_mb * 1024 * 1024)
+    console.print(f"[green]✓[/green] Removed [cyan]{removed}[/cyan] cached pages ({format_size(freed)})")
+
+
 @cli.command()
 def check():
     """Check system requirements and dependencies."""
@@ -670,7 +3823,7 @@ def check():
     deps.add_column("Notes")
     
     # Python packages
-    packages = ['playwright', 'PIL', 'img2pdf', 'pikepdf', 'click', 'rich']
+    packages = ['playwright', 'PIL', 'numpy', 'img2pdf', 'pikepdf', 'click', 'rich']
     for pkg in packages:
         try:
             __import__(pkg if pkg != 'PIL' else 'PIL')
@@ -5,9 +5,11 @@ import re
 import sys
 import time
 import tempfile
+from collections import deque
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
+import numpy as np
 from PIL import Image
 import img2pdf
 from tqdm import tqdm
@@ -34,11 +36,52 @@ def ensure_dir(p: Path):
 
 
 # Auto-crop white margins (simple heuristic)
+CROP_SEARCH_STEP = 8  # Stride of the coarse bounding-box search
+
+
+def content_bbox(img: Image.Image, threshold: int, step: int = CROP_SEARCH_STEP) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box (left, top, right, bottom) of pixels <= threshold in grayscale, None if blank
+    
+    A nearest-neighbour sample of one pixel per step x step cell locates the
+    content; only the margin bands around it are then converted and scanned
+    at full resolution, so the page body is never touched. The result is
+    exact: each band reaches into a sampled content cell.
+    """
+    width, height = img.size
+    
+    def dark(box) -> np.ndarray:
+        return np.asarray(img.crop(box).convert('L')) <= threshold
+    
+    cols_n, rows_n = width // step, height // step
+    rows = np.empty(0, dtype=int)
+    if cols_n and rows_n:
+        sample = img.resize((cols_n, rows_n), Image.NEAREST, box=(0, 0, cols_n * step, rows_n * step))
+        sample = np.asarray(sample.convert('L')) <= threshold
+        rows = np.flatnonzero(sample.any(axis=1))
+        cols = np.flatnonzero(sample.any(axis=0))
+    if rows.size == 0:
+        # Nothing hit the sample grid (blank page or hairline content)
+        mask = dark((0, 0, width, height))
+        rows = np.flatnonzero(mask.any(axis=1))
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(mask.any(axis=0))
+        return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+    
+    edge = (int(rows[0]) + 1) * step
+    top = int(np.flatnonzero(dark((0, 0, width, edge)).any(axis=1))[0])
+    edge = int(rows[-1]) * step
+    bottom = edge + int(np.flatnonzero(dark((0, edge, width, height)).any(axis=1))[-1]) + 1
+    edge = (int(cols[0]) + 1) * step
+    left = int(np.flatnonzero(dark((0, top, edge, bottom)).any(axis=0))[0])
+    edge = int(cols[-1]) * step
+    right = edge + int(np.flatnonzero(dark((edge, top, width, bottom)).any(axis=0))[-1]) + 1
+    return left, top, right, bottom
+
+
 def auto_crop_image(img: Image.Image, threshold: int, margin_px: int) -> Image.Image:
-    g = img.convert('L')
     # Pixels > threshold considered white background
-    mask = g.point(lambda x: 0 if x > threshold else 255, mode='1')
-    bbox = mask.getbbox()
+    bbox = content_bbox(img, threshold)
     if not bbox:
         return img
     left, top, right, bottom = bbox
@@ -51,6 +94,24 @@ def auto_crop_image(img: Image.Image, threshold: int, margin_px: int) -> Image.I
 
 # ---------- Phase A: Capture ----------
 
+EDUBASE_DOC_URL = "https://app.edubase.ch/#doc/{book_id}/{index}"
+RENDER_SETTLE_S = 1.5  # Give Edubase time to render the PDF
+
+
+def open_worker_tabs(context, first_page, book_url: str, workers: int) -> List[dict]:
+    """Open one tab per worker inside the same (logged-in) browser context."""
+    # 'shown' is the page index the tab currently displays.
+    tabs = [{'page': first_page, 'index': None, 'shown': None, 'ready_at': 0.0, 'next_nav_at': 0.0}]
+    for _ in range(workers - 1):
+        tab = context.new_page()
+        try:
+            tab.goto(book_url, wait_until="domcontentloaded", timeout=30000)
+        except PWTimeout:
+            pass  # The page is navigated again before its first screenshot
+        tabs.append({'page': tab, 'index': None, 'shown': None, 'ready_at': 0.0, 'next_nav_at': 0.0})
+    return tabs
+
+
 def capture_pages(
     book_url: str,
     total_pages: int,
@@ -65,10 +126,13 @@ def capture_pages(
     crop_margin: int,
     click_next_selector: Optional[str],
     advance_with_keys: bool,
+    workers: int = 1,
 ) -> None:
     """
     Capture pages from an already accessible viewer.
     Uses direct URL navigation (e.g., /#doc/60505/23 for page 23) if possible.
+    With workers > 1, that many tabs of the same context take page indices
+    from a shared queue.
     """
     ensure_dir(out_dir)
     
@@ -82,6 +146,10 @@ def capture_pages(
         print(f"🔗 Verwende direkte URL-Navigation für {total_pages} Seiten")
     else:
         print("⚠️  Konnte Buch ID nicht aus URL extrahieren, nutze Fallback-Methode")
+        if workers > 1:
+            print("⚠️  Parallel-Capture benötigt die Buch ID, nutze --workers 1")
+            workers = 1
+    workers = max(1, workers)
 
     with sync_playwright() as p:
         print("\n🌐 Starte Browser (Firefox)...")
@@ -144,17 +212,21 @@ def capture_pages(
             print("="*70)
             input("   Drücke Enter zum Starten...\n")
 
+        tabs = open_worker_tabs(context, page, book_url, workers)
+        tabs[0]['shown'] = start_index
+        if len(tabs) > 1:
+            print(f"🗂️  {len(tabs)} Tabs für Parallel-Capture geöffnet")
+
         # Best-effort wait for viewer element
-        target_locator = None
+        use_locator = False
         if viewer_selector:
             try:
                 print(f"🔍 Suche Viewer-Element: {viewer_selector}")
-                target_locator = page.locator(viewer_selector)
-                target_locator.wait_for(timeout=5000, state='visible')
+                page.locator(viewer_selector).wait_for(timeout=5000, state='visible')
                 print(f"✓ Viewer-Element gefunden")
+                use_locator = True
             except PWTimeout:
                 print("⚠️  Viewer-Element nicht gefunden, nutze Fullpage-Screenshots")
-                target_locator = None
 
         print(f"\n📸 Starte Capture: Seite {start_index} bis {total_pages}")
         print("="*70)
@@ -163,44 +235,73 @@ def capture_pages(
         skipped_count = 0
         failed_pages = []
 
-        # Page loop with direct URL navigation
+        # Shared work queue; existing files are skipped up front
+        pending = deque()
         for i in range(start_index, total_pages + 1):
-            filename = out_dir / f"page_{i:04d}.png"
-            
-            # Skip if file already exists
-            if filename.exists():
+            if (out_dir / f"page_{i:04d}.png").exists():
                 print(f"  [Seite {i:>3}/{total_pages}] ⏭️  Bereits vorhanden, überspringe...")
                 skipped_count += 1
-                continue
-            
-            # Navigate directly to page URL if we have book_id
-            if book_id and i > start_index:
-                page_url = f"https://app.edubase.ch/#doc/{book_id}/{i}"
-                try:
-                    response = page.goto(page_url, wait_until="domcontentloaded", timeout=15000)
-                    # Check if response indicates an error (4xx, 5xx)
-                    if response and response.status >= 400:
-                        print(f"  [Seite {i:>3}/{total_pages}] ⚠️  Status {response.status}")
-                    # Wait for page to render (shorter than full delay)
-                    page.wait_for_load_state("networkidle", timeout=3000)
-                except PWTimeout:
-                    # Page loaded but networkidle timeout - usually fine
-                    pass
-                except Exception as e:
-                    print(f"  [Seite {i:>3}/{total_pages}] ⚠️  Navigation fehlgeschlagen: {e}")
-                    failed_pages.append(i)
+            else:
+                pending.append(i)
+
+        # Page loop with direct URL navigation
+        while pending or any(t['index'] is not None for t in tabs):
+            # Hand out pages to idle tabs whose rate-limit delay has passed
+            now = time.monotonic()
+            for tab in tabs:
+                if tab['index'] is not None or not pending or now < tab['next_nav_at']:
                     continue
-            
+                i = pending.popleft()
+
+                # Navigate directly to page URL if we have book_id
+                if book_id and tab['shown'] != i:
+                    try:
+                        response = tab['page'].goto(
+                            EDUBASE_DOC_URL.format(book_id=book_id, index=i),
+                            wait_until="domcontentloaded",
+                            timeout=15000,
+                        )
+                        # Check if response indicates an error (4xx, 5xx)
+                        if response and response.status >= 400:
+                            print(f"  [Seite {i:>3}/{total_pages}] ⚠️  Status {response.status}")
+                    except PWTimeout:
+                        # Page loaded but timeout - usually fine
+                        pass
+                    except Exception as e:
+                        print(f"  [Seite {i:>3}/{total_pages}] ⚠️  Navigation fehlgeschlagen: {e}")
+                        failed_pages.append(i)
+                        continue
+
+                tab['index'] = i
+                tab['shown'] = i
+                tab['ready_at'] = time.monotonic() + RENDER_SETTLE_S
+
+            busy = [t for t in tabs if t['index'] is not None]
+            if not busy:
+                # Every tab is idle and waiting for its delay to pass
+                time.sleep(max(0.0, min(t['next_nav_at'] for t in tabs) - time.monotonic()))
+                continue
+
+            # Screenshot the tab whose page has had the longest time to render
+            tab = min(busy, key=lambda t: t['ready_at'])
+            i = tab['index']
+            filename = out_dir / f"page_{i:04d}.png"
+            tab['index'] = None
+            tab['next_nav_at'] = time.monotonic() + per_page_delay_ms / 1000.0
+
             # Wait for page to render - NO manipulation
-            page.wait_for_load_state("networkidle", timeout=3000)
-            time.sleep(1.5)  # Give Edubase time to render the PDF
+            try:
+                tab['page'].wait_for_load_state("networkidle", timeout=3000)
+            except PWTimeout:
+                pass
+            time.sleep(max(0.0, tab['ready_at'] - time.monotonic()))
 
             # Capture screenshot
             try:
-                if target_locator and not fullpage:
-                    target_locator.screenshot(path=str(filename), type="png")
+                if use_locator and not fullpage:
+                    tab['page'].locator(viewer_selector).screenshot(path=str(filename), type="png")
                 else:
-                    page.screenshot(path=str(filename), full_page=True, type="png")
+                    tab['page'].screenshot(path=str(filename), full_page=True, type="png")
                 
                 # Optional crop
                 if crop:
@@ -220,11 +321,6 @@ def capture_pages(
             except Exception as e:
                 print(f"  [Seite {i:>3}/{total_pages}] ❌ Screenshot fehlgeschlagen: {e}")
                 failed_pages.append(i)
-                continue
-
-            # Rate-limit between pages
-            if i < total_pages:
-                time.sleep(per_page_delay_ms / 1000.0)
 
         # Summary
         print("\n" + "="*70)
@@ -234,6 +330,7 @@ def capture_pages(
         if skipped_count > 0:
             print(f"  ⏭️  Übersprungen:  {skipped_count} Seiten (bereits vorhanden)")
         if failed_pages:
+            failed_pages.sort()
             print(f"  ❌ Fehlgeschlagen: {len(failed_pages)} Seiten: {failed_pages}")
         
         total_saved = len(list(out_dir.glob("page_*.png")))
@@ -425,6 +522,7 @@ def main():
     cap.add_argument("--crop", action="store_true", help="Auto-crop white margins (on captured images)")
     cap.add_argument("--crop-threshold", type=int, default=248, help="Crop white threshold (200–254)")
     cap.add_argument("--crop-margin", type=int, default=10, help="Extra margin (px) around content")
+    cap.add_argument("--workers", type=int, default=1, help="Parallel capture tabs in the same browser session")
 
     # build subcommand
     bld = sub.add_parser("build", help="Build OCR-PDF from images")
@@ -464,6 +562,7 @@ def main():
             crop_margin=args.crop_margin,
             click_next_selector=args.click_next_selector,
             advance_with_keys=args.advance_with_keys,
+            workers=args.workers,
         )
 
     elif args.cmd == "build":
@@ -0,0 +1,1784 @@
+"""
+Unit tests for edubase_cli.py
+
+Run with: pytest tests/
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+from decimal import Decimal
+import pytest
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import pikepdf
+from playwright.sync_api import Error as PWError, TimeoutError as PWTimeout
+from click.testing import CliRunner
+
+# Import functions from main script
+import sys
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import edubase_cli
+from edubase_cli import (
+    wait_for_page_ready,
+    wait_for_page_ready_async,
+    store_screenshot,
+    navigate_to_page,
+    capture_book,
+    capture_book_async,
+    page_path,
+    list_page_files,
+    reap_postprocess,
+    default_postprocess_workers,
+    load_manifest,
+    record_page,
+    page_is_done,
+    adopt_existing_pages,
+    list_images,
+    manifest_mismatches,
+    MANIFEST_NAME,
+    frame_dhash,
+    hamming_distance,
+    is_stale_frame,
+    AdaptiveDelay,
+    retry_delay,
+    MAX_RETRY_BACKOFF_S,
+    RequestBlocker,
+    parse_page_size,
+    capture_geometry,
+    fitted_viewport,
+    screenshot_options,
+    manifest_dpi,
+    detect_viewer_box,
+    DETECT_VIEWER_JS,
+    load_jobs,
+    parse_shard,
+    shard_range,
+    shard_dir_name,
+    write_shard_info,
+    plan_merge,
+    merge_shards,
+    read_daemon_endpoint,
+    close_capture_context,
+    session_is_valid,
+    apply_viewer_setup,
+    EXIT_SESSION_INVALID,
+    preprocess_images,
+    sample_pages,
+    book_crop_box,
+    prune_cache,
+    cache_entries,
+    build_pdf_from_images,
+    PdfPageWriter,
+    classify_page,
+    write_build_report,
+    mrc_layers,
+    BuildWorkspace,
+    reap_stale_workspaces,
+)
+
+
+class FakePage:
+    """Minimal stand-in for a Playwright page"""
+
+    def __init__(self, frames=None):
+        self.frames = list(frames or [])
+        self.load_states = []
+
+    def screenshot(self, **kwargs):
+        return self.frames.pop(0) if len(self.frames) > 1 else self.frames[0]
+
+    def wait_for_load_state(self, state, timeout=None):
+        self.load_states.append(state)
+
+
+class TestReadinessProbes:
+    """Test render-readiness detection"""
+
+    @pytest.fixture(autouse=True)
+    def no_sleep(self, monkeypatch):
+        monkeypatch.setattr(edubase_cli.time, "sleep", lambda s: None)
+
+    def test_fixed_probe_waits_for_networkidle(self):
+        """Test that the fixed probe keeps the legacy networkidle wait"""
+        page = FakePage()
+        assert wait_for_page_ready(page, 1, 'fixed', timeout_s=1.0)
+        assert page.load_states == ["networkidle"]
+
+    def test_frames_probe_returns_on_stable_frame(self):
+        """Test that two identical frames count as rendered"""
+        page = FakePage(frames=[b"a", b"b", b"c", b"c"])
+        assert wait_for_page_ready(page, 1, 'frames', timeout_s=5.0)
+        assert page.frames == [b"c"]
+
+    def test_frames_probe_times_out(self, monkeypatch):
+        """Test that a page that never settles reports not ready"""
+        clock = iter(range(100))
+        monkeypatch.setattr(edubase_cli.time, "monotonic", lambda: next(clock))
+        page = FakePage(frames=[bytes([n]) for n in range(50)])
+        assert not wait_for_page_ready(page, 1, 'frames', timeout_s=3.0)
+
+    def test_unknown_probe_raises(self):
+        """Test that an unknown probe name is rejected"""
+        with pytest.raises(ValueError):
+            wait_for_page_ready(FakePage(), 1, 'magic', timeout_s=1.0)
+
+
+class FakeNavPage:
+    """Records in-app jumps and full navigations"""
+
+    class Response:
+        status = 200
+
+    def __init__(self, hash_result):
+        self.hash_result = hash_result
+        self.evaluated = []
+        self.visited = []
+
+    def evaluate(self, script, arg=None):
+        self.evaluated.append(arg)
+        if isinstance(self.hash_result, Exception):
+            raise self.hash_result
+        return self.hash_result
+
+    def goto(self, url, **kwargs):
+        self.visited.append(url)
+        return self.Response()
+
+
+class TestNavigation:
+    """Test page navigation strategies"""
+
+    def test_hash_jump_avoids_goto(self):
+        """Test that a hash jump returns at once without page.goto"""
+        page = FakeNavPage(hash_result=True)
+        assert navigate_to_page(page, "60505", 23, 'hash') == (True, None)
+        assert page.evaluated == ["#doc/60505/23"]
+        assert page.visited == []
+
+    def test_hash_already_there(self):
+        """Test that no jump is reported when the viewer already shows the page"""
+        page = FakeNavPage(hash_result=False)
+        assert navigate_to_page(page, "60505", 23, 'hash') == (False, None)
+        assert page.visited == []
+
+    def test_hash_jump_error_falls_back_to_goto(self):
+        """Test the goto fallback when evaluate raises"""
+        page = FakeNavPage(hash_result=RuntimeError("context destroyed"))
+        assert navigate_to_page(page, "60505", 7, 'hash') == (False, 200)
+        assert page.visited == ["https://app.edubase.ch/#doc/60505/7"]
+
+    def test_goto_strategy(self):
+        """Test that the goto strategy never touches the hash"""
+        page = FakeNavPage(hash_result=True)
+        assert navigate_to_page(page, "60505", 2, 'goto') == (False, 200)
+        assert page.evaluated == []
+        assert page.visited == ["https://app.edubase.ch/#doc/60505/2"]
+
+
+# Just enough DOM for the viewer scripts: one rendered canvas on page 1;
+# `onJump` is what the viewer does when location.hash changes.
+FAKE_VIEWER_JS = """
+class El {
+    constructor(tagName, props) {
+        Object.assign(this, {tagName, dataset: {}, offsetWidth: 600, offsetHeight: 800, width: 1200, height: 1600,
+                             src: '', currentSrc: '', complete: true, naturalWidth: 1200}, props);
+    }
+}
+const elements = [new El('CANVAS')];
+let hash = '#doc/60505/1';
+let onJump = () => {};
+global.document = {
+    readyState: 'complete',
+    get images() { return elements.filter(el => el.tagName === 'IMG'); },
+    querySelectorAll: selector => selector === 'canvas' ? elements.filter(el => el.tagName === 'CANVAS') : elements.slice(),
+    createElement: () => {
+        let source;
+        return {getContext: () => ({drawImage: el => { source = el; }, getImageData: () => ({data: [source.pixels || 0]})})};
+    },
+};
+global.window = {location: {get hash() { return hash; }, set hash(value) { hash = value; onJump(); }}};
+const report = value => console.log(JSON.stringify(value));
+"""
+
+
+def run_in_fake_viewer(program):
+    """Run JS against FAKE_VIEWER_JS in Playwright's bundled node; returns what it reported"""
+    driver = edubase_cli.playwright_driver()[0]
+    if len(driver) != 2 or not Path(driver[0]).exists():
+        pytest.skip("Playwright's bundled node not installed")
+    node = driver[0]
+    result = subprocess.run([str(node), "-e", FAKE_VIEWER_JS + program], capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
+    return [json.loads(line) for line in result.stdout.splitlines()]
+
+
+class TestRenderMarks:
+    """Test HASH_NAV_JS and DOM_READY_JS against a fake viewer"""
+
+    def jump(self, on_jump, setup=""):
+        """Jump to page 2 and report the dom probe right away and after the viewer had 100 ms"""
+        ready = "(" + edubase_cli.DOM_READY_JS + ")"
+        return run_in_fake_viewer(
+            setup + "onJump = " + on_jump + ";\n"
+            "report((" + edubase_cli.HASH_NAV_JS + ")('#doc/60505/2'));\n"
+            "report(" + ready + "(2));\n"
+            "setTimeout(() => report(" + ready + "(2)), 100);\n"
+        )
+
+    def test_ignored_jump(self):
+        """Test that a jump the viewer ignores never passes the probe although the hash changed"""
+        assert self.jump("() => {}") == [True, False, False]
+
+    def test_new_canvas(self):
+        """Test that a canvas painted after the jump passes the probe, the old one does not"""
+        assert self.jump("() => setTimeout(() => elements.push(new El('CANVAS')), 50)") == [True, False, True]
+
+    def test_resized_canvas(self):
+        """Test that a canvas reused at a new size passes the probe"""
+        assert self.jump("() => setTimeout(() => { elements[0].height = 1700; }, 50)") == [True, False, True]
+
+    def test_redrawn_canvas(self):
+        """Test that a canvas redrawn at the same size passes the probe"""
+        assert self.jump("() => setTimeout(() => { elements[0].pixels = 2; }, 50)") == [True, False, True]
+
+    def test_new_image_source(self):
+        """Test that an img switching to the next page's source passes the probe"""
+        assert self.jump(
+            "() => setTimeout(() => { elements[0].src = 'page2.png'; }, 50)",
+            setup="elements[0] = new El('IMG', {src: 'page1.png'});\n",
+        ) == [True, False, True]
+
+    def test_hash_already_there(self):
+        """Test that the page the viewer already shows is ready without a repaint"""
+        ready = "(" + edubase_cli.DOM_READY_JS + ")"
+        assert run_in_fake_viewer(
+            "report(" + ready + "(1));\n"
+            "report((" + edubase_cli.HASH_NAV_JS + ")('#doc/60505/1'));\n"
+            "report(" + ready + "(1));\n"
+        ) == [True, False, True]
+
+
+class FakeViewerTab:
+    """Sync Playwright tab showing the book page of its last goto or hash jump
+
+    A page takes the context's render_s to paint after the navigation, in
+    parallel with the other tabs, as in a real browser.
+    """
+
+    viewport_size = {'width': 1280, 'height': 900}
+
+    def __init__(self, context):
+        self.context = context
+        self.url = ""
+        self.shown = None
+        self.painted_at = 0.0
+        self.closed = False
+
+    def show(self, index):
+        self.shown = index
+        self.painted_at = time.monotonic() + self.context.render_s
+
+    def goto(self, url, **kwargs):
+        self.url = url
+        self.show(int(url.rsplit("/", 1)[1]) if url.rsplit("/", 1)[1].isdigit() else None)
+        return FakeNavPage.Response()
+
+    def wait_for_load_state(self, state, timeout=None):
+        pass
+
+    def evaluate(self, script, arg=None):
+        if script == edubase_cli.HASH_NAV_JS:
+            if not self.context.ignore_jumps:
+                self.show(int(arg.rsplit("/", 1)[1]))
+            return True
+        return None
+
+    def wait_for_function(self, expression, arg=None, timeout=None, polling=None):
+        errors = self.context.render_errors.get(self.shown)
+        if errors:
+            self.context.failures.append((self, self.shown))
+            raise errors.pop(0)
+        if self.shown != arg:
+            raise PWTimeout("viewer still shows another page")
+        started = time.monotonic()
+        time.sleep(max(0.0, self.painted_at - started))
+        self.context.renders.append((self.painted_at - self.context.render_s, self.painted_at))
+
+    def screenshot(self, **kwargs):
+        self.context.shots.append((self, self.shown))
+        return f"page {self.shown}".encode()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeViewerContext:
+    """Browser context whose tabs render pages instantly unless render_errors or render_s say otherwise"""
+
+    def __init__(self, render_errors=None, render_s=0.0, ignore_jumps=False):
+        self.render_errors = render_errors or {}
+        self.render_s = render_s
+        self.ignore_jumps = ignore_jumps
+        self.shots = []
+        self.failures = []
+        self.renders = []
+        self.tabs = []
+        self.pages = [self.new_page()]
+
+    def new_page(self):
+        tab = FakeViewerTab(self)
+        self.tabs.append(tab)
+        return tab
+
+
+def run_capture_book(context, out_dir, **overrides):
+    options = dict(
+        book_url="https://app.edubase.ch/#doc/60505/1", book_id="60505", total_pages=6, out_dir=out_dir,
+        start_index=1, manifest={}, retry_pages=None, rate=AdaptiveDelay(0), blocker=RequestBlocker('off'),
+        geometry=None, crop=False, crop_threshold=250, crop_margin=0, workers=1, ready_probe='dom',
+        ready_timeout=1.0, ready_js=None, nav_strategy='goto', image_format='png', compress_level=None,
+        postprocess_workers=0, stale_retries=0, stale_threshold=0, max_attempts=2, retry_backoff_s=0.0,
+        target_dpi=None, viewer_selector=None, fullpage=True, prompt=False,
+    )
+    options.update(overrides)
+    return capture_book(context, **options)
+
+
+class TestCaptureLoop:
+    """Test the sync capture loop against fake tabs"""
+
+    @pytest.fixture
+    def out_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield Path(tmpdir)
+
+    def test_render_error_is_a_page_failure(self, out_dir):
+        """Test that a non-timeout Playwright error while waiting is retried, then failed, not fatal"""
+        context = FakeViewerContext(render_errors={
+            3: [PWError("Execution context was destroyed")],
+            5: [PWError("Target closed"), PWError("Target closed")],
+        })
+        captured, skipped, failed = run_capture_book(context, out_dir)
+        assert (captured, skipped, failed) == (5, 0, [5])
+        assert (out_dir / "page_0003.png").read_bytes() == b"page 3"
+        assert not (out_dir / "page_0005.png").exists()
+        assert load_manifest(out_dir)[5]['status'] == 'failed'
+
+    def test_tabs_share_the_queue(self, out_dir):
+        """Test that three tabs capture every page once and their failures end up in one list"""
+        context = FakeViewerContext(render_errors={4: [PWError("Target closed")], 8: [PWError("Target closed")]})
+        captured, skipped, failed = run_capture_book(context, out_dir, total_pages=9, workers=3, max_attempts=1)
+        assert (captured, skipped) == (7, 0)
+        assert sorted(failed) == [4, 8]
+        assert len({tab for tab, _ in context.failures}) == 2  # Failed on different tabs
+        shot_pages = [page for _, page in context.shots]
+        assert sorted(shot_pages) == [1, 2, 3, 5, 6, 7, 9]
+        assert {tab for tab, _ in context.shots} == set(context.tabs)
+        for i in shot_pages:
+            assert (out_dir / f"page_{i:04d}.png").read_bytes() == f"page {i}".encode()
+        assert all(tab.closed for tab in context.tabs[1:]) and not context.tabs[0].closed
+
+
+    def test_hash_jump_renders_overlap(self, out_dir):
+        """Test that hash jumps return at once, so the tabs' pages render in parallel"""
+        context = FakeViewerContext(render_s=0.2)
+        start = time.monotonic()
+        captured, skipped, failed = run_capture_book(context, out_dir, workers=3, nav_strategy='hash')
+        elapsed = time.monotonic() - start
+        assert (captured, skipped, failed) == (6, 0, [])
+        overlap = max(sum(1 for s, e in context.renders if s <= t < e) for t, _ in context.renders)
+        assert overlap == 3
+        assert elapsed < 5 * 0.2  # One after another the five new pages would take 1 s
+
+    def test_ignored_hash_jump_reloads(self, out_dir):
+        """Test that a page whose jump the viewer ignores is loaded with goto once the probe times out"""
+        context = FakeViewerContext(ignore_jumps=True)
+        captured, skipped, failed = run_capture_book(context, out_dir, workers=2, nav_strategy='hash')
+        assert (captured, skipped, failed) == (6, 0, [])
+        assert sorted(page for _, page in context.shots) == [1, 2, 3, 4, 5, 6]
+        for i in range(1, 7):
+            assert (out_dir / f"page_{i:04d}.png").read_bytes() == f"page {i}".encode()
+
+
+    def test_aborted_book_releases_tabs_and_pool(self, out_dir, monkeypatch):
+        """Test that a book aborted mid-capture closes its worker tabs and pool before the next book"""
+        context = FakeViewerContext()
+        pools = []
+        open_tabs = []
+
+        class FakePool(ThreadPoolExecutor):
+            def __init__(self, workers):
+                super().__init__(workers)
+                self.cancelled = None
+                pools.append(self)
+
+            def shutdown(self, wait=True, cancel_futures=False):
+                self.cancelled = cancel_futures
+                super().shutdown(wait, cancel_futures=cancel_futures)
+
+        open_tabs_original = edubase_cli.open_worker_tabs
+
+        def open_worker_tabs(context, first_page, book_url, workers):
+            open_tabs.append(sum(not tab.closed for tab in context.tabs))
+            return open_tabs_original(context, first_page, book_url, workers)
+
+        progress = edubase_cli.capture_progress
+        calls = []
+
+        def capture_progress():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError("viewer crashed")
+            return progress()
+
+        monkeypatch.setattr(edubase_cli, "sync_playwright", contextmanager(lambda: (yield None)))
+        monkeypatch.setattr(edubase_cli, "launch_capture_context", lambda *args, **kwargs: context)
+        monkeypatch.setattr(edubase_cli, "close_capture_context", lambda context, session_path: None)
+        monkeypatch.setattr(edubase_cli, "ProcessPoolExecutor", FakePool)
+        monkeypatch.setattr(edubase_cli, "open_worker_tabs", open_worker_tabs)
+        monkeypatch.setattr(edubase_cli, "capture_progress", capture_progress)
+        monkeypatch.setattr(edubase_cli.console, "input", lambda prompt="": "")
+        jobs = [
+            {'url': f"https://app.edubase.ch/#doc/{book}/1", 'book_id': str(book), 'pages': 3,
+             'out_dir': out_dir / str(book)}
+            for book in (1, 2)
+        ]
+        results = edubase_cli.capture_batch(
+            jobs, per_page_delay_ms=0, fullpage=True, crop=False, crop_threshold=250, crop_margin=0,
+            workers=3, nav_strategy='goto', postprocess_workers=1, stale_retries=0,
+        )
+        assert results[0]['error'] == "viewer crashed"
+        assert results[1]['captured'] == 3 and results[1]['error'] is None
+        assert open_tabs == [1, 1]
+        assert [pool.cancelled for pool in pools] == [True, True]
+        assert all(tab.closed for tab in context.tabs[1:]) and not context.tabs[0].closed
+
+
+class FakeAsyncViewerTab(FakeViewerTab):
+    """Async variant of FakeViewerTab"""
+
+    async def goto(self, url, **kwargs):
+        return FakeViewerTab.goto(self, url, **kwargs)
+
+    async def wait_for_load_state(self, state, timeout=None):
+        pass
+
+    async def evaluate(self, script, arg=None):
+        return FakeViewerTab.evaluate(self, script, arg)
+
+    async def wait_for_function(self, expression, arg=None, timeout=None, polling=None):
+        FakeViewerTab.wait_for_function(self, expression, arg, timeout, polling)
+
+    async def screenshot(self, **kwargs):
+        return FakeViewerTab.screenshot(self)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeAsyncViewerContext:
+    """Async variant of FakeViewerContext"""
+
+    def __init__(self, render_errors=None, ignore_jumps=False):
+        self.render_errors = render_errors or {}
+        self.render_s = 0.0
+        self.ignore_jumps = ignore_jumps
+        self.shots = []
+        self.failures = []
+        self.renders = []
+        self.tabs = []
+        self.pages = [self.add_tab()]
+
+    def add_tab(self):
+        tab = FakeAsyncViewerTab(self)
+        self.tabs.append(tab)
+        return tab
+
+    async def new_page(self):
+        return self.add_tab()
+
+
+class TestAsyncCaptureLoop:
+    """Test the async capture engine against fake tabs"""
+
+    @pytest.fixture
+    def out_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield Path(tmpdir)
+
+    def run(self, context, out_dir, **overrides):
+        options = dict(
+            book_url="https://app.edubase.ch/#doc/60505/1", book_id="60505", total_pages=8, out_dir=out_dir,
+            start_index=1, manifest={}, retry_pages=None, rate=AdaptiveDelay(0), blocker=RequestBlocker('off'),
+            geometry=None, crop=False, crop_threshold=250, crop_margin=0, workers=2, ready_probe='dom',
+            ready_timeout=1.0, ready_js=None, nav_strategy='goto', image_format='png', compress_level=None,
+            postprocess_workers=0, stale_retries=0, stale_threshold=0, max_attempts=2, retry_backoff_s=0.0,
+            target_dpi=None, viewer_selector=None, fullpage=True, prompt=False,
+        )
+        options.update(overrides)
+        return asyncio.run(asyncio.wait_for(capture_book_async(context, **options), timeout=20))
+
+    def test_success_retry_and_failure(self, out_dir):
+        """Test that a page failing once is retried and one failing every attempt ends up failed"""
+        context = FakeAsyncViewerContext(render_errors={
+            3: [PWError("Execution context was destroyed")],
+            6: [PWError("Target closed"), PWError("Target closed")],
+        })
+        captured, skipped, failed = self.run(context, out_dir)
+        assert (captured, skipped, failed) == (7, 0, [6])
+        assert sorted(p.name for p in out_dir.glob("page_*")) == [f"page_{i:04d}.png" for i in range(1, 9) if i != 6]
+        assert (out_dir / "page_0003.png").read_bytes() == b"page 3"
+        manifest = load_manifest(out_dir)
+        assert manifest[3]['status'] == 'done' and manifest[6]['status'] == 'failed'
+        assert [page for _, page in context.failures] == [3, 6, 6]
+        assert {tab for tab, _ in context.shots} == set(context.tabs)
+        assert context.tabs[1].closed
+
+    def test_ignored_hash_jump_reloads(self, out_dir):
+        """Test the goto fallback after an ignored hash jump in the async engine"""
+        context = FakeAsyncViewerContext(ignore_jumps=True)
+        captured, skipped, failed = self.run(context, out_dir, nav_strategy='hash')
+        assert (captured, skipped, failed) == (8, 0, [])
+        for i in range(1, 9):
+            assert (out_dir / f"page_{i:04d}.png").read_bytes() == f"page {i}".encode()
+
+    def test_failed_write_is_retried_and_writes_are_bounded(self, out_dir, monkeypatch):
+        """Test that at most 2 x workers writes are pending and a failed write is captured again"""
+        store = edubase_cli.store_screenshot
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0, 'failures': 0}
+
+        def slow_store(data, filename, *args):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            try:
+                time.sleep(0.05)
+                if filename.name == "page_0002.png" and not state['failures']:
+                    state['failures'] += 1
+                    raise OSError("disk full")
+                return store(data, filename, *args)
+            finally:
+                with lock:
+                    state['running'] -= 1
+
+        monkeypatch.setattr(edubase_cli, "store_screenshot", slow_store)
+        captured, skipped, failed = self.run(FakeAsyncViewerContext(), out_dir, workers=1)
+        assert (captured, skipped, failed) == (8, 0, [])
+        assert 1 < state['peak'] <= 2
+        assert state['failures'] == 1
+        assert load_manifest(out_dir)[2]['status'] == 'done'
+
+
+class FakeAsyncPage(FakePage):
+    """Async variant of FakePage"""
+
+    async def screenshot(self, **kwargs):
+        return FakePage.screenshot(self, **kwargs)
+
+
+class TestAsyncEngine:
+    """Test async capture helpers"""
+
+    def test_async_frames_probe(self, monkeypatch):
+        """Test that the async probe matches the sync frame logic"""
+        monkeypatch.setattr(edubase_cli, "FRAME_POLL_S", 0)
+        page = FakeAsyncPage(frames=[b"a", b"b", b"b"])
+        assert asyncio.run(wait_for_page_ready_async(page, 1, 'frames', timeout_s=5.0))
+
+
+class TestStoreScreenshot:
+    """Test writing captured screenshots"""
+
+    @staticmethod
+    def png_bytes(img):
+        buf = BytesIO()
+        img.save(buf, format="PNG")
+        return buf.getvalue()
+
+    def test_store_without_crop(self):
+        """Test that bytes are written unchanged without crop"""
+        data = self.png_bytes(Image.new('RGB', (40, 30), color='white'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = Path(tmpdir) / "page_0001.png"
+            store_screenshot(data, target, crop=False, crop_threshold=248, crop_margin=0)
+            assert target.read_bytes() == data
+
+    def test_store_with_crop(self):
+        """Test that white margins are cropped before saving"""
+        img = Image.new('RGB', (100, 100), color='white')
+        img.paste((0, 0, 0), (20, 30, 60, 70))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = Path(tmpdir) / "page_0001.png"
+            store_screenshot(self.png_bytes(img), target, crop=True, crop_threshold=248, crop_margin=0)
+            with Image.open(target) as saved:
+                assert saved.size == (40, 40)
+
+    @pytest.mark.parametrize("image_format,pil_format", [
+        ('png', 'PNG'), ('jpeg', 'JPEG'), ('webp', 'WEBP'),
+    ])
+    def test_store_in_other_codecs(self, image_format, pil_format):
+        """Test that the configured codec is used for the single write"""
+        data = self.png_bytes(Image.new('RGB', (40, 30), color='red'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = page_path(Path(tmpdir), 3, image_format)
+            store_screenshot(data, target, crop=False, crop_threshold=248, crop_margin=0,
+                             image_format=image_format, compress_level=1)
+            with Image.open(target) as saved:
+                assert saved.format == pil_format
+                assert saved.size == (40, 30)
+
+    def test_store_leaves_no_partial_file(self):
+        """Test that the atomic write cleans up its temporary file"""
+        data = self.png_bytes(Image.new('RGB', (10, 10), color='red'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store_screenshot(data, Path(tmpdir) / "page_0001.png", crop=True, crop_threshold=248, crop_margin=0)
+            assert [f.name for f in Path(tmpdir).iterdir()] == ["page_0001.png"]
+
+    def test_page_files_across_formats(self):
+        """Test that page files are found regardless of codec"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_dir = Path(tmpdir)
+            assert page_path(out_dir, 7, 'jpeg').name == "page_0007.jpg"
+            for n, fmt in enumerate(['png', 'jpeg', 'webp'], start=1):
+                page_path(out_dir, n, fmt).write_bytes(b"x")
+            (out_dir / "notes.txt").write_text("ignore")
+            assert len(list_page_files(out_dir)) == 3
+
+    @pytest.mark.parametrize("image_format,level", [('png', 10), ('webp', 7), ('jpeg', 0), ('jpeg', 96)])
+    def test_compress_level_out_of_range(self, image_format, level, monkeypatch):
+        """Test that a --compress-level the codec rejects stops capture before the browser starts"""
+        monkeypatch.setattr(edubase_cli, "capture_pages", lambda *args, **kwargs: pytest.fail("capture started"))
+        result = CliRunner().invoke(edubase_cli.cli, [
+            "capture", "--book-url", "https://app.edubase.ch/#doc/1/1", "--pages", "3",
+            "--image-format", image_format, "--compress-level", str(level),
+        ])
+        assert result.exit_code == 2
+        assert "--compress-level" in result.output and "out of range" in result.output
+
+
+class TestPostprocessPool:
+    """Test the producer/consumer post-processing queue"""
+
+    def test_default_workers(self):
+        """Test that plain PNG pass-through stays inline"""
+        assert default_postprocess_workers(False, 'png', None) == 0
+        assert default_postprocess_workers(True, 'png', None) >= 1
+
+    def test_reap_applies_backpressure(self):
+        """Test that reaping blocks until the queue is below the limit"""
+        gate = threading.Event()
+        with ThreadPoolExecutor(2) as pool:
+            in_flight = {pool.submit(gate.wait): n for n in range(3)}
+            assert reap_postprocess(in_flight, max_pending=3) == []
+            gate.set()
+            finished = reap_postprocess(in_flight, max_pending=0)
+        assert sorted(i for i, _, _ in finished) == [0, 1, 2]
+        assert in_flight == {}
+
+    def test_reap_reports_errors(self):
+        """Test that failed jobs are returned with their exception"""
+        with ThreadPoolExecutor(1) as pool:
+            in_flight = {pool.submit(int, "not a number"): 5}
+            [(index, result, error)] = reap_postprocess(in_flight, max_pending=0)
+        assert index == 5
+        assert result is None
+        assert isinstance(error, ValueError)
+
+    def test_store_in_process_pool(self):
+        """Test that store_screenshot runs in worker processes"""
+        data = TestStoreScreenshot.png_bytes(Image.new('RGB', (20, 20), color='blue'))
+        with tempfile.TemporaryDirectory() as tmpdir, ProcessPoolExecutor(1) as pool:
+            target = Path(tmpdir) / "page_0001.webp"
+            in_flight = {pool.submit(store_screenshot, data, target, False, 248, 0, 'webp', None): 1}
+            [(index, result, error)] = reap_postprocess(in_flight, max_pending=0)
+            assert (index, error) == (1, None)
+            assert result['file'] == "page_0001.webp"
+            assert result['bytes'] == target.stat().st_size
+
+
+
+class TestCaptureManifest:
+    """Test the per-page capture journal"""
+
+    @pytest.fixture
+    def out_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield Path(tmpdir)
+
+    @staticmethod
+    def write_page(out_dir, index, data=b"pixels"):
+        name = f"page_{index:04d}.png"
+        (out_dir / name).write_bytes(data)
+        return {'file': name, 'sha256': 'x', 'bytes': len(data)}
+
+    def test_latest_record_wins(self, out_dir):
+        """Test that replaying the journal keeps the last state per page"""
+        manifest = {}
+        record_page(out_dir, manifest, 3, 'failed', error=RuntimeError("timeout"))
+        record_page(out_dir, manifest, 3, 'done', result=self.write_page(out_dir, 3),
+                    timings={'nav_s': 0.1234, 'render_s': 0.5, 'shot_s': 0.2})
+        loaded = load_manifest(out_dir)
+        assert loaded[3]['status'] == 'done'
+        assert loaded[3]['attempts'] == 2
+        assert loaded[3]['nav_s'] == 0.123
+
+    def test_truncated_line_is_ignored(self, out_dir):
+        """Test that a crash mid-append does not break loading"""
+        manifest = {}
+        record_page(out_dir, manifest, 1, 'done', result=self.write_page(out_dir, 1))
+        with open(out_dir / MANIFEST_NAME, 'a') as f:
+            f.write('{"page": 2, "sta')
+        assert list(load_manifest(out_dir)) == [1]
+
+    def test_page_is_done_checks_file(self, out_dir):
+        """Test that missing or truncated files are not treated as done"""
+        manifest = {}
+        record_page(out_dir, manifest, 1, 'done', result=self.write_page(out_dir, 1))
+        record_page(out_dir, manifest, 2, 'done', result=self.write_page(out_dir, 2))
+        (out_dir / "page_0002.png").write_bytes(b"pix")
+        record_page(out_dir, manifest, 4, 'failed')
+        assert page_is_done(out_dir, manifest, 1)
+        assert not page_is_done(out_dir, manifest, 2)
+        assert not page_is_done(out_dir, manifest, 3)
+        assert not page_is_done(out_dir, manifest, 4)
+
+    def test_adopt_existing_pages(self, out_dir):
+        """Test that pre-manifest captures are journaled, empty files skipped"""
+        self.write_page(out_dir, 1)
+        self.write_page(out_dir, 2, data=b"")
+        manifest = {}
+        assert adopt_existing_pages(out_dir, manifest) == 1
+        assert page_is_done(out_dir, manifest, 1)
+        assert 2 not in manifest
+        assert adopt_existing_pages(out_dir, manifest) == 0
+
+    def test_list_images_uses_disk(self, out_dir):
+        """Test that build input is every page on disk and journal disagreements are reported"""
+        manifest = {}
+        for index in [10, 2, 3, 4]:
+            record_page(out_dir, manifest, index, 'done', result=self.write_page(out_dir, index))
+        self.write_page(out_dir, 5)  # not journaled
+        (out_dir / "page_0003.png").write_bytes(b"edited by hand")
+        record_page(out_dir, manifest, 10, 'failed')
+        (out_dir / "page_0004.png").unlink()
+        assert [p.name for p in list_images(out_dir)] == ["page_0002.png", "page_0003.png", "page_0005.png", "page_0010.png"]
+        assert manifest_mismatches(out_dir, list_images(out_dir)) == [
+            "page_0003.png: changed since capture",
+            "page_0005.png: not in the capture journal",
+            "page_0010.png: journaled as failed",
+            "page_0004.png: journaled as done but missing",
+        ]
+        assert manifest_mismatches(out_dir, [out_dir / "page_0002.png"])[0] == "page_0003.png: journaled as done but missing"
+
+
+class TestStaleFrames:
+    """Test perceptual-hash stale frame detection"""
+
+    @staticmethod
+    def text_page(lines, shift=0):
+        """White page with black 'text lines' at the given rows"""
+        img = Image.new('RGB', (400, 560), color='white')
+        for row in lines:
+            img.paste((0, 0, 0), (40 + shift, row, 360, row + 12))
+        return TestStoreScreenshot.png_bytes(img)
+
+    def test_identical_frames_match(self):
+        """Test that a repeated frame has distance 0"""
+        frame = self.text_page([50, 120, 300])
+        assert hamming_distance(frame_dhash(frame), frame_dhash(frame)) == 0
+
+    def test_different_pages_differ(self):
+        """Test that different pages are far apart"""
+        a = frame_dhash(self.text_page([50, 120, 300]))
+        b = frame_dhash(self.text_page([80, 200, 400, 480]))
+        assert hamming_distance(a, b) > 10
+
+    def test_is_stale_frame(self):
+        """Test the comparison against previous-page hashes"""
+        a = frame_dhash(self.text_page([50, 120, 300]))
+        b = frame_dhash(self.text_page([80, 200, 400, 480]))
+        assert is_stale_frame(a, [None, a], threshold=2)
+        assert not is_stale_frame(a, [b, None], threshold=2)
+        assert not is_stale_frame(a, [None, None], threshold=2)
+
+    def test_stale_check_uses_thumbnails(self, monkeypatch):
+        """Test that stale frames are judged on CSS-scale JPEG thumbnails and the full screenshot is taken once"""
+        monkeypatch.setattr(edubase_cli, "STALE_REWAIT_S", 0)
+        old_page = frame_dhash(self.text_page([50, 120, 300]))
+        thumbnails = [self.text_page([50, 120, 300]), self.text_page([80, 200, 400, 480])]
+        shots = []
+
+        class Page:
+            def screenshot(self, **kwargs):
+                shots.append(kwargs)
+                return thumbnails.pop(0) if kwargs.get('scale') == 'css' else b"full"
+
+            def wait_for_function(self, expression, arg=None, timeout=None, polling=None):
+                pass
+
+        class Run:
+            def is_stale(self, i, frame_hash, last_hash, threshold):
+                return is_stale_frame(frame_hash, [last_hash], threshold)
+
+            def record_frame(self, i, frame_hash, last_hash, retries, threshold):
+                return {'stale_retries': retries}
+
+        clip = {'x': 0, 'y': 0, 'width': 400, 'height': 560}
+        data, frame_hash, fields = edubase_cli.screenshot_page(
+            Page(), 2, clip, Run(), old_page, 2, 2, 'dom', 1.0, None,
+        )
+        assert data == b"full" and fields == {'stale_retries': 1}
+        assert [(shot.get('scale'), shot['type']) for shot in shots] == [('css', 'jpeg'), ('css', 'jpeg'), (None, 'png')]
+        assert all(shot['clip'] == clip for shot in shots)
+
+
+
+class TestAdaptiveDelay:
+    """Test the AIMD inter-page delay controller"""
+
+    def test_fixed_delay_never_changes(self):
+        """Test that the controller is inert without --adaptive-delay"""
+        rate = AdaptiveDelay(1500)
+        rate.observe(error=True)
+        rate.observe(status=503)
+        assert rate.delay_ms == 1500
+        assert rate.summary() == "1500 ms (fixed)"
+
+    def test_healthy_pages_shrink_delay(self):
+        """Test the additive decrease down to the floor"""
+        rate = AdaptiveDelay(500, adaptive=True, min_ms=250, step_ms=100)
+        for _ in range(5):
+            rate.observe(nav_s=0.2)
+        assert rate.delay_ms == 250
+
+    def test_errors_back_off(self):
+        """Test the multiplicative increase up to the ceiling"""
+        rate = AdaptiveDelay(1000, adaptive=True, max_ms=3000)
+        assert rate.observe(status=429) == 2000
+        assert rate.observe(error=True) == 3000
+        assert rate.backoffs == 2
+
+    def test_latency_spike_backs_off(self):
+        """Test that a navigation much slower than usual counts as congestion"""
+        rate = AdaptiveDelay(1000, adaptive=True, step_ms=100)
+        for _ in range(4):
+            rate.observe(nav_s=0.1)
+        assert rate.delay_ms == 600
+        assert rate.observe(nav_s=1.0) == 1200
+
+    def test_summary_lists_range(self):
+        """Test that the summary shows the delays that were used"""
+        rate = AdaptiveDelay(1000, adaptive=True, step_ms=100)
+        rate.observe()
+        rate.observe(error=True)
+        assert rate.summary() == "900-1800 ms (avg 1350, final 1800, 1 backoffs)"
+
+
+class TestRetryBackoff:
+    """Test the in-run retry schedule for failed pages"""
+
+    def test_delay_doubles_per_attempt(self):
+        """Test the exponential backoff"""
+        assert [retry_delay(n, 2.0) for n in (1, 2, 3)] == [2.0, 4.0, 8.0]
+
+    def test_delay_is_capped(self):
+        """Test that long failure streaks do not stall the run"""
+        assert retry_delay(20, 2.0) == MAX_RETRY_BACKOFF_S
+
+    def test_failed_attempts_are_counted(self):
+        """Test that every failed attempt is journaled with its count"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_dir = Path(tmpdir)
+            manifest = {}
+            record_page(out_dir, manifest, 3, 'failed', error=TimeoutError("slow"))
+            record_page(out_dir, manifest, 3, 'failed', error=TimeoutError("slow"))
+            assert load_manifest(out_dir)[3]['attempts'] == 2
+
+
+class FakeRoute:
+    """Minimal stand-in for a Playwright Route"""
+
+    def __init__(self, url, resource_type, tab=None):
+        frame = type('Frame', (), {'page': tab})()
+        self.request = type('Request', (), {'url': url, 'resource_type': resource_type, 'frame': frame})()
+        self.outcome = None
+
+    def continue_(self):
+        self.outcome = 'continue'
+
+    def fulfill(self, status, body):
+        self.outcome = f'fulfill {status}'
+
+    def abort(self, error_code):
+        self.outcome = 'abort'
+
+
+class TestRequestBlocker:
+    """Test the context.route blocking policy"""
+
+    def test_trackers_policy(self):
+        """Test that tracker scripts are stubbed and viewer requests pass"""
+        blocker = RequestBlocker('trackers')
+        assert blocker.decide("https://www.googletagmanager.com/gtag/js", 'script') == 'stub'
+        assert blocker.decide("https://www.google-analytics.com/g/collect?v=2", 'ping') == 'abort'
+        assert blocker.decide("https://app.edubase.ch/api/page/12", 'image') is None
+        assert blocker.route_pattern() is blocker.url_re
+
+    def test_lean_policy_blocks_resource_types(self):
+        """Test that lean also drops media and long-polls but never documents"""
+        blocker = RequestBlocker('lean')
+        assert blocker.decide("https://app.edubase.ch/stream", 'eventsource') == 'abort'
+        assert blocker.decide("https://www.doubleclick.net/ad", 'document') is None
+        assert blocker.route_pattern() == '**/*'
+
+    def test_off_with_extra_patterns(self):
+        """Test that --block-url patterns work without a preset"""
+        assert not RequestBlocker('off').enabled
+        blocker = RequestBlocker('off', (r'fonts\.gstatic\.com',))
+        assert blocker.decide("https://fonts.gstatic.com/s/x.woff2", 'font') == 'abort'
+        assert blocker.decide("https://www.google-analytics.com/analytics.js", 'script') is None
+
+    def test_counts_per_tab(self):
+        """Test that blocked requests are counted per tab and reset on take"""
+        blocker = RequestBlocker('trackers')
+        tab_a, tab_b = object(), object()
+        routes = [
+            FakeRoute("https://www.googletagmanager.com/gtag/js", 'script', tab_a),
+            FakeRoute("https://www.google-analytics.com/g/collect?v=2", 'ping', tab_a),
+            FakeRoute("https://static.hotjar.com/c/hotjar.js", 'script', tab_b),
+            FakeRoute("https://app.edubase.ch/api/page/12", 'image', tab_b),
+        ]
+        for route in routes:
+            blocker.handle(route)
+        assert [r.outcome for r in routes] == ['fulfill 204', 'abort', 'fulfill 204', 'continue']
+        assert blocker.take(tab_a) == 2
+        assert blocker.take(tab_a) == 0
+        assert blocker.take(tab_b) == 1
+        assert blocker.summary() == "3 requests (script 2, ping 1)"
+
+    def test_unknown_policy(self):
+        """Test that an unknown policy is rejected"""
+        with pytest.raises(ValueError):
+            RequestBlocker('everything')
+
+
+class TestCaptureGeometry:
+    """Test target-DPI viewport and scale factor selection"""
+
+    def test_parse_page_size(self):
+        """Test named sizes and WIDTHxHEIGHT in mm"""
+        assert parse_page_size("A4") == (210.0, 297.0)
+        assert parse_page_size("170x240") == (170.0, 240.0)
+        with pytest.raises(ValueError):
+            parse_page_size("huge")
+        with pytest.raises(ValueError):
+            parse_page_size("0x240")
+
+    def test_a4_at_300_dpi(self):
+        """Test that an A4 page renders at 2480x3508 device pixels"""
+        geometry = capture_geometry(300, (210.0, 297.0))
+        assert geometry['page_css'] == (794, 1123)
+        scale = geometry['device_scale_factor']
+        assert round(794 * scale) == 2481
+        assert round(1123 * scale) == 3509
+        assert geometry['viewport']['height'] > geometry['page_css'][1]
+
+    def test_fitted_viewport(self):
+        """Test that the viewport is corrected by the measured viewer size"""
+        viewport = {'width': 874, 'height': 1243}
+        box = {'x': 40, 'y': 90, 'width': 760, 'height': 1075}
+        assert fitted_viewport(viewport, box, (794, 1123)) == {'width': 908, 'height': 1291}
+
+    def test_screenshot_options(self):
+        """Test clip vs full-page screenshot arguments"""
+        clip = {'x': 10, 'y': 20, 'width': 794, 'height': 1123}
+        assert screenshot_options(clip) == {'clip': clip, 'type': 'png'}
+        assert screenshot_options(None) == {'full_page': True, 'type': 'png'}
+
+    def test_manifest_dpi(self):
+        """Test that build picks up the capture resolution"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_dir = Path(tmpdir)
+            manifest = {}
+            assert manifest_dpi(out_dir) is None
+            record_page(out_dir, manifest, 1, 'done', result={'file': 'page_0001.png'}, extra={'dpi': 300})
+            record_page(out_dir, manifest, 2, 'failed', error="timeout", extra={'dpi': 150})
+            assert manifest_dpi(out_dir) == 300
+
+
+class FakeViewerPage:
+    """Page stand-in answering viewer-box lookups"""
+
+    def __init__(self, detected=None, located=None):
+        self.detected = detected
+        self.located = located
+        self.selectors = []
+
+    def evaluate(self, expression, arg=None):
+        assert expression == DETECT_VIEWER_JS
+        if isinstance(self.detected, Exception):
+            raise self.detected
+        return self.detected
+
+    def locator(self, selector):
+        self.selectors.append(selector)
+        located = self.located
+        first = type('Locator', (), {'bounding_box': lambda self, timeout=None: located})()
+        return type('Locators', (), {'first': first})()
+
+
+class TestViewerDetection:
+    """Test locating the page element to clip screenshots to"""
+
+    def test_largest_canvas_by_default(self):
+        """Test that the JS detector is used without a selector"""
+        box = {'x': 320, 'y': 64, 'width': 794, 'height': 1010}
+        page = FakeViewerPage(detected=box)
+        assert detect_viewer_box(page) == box
+        assert page.selectors == []
+
+    def test_selector_wins(self):
+        """Test that a configured selector is used instead of detection"""
+        box = {'x': 0, 'y': 50, 'width': 800, 'height': 1000}
+        page = FakeViewerPage(detected={'x': 1, 'y': 1, 'width': 300, 'height': 300}, located=box)
+        assert detect_viewer_box(page, '#viewer canvas') == box
+        assert page.selectors == ['#viewer canvas']
+
+    def test_detection_errors_fall_back(self):
+        """Test that a failing lookup means no clip (full-page capture)"""
+        assert detect_viewer_box(FakeViewerPage(detected=RuntimeError("navigated"))) is None
+
+
+class TestCaptureBatch:
+    """Test the multi-book job file and capture-batch command"""
+
+    @pytest.fixture
+    def tmp(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield Path(tmpdir)
+
+    def test_load_jobs(self, tmp):
+        """Test job lines, comments and default output directories"""
+        job_file = tmp / "books.txt"
+        job_file.write_text(
+            "# Semester 1\n"
+            "https://app.edubase.ch/#doc/60505/1 396\n"
+            "\n"
+            f"https://app.edubase.ch/#doc/70001/1 120 {tmp / 'physik'}\n"
+        )
+        jobs = load_jobs(job_file, tmp / "books")
+        assert [(j['book_id'], j['pages']) for j in jobs] == [('60505', 396), ('70001', 120)]
+        assert jobs[0]['out_dir'] == (tmp / "books" / "book_60505").resolve()
+        assert jobs[1]['out_dir'] == (tmp / "physik").resolve()
+
+    @pytest.mark.parametrize("line", [
+        "https://app.edubase.ch/#doc/60505/1",
+        "https://app.edubase.ch/#doc/60505/1 many",
+        "https://example.com/book 10",
+    ])
+    def test_bad_job_lines(self, tmp, line):
+        """Test that malformed lines are reported with their line number"""
+        job_file = tmp / "books.txt"
+        job_file.write_text(f"# header\n{line}\n")
+        with pytest.raises(ValueError, match=":2:"):
+            load_jobs(job_file, tmp)
+
+    def test_duplicate_output_dir(self, tmp):
+        """Test that two books cannot write into the same directory"""
+        job_file = tmp / "books.txt"
+        job_file.write_text("https://app.edubase.ch/#doc/1/1 5 out\nhttps://app.edubase.ch/#doc/2/1 5 out\n")
+        with pytest.raises(ValueError, match="used twice"):
+            load_jobs(job_file, tmp)
+
+    def test_command_passes_shared_options(self, tmp, monkeypatch):
+        """Test that capture-batch takes the same capture options as capture"""
+        calls = []
+        monkeypatch.setattr(edubase_cli, "capture_batch", lambda jobs, **kw: calls.append((jobs, kw)))
+        job_file = tmp / "books.txt"
+        job_file.write_text("https://app.edubase.ch/#doc/60505/1 3\n")
+        result = CliRunner().invoke(edubase_cli.cli, [
+            "capture-batch", "--jobs", str(job_file), "--out-root", str(tmp), "--workers", "3", "--delay-ms", "500",
+        ])
+        assert result.exit_code == 0, result.output
+        jobs, kwargs = calls[0]
+        assert jobs[0]['pages'] == 3
+        assert kwargs['workers'] == 3
+        assert kwargs['per_page_delay_ms'] == 500
+
+    def test_command_rejects_bad_job_file(self, tmp):
+        """Test that job file errors surface as usage errors"""
+        job_file = tmp / "books.txt"
+        job_file.write_text("# nothing yet\n")
+        result = CliRunner().invoke(edubase_cli.cli, ["capture-batch", "--jobs", str(job_file)])
+        assert result.exit_code == 2
+        assert "lists no books" in result.output
+
+
+class TestSharding:
+    """Test shard page ranges and merge-shards"""
+
+    @pytest.fixture
+    def tmp(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield Path(tmpdir)
+
+    @staticmethod
+    def make_shard(root, k, n, pages, total_pages, content=None, book_url="https://app.edubase.ch/#doc/1/1"):
+        """Write a shard directory with one tiny page file per index"""
+        shard_dir = root / shard_dir_name(k, n)
+        shard_dir.mkdir()
+        write_shard_info(shard_dir, k, n, book_url, min(pages), max(pages), total_pages)
+        manifest = {}
+        for i in pages:
+            data = (content or {}).get(i, f"page {i}".encode())
+            (shard_dir / f"page_{i:04d}.png").write_bytes(data)
+            record_page(shard_dir, manifest, i, 'done', result={
+                'file': f"page_{i:04d}.png", 'sha256': hashlib.sha256(data).hexdigest(), 'bytes': len(data),
+            }, extra={'dhash': f"{i:064x}"})
+        return shard_dir
+
+    def test_parse_shard(self):
+        """Test K/N parsing and range checks"""
+        assert parse_shard("2/4") == (2, 4)
+        for bad in ("0/4", "5/4", "2", "a/b"):
+            with pytest.raises(ValueError):
+                parse_shard(bad)
+
+    @pytest.mark.parametrize("start,total,n", [(1, 396, 4), (1, 10, 3), (50, 100, 7), (1, 2, 3)])
+    def test_shards_cover_every_page_once(self, start, total, n):
+        """Test that the blocks are contiguous, disjoint and complete"""
+        pages = []
+        for k in range(1, n + 1):
+            first, last = shard_range(start, total, k, n)
+            pages.extend(range(first, last + 1))
+        assert pages == list(range(start, total + 1))
+
+    def test_merge_complete_set(self, tmp):
+        """Test that merged pages keep their names and land in the manifest"""
+        a = self.make_shard(tmp, 1, 2, range(1, 4), 5)
+        b = self.make_shard(tmp, 2, 2, range(4, 6), 5)
+        plan = plan_merge([b, a])
+        assert not (plan['gaps'] or plan['conflicts'] or plan['problems'])
+        out_dir = tmp / "merged"
+        assert merge_shards(plan, out_dir) == 5
+        assert [p.name for p in list_images(out_dir)] == [f"page_{i:04d}.png" for i in range(1, 6)]
+        merged = load_manifest(out_dir)
+        assert merged[4]['shard'] == "shard-2-of-2"
+        assert merged[4]['dhash'] == f"{4:064x}"
+        assert page_is_done(out_dir, merged, 4)
+
+    def test_gaps_and_missing_shards(self, tmp):
+        """Test that uncaptured pages and absent shards are reported"""
+        a = self.make_shard(tmp, 1, 3, [1, 3], 6)
+        plan = plan_merge([a])
+        assert plan['gaps'] == [2, 4, 5, 6]
+        assert plan['problems'] == ["Missing shards: [2, 3]"]
+
+    def test_shards_of_different_books(self, tmp):
+        """Test that shards of two books with the same page count are not merged"""
+        a = self.make_shard(tmp, 1, 2, [1, 2], 4)
+        b = self.make_shard(tmp, 2, 2, [3, 4], 4, book_url="https://app.edubase.ch/#doc/2/3")
+        assert plan_merge([a, b])['problems'] == ["Shards come from different books (1, 2)"]
+        (tmp / "other").mkdir()
+        c = self.make_shard(tmp / "other", 2, 2, [3, 4], 4, book_url="https://app.edubase.ch/#doc/1/3")
+        assert plan_merge([a, c])['problems'] == []
+
+    def test_incomplete_shard_metadata(self, tmp):
+        """Test that a shard.json missing keys is reported, not a KeyError"""
+        a = self.make_shard(tmp, 1, 2, [1, 2], 4)
+        b = self.make_shard(tmp, 2, 2, [3, 4], 4)
+        (b / "shard.json").write_text(json.dumps({'shard': 2, 'book_url': "https://app.edubase.ch/#doc/1/3"}))
+        plan = plan_merge([a, b])
+        assert plan['problems'] == [
+            f"Incomplete shard metadata in {b} (missing shards, first, last, total_pages)",
+            "Missing shards: [2]",
+        ]
+        (b / "shard.json").write_text("[]")
+        assert plan_merge([a, b])['problems'][0].startswith(f"Incomplete shard metadata in {b}")
+
+    def test_duplicates_and_conflicts(self, tmp):
+        """Test that overlapping pages must have identical bytes"""
+        a = self.make_shard(tmp, 1, 2, [1, 2, 3], 4)
+        b = self.make_shard(tmp, 2, 2, [2, 3, 4], 4, content={3: b"different"})
+        plan = plan_merge([a, b])
+        assert plan['duplicates'] == [2]
+        assert plan['conflicts'] == [3]
+        assert plan['pages'][3][0] == a
+
+    def test_command_refuses_gaps(self, tmp):
+        """Test that merge-shards exits non-zero unless --allow-gaps is given"""
+        self.make_shard(tmp, 1, 2, [1, 2], 4)
+        self.make_shard(tmp, 2, 2, [4], 4)
+        result = CliRunner().invoke(edubase_cli.cli, ["merge-shards", "--out-dir", str(tmp)])
+        assert result.exit_code == 1
+        assert not (tmp / "page_0001.png").exists()
+        result = CliRunner().invoke(edubase_cli.cli, ["merge-shards", "--out-dir", str(tmp), "--allow-gaps"])
+        assert result.exit_code == 0, result.output
+        assert sorted(load_manifest(tmp)) == [1, 2, 4]
+
+
+class FakeContext:
+    """Context stand-in recording how it is shut down"""
+
+    def __init__(self, browser=None):
+        self.browser = browser
+        self.calls = []
+
+    def storage_state(self, path):
+        Path(path).write_text('{"cookies": []}')
+        self.calls.append('storage_state')
+
+    def close(self):
+        self.calls.append('close')
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestBrowserDaemon:
+    """Test attaching capture runs to the browser-daemon"""
+
+    @pytest.fixture
+    def paths(self, monkeypatch):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            info = Path(tmpdir) / "daemon.json"
+            session = Path(tmpdir) / "session.json"
+            monkeypatch.setattr(edubase_cli, "DAEMON_INFO_PATH", info)
+            monkeypatch.setattr(edubase_cli, "SESSION_STATE_PATH", session)
+            yield info, session
+
+    def test_endpoint_of_running_daemon(self, paths):
+        """Test that the endpoint is only returned while the server process lives"""
+        info, _ = paths
+        assert read_daemon_endpoint() is None
+        info.write_text(json.dumps({'ws_endpoint': "ws://127.0.0.1:4000/abc", 'pid': os.getpid()}))
+        assert read_daemon_endpoint() == "ws://127.0.0.1:4000/abc"
+        info.write_text("{not json")
+        assert read_daemon_endpoint() is None
+
+    def test_stale_daemon_file(self, paths):
+        """Test that a leftover file from a dead daemon is ignored"""
+        info, _ = paths
+        dead = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead.wait()
+        info.write_text(json.dumps({'ws_endpoint': "ws://127.0.0.1:4000/abc", 'pid': dead.pid}))
+        assert read_daemon_endpoint() is None
+
+    def test_attach_without_daemon_fails(self, paths):
+        """Test that --attach exits non-zero when no daemon runs"""
+        result = CliRunner().invoke(edubase_cli.cli, [
+            "capture", "--attach", "--book-url", "https://app.edubase.ch/#doc/1/1", "--pages", "3",
+        ])
+        assert result.exit_code == 1
+        assert "No browser daemon running" in result.output
+
+    def test_kill_stops_server_and_browser(self, paths):
+        """Test that SIGTERM to the daemon stops the whole server process group and removes its file"""
+        info, _ = paths
+        browser_pid = info.with_name("browser.pid")
+        server = (
+            "import subprocess, sys, time\n"
+            f"child = subprocess.Popen(['sleep', '60'])\n"
+            f"open({str(browser_pid)!r}, 'w').write(str(child.pid))\n"
+            "print('ws://127.0.0.1:4000/abc', flush=True)\n"
+            "time.sleep(60)\n"
+        )
+        daemon = subprocess.Popen([sys.executable, "-c", (
+            "import sys, edubase_cli\n"
+            "from pathlib import Path\n"
+            f"edubase_cli.DAEMON_INFO_PATH = Path({str(info)!r})\n"
+            f"edubase_cli.browser_server_command = lambda config: ([sys.executable, '-c', {server!r}], None)\n"
+            "edubase_cli.run_browser_daemon(4000, headless=True)\n"
+        )], cwd=Path(__file__).parent.parent)
+        try:
+            for _ in range(100):
+                if info.exists() and browser_pid.exists() and browser_pid.read_text():
+                    break
+                time.sleep(0.05)
+            server_pid = json.loads(info.read_text())['pid']
+            daemon.terminate()
+            assert daemon.wait(timeout=15) == 0
+            assert not info.exists()
+            for pid in (server_pid, int(browser_pid.read_text())):
+                stat = Path(f"/proc/{pid}/stat")
+                assert not stat.exists() or stat.read_text().split()[2] == 'Z'  # Gone or awaiting reaping
+        finally:
+            daemon.kill()
+
+    def test_driver_layouts(self, monkeypatch):
+        """Test the (node, cli.js) driver of current Playwright and the wrapper script of older releases"""
+        from playwright._impl import _driver
+        monkeypatch.setattr(_driver, "compute_driver_executable", lambda: ("/pw/node", "/pw/package/cli.js"))
+        command, env = edubase_cli.browser_server_command("/tmp/config.json")
+        assert command == ["/pw/node", "/pw/package/cli.js", "launch-server", "--browser", "firefox",
+                           "--config", "/tmp/config.json"]
+        assert env["PATH"] == os.environ["PATH"]
+        monkeypatch.setattr(_driver, "compute_driver_executable", lambda: Path("/pw/playwright.sh"))
+        assert edubase_cli.browser_server_command("/tmp/config.json")[0][:2] == ["/pw/playwright.sh", "launch-server"]
+
+    def test_unknown_driver_layout(self, paths, monkeypatch):
+        """Test that an unknown Playwright driver layout fails with the version instead of an unpacking error"""
+        from playwright._impl import _driver
+        from playwright._repo_version import version
+        monkeypatch.setattr(_driver, "compute_driver_executable", lambda: ("node", "cli.js", "extra"))
+        result = CliRunner().invoke(edubase_cli.cli, ["browser-daemon", "--headless"])
+        assert result.exit_code == 1
+        assert f"Playwright {version} is not supported" in result.output
+
+    def test_close_keeps_session_on_daemon(self, paths):
+        """Test that attached runs save the login and only disconnect"""
+        _, session = paths
+        browser = FakeBrowser()
+        context = FakeContext(browser)
+        close_capture_context(context, session)
+        assert context.calls == ['storage_state', 'close']
+        assert browser.closed
+        assert session.exists()
+
+    def test_close_persistent_profile(self, paths):
+        """Test that the persistent profile also leaves a session for headless runs"""
+        _, session = paths
+        context = FakeContext()
+        close_capture_context(context, session)
+        assert context.calls == ['storage_state', 'close']
+        assert session.exists()
+
+    def test_close_without_saving(self, paths):
+        """Test that a logged-out session does not overwrite the saved one"""
+        _, session = paths
+        context = FakeContext()
+        close_capture_context(context, None)
+        assert context.calls == ['close']
+        assert not session.exists()
+
+
+class FakeSessionPage:
+    """Page stand-in answering evaluate() with a fixed result"""
+
+    def __init__(self, result):
+        self.result = result
+        self.scripts = []
+
+    def evaluate(self, script, arg=None):
+        self.scripts.append(script)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class TestNonInteractiveCapture:
+    """Test the headless, prompt-free capture mode"""
+
+    def test_session_check(self):
+        """Test that only a page showing the book counts as logged in"""
+        assert session_is_valid(FakeSessionPage(True), "60505")
+        assert not session_is_valid(FakeSessionPage(False), "60505")
+        assert not session_is_valid(FakeSessionPage(RuntimeError("closed")), "60505")
+
+    def test_setup_script_errors_are_not_fatal(self):
+        """Test that a broken --setup-js only warns"""
+        page = FakeSessionPage(RuntimeError("SyntaxError"))
+        apply_viewer_setup(page, "document.body.style.zoom = 2")
+        assert page.scripts == ["document.body.style.zoom = 2"]
+
+    def test_missing_session_exits_3(self, monkeypatch):
+        """Test that --non-interactive without a saved login exits with EXIT_SESSION_INVALID"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(edubase_cli, "SESSION_STATE_PATH", Path(tmpdir) / "session.json")
+            result = CliRunner().invoke(edubase_cli.cli, [
+                "capture", "--non-interactive", "--headless",
+                "--book-url", "https://app.edubase.ch/#doc/1/1", "--pages", "3",
+                "--out-dir", str(Path(tmpdir) / "pages"),
+            ])
+        assert result.exit_code == EXIT_SESSION_INVALID
+        assert "Log in once" in result.output
+
+class TestBuildPreprocessing:
+    """Test the parallel crop/JPEG step of the build"""
+
+    @staticmethod
+    def make_pages(directory: Path, count: int) -> list:
+        pages = []
+        for n in range(1, count + 1):
+            img = Image.new('RGB', (60, 80), color='white')
+            img.paste((n * 20, 0, 0), (10, 10, 30 + n, 40))
+            path = directory / f"page_{n:04d}.png"
+            img.save(path)
+            pages.append(path)
+        return pages
+
+    def test_parallel_matches_serial(self):
+        """Test that workers produce the same files in page order"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            images = self.make_pages(tmp, 5)
+            serial_dir, parallel_dir = tmp / "serial", tmp / "parallel"
+            serial_dir.mkdir()
+            parallel_dir.mkdir()
+            serial = preprocess_images(images, serial_dir, True, 248, 2, 90, workers=1, codec_mode='jpeg')
+            done = []
+            parallel = preprocess_images(images, parallel_dir, True, 248, 2, 90, workers=3,
+                                         on_done=lambda: done.append(1), codec_mode='jpeg')
+            assert [p['file'].name for p in parallel] == [f"page_{n:04d}.jpg" for n in range(1, 6)]
+            assert len(done) == 5
+            for a, b in zip(serial, parallel):
+                assert a['file'].read_bytes() == b['file'].read_bytes()
+
+    def test_worker_errors_propagate(self):
+        """Test that an unreadable page aborts the step"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            images = self.make_pages(tmp, 2)
+            images[1].write_bytes(b"not an image")
+            with pytest.raises(Exception):
+                preprocess_images(images, tmp, False, 248, 0, 90, workers=2)
+
+
+class TestBookCrop:
+    """Test --crop-mode book"""
+
+    @staticmethod
+    def make_page(path: Path, box) -> Path:
+        img = Image.new('RGB', (100, 140), color='white')
+        if box:
+            img.paste((0, 0, 0), box)
+        img.save(path)
+        return path
+
+    def test_sample_spans_book(self):
+        """Test that the sample is evenly spread and keeps first and last page"""
+        pages = [Path(f"page_{n:04d}.png") for n in range(1, 101)]
+        sample = sample_pages(pages, 5)
+        assert [p.name for p in sample] == ["page_0001.png", "page_0026.png", "page_0051.png",
+                                            "page_0075.png", "page_0100.png"]
+        assert sample_pages(pages[:3], 5) == pages[:3]
+
+    def test_percentile_union_ignores_outliers(self):
+        """Test that one full-bleed cover does not widen the book box"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            images = [self.make_page(tmp / "page_0001.png", (0, 0, 100, 140))]
+            for n in range(2, 22):
+                images.append(self.make_page(tmp / f"page_{n:04d}.png", (20 + n % 3, 30, 80 - n % 2, 110)))
+            images.append(self.make_page(tmp / "page_0022.png", None))
+            assert book_crop_box(images, 248, 0, sample_size=22) == (20, 30, 80, 110)
+            assert book_crop_box(images, 248, 5, sample_size=22) == (15, 25, 85, 115)
+            assert book_crop_box(images[-1:], 248, 0) is None
+
+    def test_pages_come_out_uniform(self):
+        """Test that every page is cropped to the same size"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            images = [self.make_page(tmp / f"page_{n:04d}.png", (10 + n, 20, 50 + n, 60 + n))
+                      for n in range(1, 5)]
+            out_dir = tmp / "processed"
+            out_dir.mkdir()
+            box = book_crop_box(images, 248, 2)
+            pages = preprocess_images(images, out_dir, True, 248, 2, 90, workers=1, crop_box=box)
+            sizes = {Image.open(p['file']).size for p in pages}
+            assert sizes == {(box[2] - box[0], box[3] - box[1])}
+
+
+
+class TestPreprocessCache:
+    """Test the content-addressed preprocessing cache"""
+
+    @pytest.fixture
+    def book(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            images = TestBuildPreprocessing.make_pages(tmp, 4)
+            yield tmp, images
+
+    def run(self, tmp, images, name, **kwargs):
+        out_dir = tmp / name
+        out_dir.mkdir()
+        options = dict(crop=True, crop_threshold=248, crop_margin=2, jpeg_quality=90, workers=2)
+        options.update(kwargs)
+        pages = preprocess_images(images, out_dir, cache_dir=tmp / "cache", **options)
+        return [p['file'] for p in pages], sum(p['cached'] for p in pages)
+
+    def test_rebuild_reuses_unchanged_pages(self, book):
+        """Test that only recaptured pages are processed again"""
+        tmp, images = book
+        first, hits = self.run(tmp, images, "first")
+        assert hits == 0
+        Image.new('RGB', (60, 80), color='black').save(images[2])
+        second, hits = self.run(tmp, images, "second")
+        assert hits == 3
+        assert first[0].read_bytes() == second[0].read_bytes()
+        assert first[2].read_bytes() != second[2].read_bytes()
+        assert len(cache_entries(tmp / "cache")) == 5
+
+    def test_parameters_are_part_of_the_key(self, book):
+        """Test that other crop or JPEG settings miss the cache"""
+        tmp, images = book
+        self.run(tmp, images, "first")
+        assert self.run(tmp, images, "margin", crop_margin=5)[1] == 0
+        assert self.run(tmp, images, "quality", jpeg_quality=80)[1] == 0
+        assert self.run(tmp, images, "book", crop_box=(0, 0, 40, 40))[1] == 0
+        assert self.run(tmp, images, "again")[1] == 4
+
+    def test_prune_evicts_least_recently_used(self, book):
+        """Test that eviction removes the oldest-used pages first"""
+        tmp, images = book
+        self.run(tmp, images, "first")
+        paths = [p for p, _ in cache_entries(tmp / "cache")]
+        for n, path in enumerate(paths):
+            os.utime(path, (1000 + n, 1000 + n))
+        newest = paths[0]
+        os.utime(newest, (2000, 2000))  # A cache hit on the oldest page
+        size = newest.stat().st_size
+        removed, freed = prune_cache(tmp / "cache", size)
+        assert removed == 3
+        assert [p for p, _ in cache_entries(tmp / "cache")] == [newest]
+        assert prune_cache(tmp / "cache", 0) == (1, size)
+
+    def test_prune_command(self, book):
+        """Test the cache prune subcommand"""
+        tmp, images = book
+        self.run(tmp, images, "first")
+        result = CliRunner().invoke(edubase_cli.cli, [
+            "cache", "prune", "--cache-dir", str(tmp / "cache"), "--max-size-mb", "0",
+        ])
+        assert result.exit_code == 0
+        assert cache_entries(tmp / "cache") == []
+
+
+
+class TestPdfAssembly:
+    """Test the page-by-page raw PDF writer"""
+
+    def test_pages_in_order_at_dpi(self):
+        """Test that every image becomes one page of the right size, in order"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            images = []
+            for n, mode in enumerate(['RGB', 'L', '1', 'P'], start=1):
+                path = tmp / f"page_{n:04d}.{'jpg' if mode in ('RGB', 'L') else 'png'}"
+                Image.new(mode, (300 * n, 600)).save(path)
+                images.append(path)
+            build_pdf_from_images(images, tmp / "raw.pdf", dpi=300)
+            with pikepdf.open(tmp / "raw.pdf") as pdf:
+                assert pdf.check_pdf_syntax() == []
+                assert [float(page.mediabox[2]) for page in pdf.pages] == [72, 144, 216, 288]
+                assert float(pdf.pages[0].mediabox[3]) == 144
+                decoded = [pikepdf.PdfImage(next(iter(page.get_images().values()))).as_pil_image().size
+                           for page in pdf.pages]
+                assert decoded == [(300 * n, 600) for n in range(1, 5)]
+
+    def test_round_trip(self):
+        """Test that pikepdf reads back every page with its codec's filter and the MRC mask polarity"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            sources = [TestPageCodecs.text_page(), TestPageCodecs.text_page(ink=(200, 30, 30)),
+                       TestMixedRasterContent.boxed_page()]
+            images = []
+            for n, img in enumerate(sources, start=1):
+                images.append(tmp / f"page_{n:04d}.png")
+                img.save(images[-1])
+            out_dir = tmp / "processed"
+            out_dir.mkdir()
+            pages = preprocess_images(images[:2], out_dir, False, 248, 0, 90, workers=1)
+            pages += preprocess_images(images[2:], out_dir, False, 248, 0, 90, workers=1, codec_mode='mrc', dpi=150)
+            photo = tmp / "processed" / "page_0004.jpg"
+            noise = np.random.default_rng(0).integers(0, 256, size=(90, 60, 3), dtype=np.uint8)
+            Image.fromarray(noise).save(photo)
+            files = [p['file'] for p in pages] + [photo]
+            assert [f.suffix for f in files] == [".tif", ".png", ".pdf", ".jpg"]
+
+            build_pdf_from_images(files, tmp / "raw.pdf", dpi=150)
+            with pikepdf.open(tmp / "raw.pdf") as pdf:
+                assert pdf.check_pdf_syntax() == []
+                assert len(pdf.pages) == 4
+                filters = [[pikepdf.PdfImage(image).filters for image in page.Resources.XObject.values()]
+                           for page in pdf.pages]
+                assert filters == [[["/CCITTFaxDecode"]], [["/FlateDecode"]], [["/DCTDecode"], ["/DCTDecode"]],
+                                   [["/DCTDecode"]]]
+                mask = pdf.pages[2].Resources.XObject.Fg.Mask
+                assert mask.ImageMask and pikepdf.PdfImage(mask).filters == ["/CCITTFaxDecode"]
+                assert list(mask.get('/Decode', [0, 1])) == [0, 1]
+                # Sample 0 paints the text colour: it must be where mrc_layers found text
+                expected, _, _ = mrc_layers(sources[2], color=True)
+                decoded = pikepdf.PdfImage(mask).as_pil_image().convert('1')
+                assert np.array_equal(np.asarray(decoded), np.asarray(expected))
+                assert not decoded.getpixel((20, 13)) and decoded.getpixel((20, 20))
+
+    def test_null_and_version(self):
+        """Test that null values survive and a newer source version is declared in the catalog"""
+        with pikepdf.new() as source:
+            source.add_blank_page()
+            source.pages[0].obj.Foo = pikepdf.Array([1, None, pikepdf.Name.X, Decimal("0.5")])
+            buf = BytesIO()
+            writer = PdfPageWriter(buf)
+            writer.add_page(source.pages[0], "1.6")
+            writer.close()
+        with pikepdf.open(BytesIO(buf.getvalue())) as pdf:
+            assert pdf.check_pdf_syntax() == []
+            assert list(pdf.pages[0].obj.Foo) == [1, None, pikepdf.Name.X, Decimal("0.5")]
+            assert pdf.Root.Version == pikepdf.Name("/1.6")
+
+
+
+class TestPageCodecs:
+    """Test the per-page codec selection"""
+
+    @staticmethod
+    def text_page(size=(400, 560), ink=(0, 0, 0)) -> Image.Image:
+        img = Image.new('RGB', size, color='white')
+        for y in range(40, size[1] - 40, 24):
+            img.paste(ink, (40, y, size[0] - 40, y + 8))
+            img.paste((128, 128, 128), (40, y + 8, size[0] - 40, y + 9))  # Anti-aliased edge
+        return img
+
+    def test_classification(self):
+        """Test that each kind of page gets its codec"""
+        assert classify_page(self.text_page()) == 'bilevel'
+        assert classify_page(self.text_page().convert('L')) == 'bilevel'
+        shaded = self.text_page()
+        shaded.paste((210, 210, 210), (40, 200, 360, 400))
+        assert classify_page(shaded) == 'gray'
+        assert classify_page(self.text_page(ink=(200, 30, 30))) == 'palette'
+        noise = np.random.default_rng(0).integers(0, 256, size=(560, 400, 3), dtype=np.uint8)
+        assert classify_page(Image.fromarray(noise)) == 'color'
+
+    def test_codecs_are_written_and_reported(self):
+        """Test that each page is encoded with its codec and listed in the report"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            sources = {'text': self.text_page(), 'heading': self.text_page(ink=(200, 30, 30))}
+            images = []
+            for name, img in sources.items():
+                images.append(tmp / f"{name}.png")
+                img.save(images[-1])
+            out_dir = tmp / "processed"
+            out_dir.mkdir()
+            pages = preprocess_images(images, out_dir, False, 248, 0, 90, workers=1)
+            assert [(p['file'].name, p['codec']) for p in pages] == [("text.tif", 'bilevel'), ("heading.png", 'palette')]
+            with Image.open(pages[0]['file']) as im:
+                assert (im.mode, im.info['compression']) == ('1', 'group4')
+            with Image.open(pages[1]['file']) as im:
+                assert im.mode == 'P'
+            
+            summary = write_build_report(tmp / "book.report.json", pages, {'codec_mode': 'auto'})
+            report = json.loads((tmp / "book.report.json").read_text())
+            assert summary == report['codecs']
+            assert report['codecs']['bilevel'] == {'pages': 1, 'bytes': pages[0]['bytes']}
+            assert [p['file'] for p in report['pages']] == ["text.tif", "heading.png"]
+
+
+class TestMixedRasterContent:
+    """Test --codec mrc"""
+
+    @staticmethod
+    def boxed_page() -> Image.Image:
+        """Red text lines on a yellow box"""
+        img = Image.new('RGB', (120, 180), color=(255, 240, 200))
+        for y in range(12, 168, 12):
+            img.paste((200, 30, 30), (12, y, 108, y + 4))
+        return img
+
+    def test_layers(self):
+        """Test that the mask holds the text and each layer its own colour"""
+        mask, background, foreground = mrc_layers(self.boxed_page(), color=True)
+        assert mask.mode == '1' and mask.size == (120, 180)
+        assert not mask.getpixel((20, 13)) and mask.getpixel((20, 20))
+        assert background.size == (40, 60) and foreground.size == (20, 30)
+        assert background.getpixel((10, 5)) == (255, 240, 200)  # Text averaged away
+        assert foreground.getpixel((5, 2)) == (200, 30, 30)
+        _, gray_background, _ = mrc_layers(self.boxed_page(), color=False)
+        assert gray_background.mode == 'L'
+
+    def test_layered_pages_in_pdf(self):
+        """Test that mrc pages become masked layers and text-only pages stay G4"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            images = [tmp / "page_0001.png", tmp / "page_0002.png"]
+            self.boxed_page().save(images[0])
+            TestPageCodecs.text_page().save(images[1])
+            out_dir = tmp / "processed"
+            out_dir.mkdir()
+            pages = preprocess_images(images, out_dir, False, 248, 0, 90, workers=2, codec_mode='mrc', dpi=150)
+            assert [(p['file'].name, p['codec']) for p in pages] == [("page_0001.pdf", 'mrc'), ("page_0002.tif", 'bilevel')]
+            
+            build_pdf_from_images([p['file'] for p in pages], tmp / "raw.pdf", dpi=150)
+            with pikepdf.open(tmp / "raw.pdf") as pdf:
+                assert pdf.check_pdf_syntax() == []
+                assert [float(v) for v in pdf.pages[0].mediabox] == [0, 0, 57.6, 86.4]
+                layers = pdf.pages[0].Resources.XObject
+                assert layers.Fg.Mask.ImageMask
+                assert int(layers.Fg.Mask.Width) == 120 and int(layers.Bg.Width) == 40
+
+
+class TestBuildWorkspace:
+    """Tests for the managed build workspace"""
+
+    def test_spills_over_budget(self):
+        """Test that files stay in the workdir within budget and spill to disk beyond it"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            with BuildWorkspace(tmp / "ram", budget_bytes=1000, spill_root=tmp / "disk") as ws:
+                processed = ws.dir("processed", 600)
+                assert processed.parent == ws.primary and processed.is_dir()
+                (processed / "page_0001.jpg").write_bytes(b"x" * 600)
+                raw = ws.path("raw.pdf", 600)
+                assert raw.parent == ws.spill and raw.parent.parent == tmp / "disk"
+                assert ws.spilled == ["raw.pdf"]
+                assert ws.path("small.bin", 300).parent == ws.primary
+            assert list((tmp / "ram").iterdir()) == [] and list((tmp / "disk").iterdir()) == []
+
+    def test_cleanup_on_error(self):
+        """Test that the workspace is removed when the build fails or is interrupted"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            for error in (RuntimeError, KeyboardInterrupt, SystemExit):
+                with pytest.raises(error):
+                    with BuildWorkspace(tmp, budget_bytes=0, spill_root=tmp) as ws:
+                        ws.path("raw.pdf", 10).write_bytes(b"x" * 10)
+                        raise error()
+                assert list(tmp.iterdir()) == []
+
+    def test_ocr_temp_files_in_workspace(self, monkeypatch):
+        """Test that ocrmypdf's intermediate files go to the workspace"""
+        calls = []
+        monkeypatch.setattr(edubase_cli.subprocess, "run", lambda cmd, **kwargs: calls.append(kwargs))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            with BuildWorkspace(tmp, budget_bytes=10 ** 9) as ws:
+                ocr_tmp = ws.dir("ocrmypdf", 10)
+                edubase_cli.run_ocr(tmp / "raw.pdf", tmp / "ocr.pdf", "deu", 1, 1, tmpdir=ocr_tmp)
+                edubase_cli.run_ocr(tmp / "raw.pdf", tmp / "ocr.pdf", "deu", 1, 1)
+        assert calls[0]['env']['TMPDIR'] == str(ocr_tmp) and calls[0]['env']['PATH'] == os.environ['PATH']
+        assert calls[1]['env'] is None
+
+    def test_reaps_stale_workspaces(self):
+        """Test that workspaces of dead builds are removed and live ones kept"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            dead = subprocess.Popen([sys.executable, "-c", ""])
+            dead.wait()
+            (tmp / f"edubase-build-{dead.pid}-abc").mkdir()
+            (tmp / f"edubase-build-{os.getpid()}-def").mkdir()
+            (tmp / "unrelated").mkdir()
+            assert reap_stale_workspaces(tmp) == 1
+            assert sorted(p.name for p in tmp.iterdir()) == [f"edubase-build-{os.getpid()}-def", "unrelated"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
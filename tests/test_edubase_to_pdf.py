@@ -8,16 +8,21 @@ import pytest
 from pathlib import Path
 import tempfile
 import shutil
+import numpy as np
 from PIL import Image
+from contextlib import contextmanager
 
 # Import functions from main script
 import sys
 sys.path.insert(0, str(Path(__file__).parent.parent))
+import edubase_to_pdf
 from edubase_to_pdf import (
     natural_key,
     list_images,
     ensure_dir,
     auto_crop_image,
+    content_bbox,
+    capture_pages,
 )
 
 
@@ -93,6 +98,36 @@ class TestImageOperations:
         result = auto_crop_image(white_img, threshold=248, margin_px=0)
         # Should return original if no content found
         assert result.size == white_img.size
+    
+    @staticmethod
+    def reference_bbox(img, threshold):
+        """Bounding box as computed by the original Image.point/getbbox version"""
+        mask = img.convert('L').point(lambda x: 0 if x > threshold else 255, mode='1')
+        return mask.getbbox()
+    
+    @pytest.mark.parametrize("seed", range(20))
+    def test_content_bbox_matches_reference(self, seed):
+        """Test that the vectorized search finds exactly the old crop box"""
+        rng = np.random.default_rng(seed)
+        height, width = rng.integers(1, 120, size=2)
+        pixels = np.full((height, width), 255, dtype=np.uint8)
+        for _ in range(rng.integers(0, 4)):
+            y, x = rng.integers(0, height), rng.integers(0, width)
+            h, w = rng.integers(1, 20, size=2)
+            pixels[y:y + h, x:x + w] = rng.integers(0, 249)
+        img = Image.fromarray(pixels)
+        assert content_bbox(img, 248) == self.reference_bbox(img, 248)
+    
+    def test_content_bbox_finds_hairlines(self):
+        """Test that single-pixel content between the sample grid is found"""
+        pixels = np.full((64, 64), 255, dtype=np.uint8)
+        pixels[3, 5] = 0
+        pixels[61, 59] = 0
+        assert content_bbox(Image.fromarray(pixels), 248, step=8) == (5, 3, 60, 62)
+        pixels[3, 5] = pixels[61, 59] = 255
+        pixels[20:40, 20:40] = 0
+        pixels[1, 63] = 100
+        assert content_bbox(Image.fromarray(pixels), 248, step=8) == (20, 1, 64, 40)
 
 
 class TestListImages:
@@ -150,6 +185,94 @@ class TestListImages:
             assert len(images) == 3
 
 
+class FakeTab:
+    """Tab that shows the page of its last goto; errors are looked up by page index"""
+
+    class Response:
+        status = 200
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.shown = None
+
+    def goto(self, url, **kwargs):
+        index = url.rsplit("/", 1)[1]
+        index = int(index) if index.isdigit() else None
+        if index in self.browser.nav_errors:
+            self.browser.failures.append((self, index))
+            raise RuntimeError("net::ERR_CONNECTION_RESET")
+        self.shown = index
+        return self.Response()
+
+    def wait_for_load_state(self, state, timeout=None):
+        pass
+
+    def evaluate(self, script, arg=None):
+        return None
+
+    def screenshot(self, path, **kwargs):
+        if self.shown in self.browser.shot_errors:
+            self.browser.failures.append((self, self.shown))
+            raise RuntimeError("Target closed")
+        self.browser.shots.append((self, self.shown))
+        Path(path).write_bytes(f"page {self.shown}".encode())
+
+
+class FakeBrowser:
+    """Stands in for sync_playwright(), firefox and the persistent context at once"""
+
+    def __init__(self, nav_errors=(), shot_errors=()):
+        self.nav_errors = set(nav_errors)
+        self.shot_errors = set(shot_errors)
+        self.shots = []
+        self.failures = []
+        self.tabs = []
+        self.firefox = self
+        self.pages = [self.new_page()]
+
+    def launch_persistent_context(self, **kwargs):
+        return self
+
+    def new_page(self):
+        tab = FakeTab(self)
+        self.tabs.append(tab)
+        return tab
+
+    def set_default_timeout(self, timeout):
+        pass
+
+    set_default_navigation_timeout = set_default_timeout
+
+    def close(self):
+        pass
+
+
+class TestParallelCapture:
+    """Test the multi-tab page queue against fake tabs"""
+
+    def test_tabs_share_the_queue(self, monkeypatch, capsys):
+        """Test that every page is captured once and failures of all tabs are merged"""
+        browser = FakeBrowser(nav_errors={4}, shot_errors={6})
+        monkeypatch.setattr(edubase_to_pdf, "sync_playwright", contextmanager(lambda: (yield browser)))
+        monkeypatch.setattr(edubase_to_pdf.time, "sleep", lambda s: None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_dir = Path(tmpdir)
+            (out_dir / "page_0003.png").write_bytes(b"old")
+            capture_pages(
+                "https://app.edubase.ch/#doc/60505/2", total_pages=9, out_dir=out_dir, user_data_dir=out_dir,
+                viewer_selector=None, start_index=2, per_page_delay_ms=0, fullpage=True, crop=False,
+                crop_threshold=250, crop_margin=0, click_next_selector=None, advance_with_keys=False, workers=3,
+            )
+            shot_pages = [page for _, page in browser.shots]
+            assert sorted(shot_pages) == [2, 5, 7, 8, 9]
+            assert {tab for tab, _ in browser.shots} == set(browser.tabs)
+            for i in shot_pages:
+                assert (out_dir / f"page_{i:04d}.png").read_bytes() == f"page {i}".encode()
+            assert (out_dir / "page_0003.png").read_bytes() == b"old"
+        assert len({tab for tab, _ in browser.failures}) == 2  # Failed on different tabs
+        assert "Fehlgeschlagen: 2 Seiten: [4, 6]" in capsys.readouterr().out
+
+
 class TestConfiguration:
     """Test configuration and constants"""
     